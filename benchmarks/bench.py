@@ -0,0 +1,450 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks of mmr commands on synthetic dependency graphs.
+
+Each scenario generates a graph of bare repositories on local disk (reached
+with file:// URLs, so nothing touches the network) and then runs a sequence
+of mmr commands in a fresh repository, timing each end-to-end and counting
+the git processes it ran (from its --profile trace).
+
+A graph has a root tree, "depth" levels of dependencies below it and
+"fanout" dependencies per tree. With "sharing", a dependency may instead be
+an existing tree of the same level (making diamonds). Each dependency is
+either a git submodule or a module_deps.json entry ("json_fraction" is the
+chance of the latter). Every repository has "commits" commits. Repositories
+are written with a single "git fast-import" each, so large graphs are cheap
+to generate.
+
+Run with run_benchmarks.sh from the top of the source tree. Results can be
+saved with --json and compared against a saved baseline with --baseline, which
+fails if any command runs more git processes, or becomes slower by more than
+--tolerance. Git process counts are deterministic, so they make a stable
+regression gate.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+GraphSpec = collections.namedtuple(
+    "GraphSpec", "depth,fanout,sharing,json_fraction,commits,seed")
+
+SCENARIOS = collections.OrderedDict([
+    ("small", GraphSpec(2, 3, 0.0, 0.5, 5, 1)),
+    ("wide", GraphSpec(1, 32, 0.0, 0.5, 5, 2)),
+    ("deep", GraphSpec(8, 1, 0.0, 0.5, 5, 3)),
+    ("diamond", GraphSpec(4, 4, 0.6, 0.5, 5, 4)),
+    ("history", GraphSpec(2, 3, 0.0, 0.5, 500, 5)),
+])
+
+# Commands run for each scenario, in order, as (step name, mmr arguments).
+STEPS = [
+    ("init", ["init"]),
+    ("checkout", ["checkout", "{root_url}"]),
+    ("status", ["status"]),
+    ("version_map --set", ["version_map", "--set", "root"]),
+    ("fix --all", ["fix", "--all"]),
+]
+
+StepResult = collections.namedtuple(
+    "StepResult", "scenario,step,trees,seconds,git_processes,cat_file_queries")
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "python")
+# Commit times are fixed so that generated graphs are identical across runs.
+BASE_COMMIT_TIME = 1600000000
+
+
+class BenchmarkError(Exception):
+  """An error running a benchmark."""
+
+
+def generate_graph(spec: GraphSpec):
+  """Generates the shape of a dependency graph.
+
+  Returns:
+    Tuple of (levels, deps). levels is a list of lists of tree names, starting
+    with ["root"]. deps maps each tree name to a list of (dep name, kind),
+    where kind is "gitmodules" or "json".
+
+  >>> levels, deps = generate_graph(GraphSpec(2, 2, 0.0, 0.0, 1, 0))
+  >>> levels
+  [['root'], ['t1_0', 't1_1'], ['t2_0', 't2_1', 't2_2', 't2_3']]
+  >>> deps["t1_1"]
+  [('t2_2', 'gitmodules'), ('t2_3', 'gitmodules')]
+  >>> levels, deps = generate_graph(GraphSpec(2, 2, 1.0, 1.0, 1, 0))
+  >>> levels
+  [['root'], ['t1_0'], ['t2_0']]
+  >>> deps["root"]
+  [('t1_0', 'json')]
+  """
+  rng = random.Random(spec.seed)
+  levels = [["root"]]
+  deps = collections.defaultdict(list)
+  for depth in range(1, spec.depth + 1):
+    level = []
+    for parent in levels[-1]:
+      for _ in range(spec.fanout):
+        if level and rng.random() < spec.sharing:
+          child = rng.choice(level)
+          if any(child == name for name, _ in deps[parent]):
+            continue
+        else:
+          child = "t{}_{}".format(depth, len(level))
+          level.append(child)
+        kind = "json" if rng.random() < spec.json_fraction else "gitmodules"
+        deps[parent].append((child, kind))
+    levels.append(level)
+  return levels, deps
+
+
+def _data(contents: bytes) -> bytes:
+  return "data {}\n".format(len(contents)).encode("UTF-8") + contents + b"\n"
+
+
+def fast_import_stream(name: str, commits: int, dep_files) -> bytes:
+  """Creates a git fast-import stream for the history of a repository.
+
+  Args:
+    name: Name of the repository.
+    commits: Number of commits to create.
+    dep_files: Dict of path -> contents (bytes), or (None, commit) for a
+      gitlink, added by the last commit.
+  """
+  parts = []
+  for i in range(1, commits + 1):
+    commit_time = BASE_COMMIT_TIME + i
+    parts.append(b"commit refs/heads/main\n")
+    parts.append("mark :{}\n".format(i).encode("UTF-8"))
+    parts.append("committer Benchmark <bench@example.test> {} +0000\n".format(
+        commit_time).encode("UTF-8"))
+    parts.append(_data("Commit {} of {}".format(i, name).encode("UTF-8")))
+    if i > 1:
+      parts.append("from :{}\n".format(i - 1).encode("UTF-8"))
+    parts.append("M 100644 inline src/file{}.txt\n".format(i % 16).encode(
+        "UTF-8"))
+    parts.append(_data("{} revision {}\n".format(name, i).encode("UTF-8")))
+    if i == commits:
+      for path, contents in sorted(dep_files.items()):
+        if isinstance(contents, tuple):
+          parts.append("M 160000 {} {}\n".format(contents[1],
+                                                path).encode("UTF-8"))
+        else:
+          parts.append("M 100644 inline {}\n".format(path).encode("UTF-8"))
+          parts.append(_data(contents))
+  return b"".join(parts)
+
+
+def repo_url(remotes_dir: str, name: str) -> str:
+  return "file://{}/{}.git".format(remotes_dir, name)
+
+
+def create_graph(spec: GraphSpec, remotes_dir: str, env) -> int:
+  """Creates the bare repositories of a graph.
+
+  Returns:
+    The number of repositories.
+  """
+  levels, deps = generate_graph(spec)
+  heads = {}
+  # Dependencies must exist before their dependents (to know their commits).
+  for level in reversed(levels):
+    for name in level:
+      dep_files = {}
+      gitmodules = []
+      json_deps = []
+      for dep_name, kind in deps[name]:
+        url = repo_url(remotes_dir, dep_name)
+        if kind == "gitmodules":
+          path = "third_party/" + dep_name
+          gitmodules.append(
+              '[submodule "{0}"]\n\tpath = {0}\n\turl = {1}\n'.format(
+                  path, url))
+          dep_files[path] = (None, heads[dep_name])
+        else:
+          json_deps.append({
+              "path": "deps/" + dep_name,
+              "url": url,
+              "version": heads[dep_name],
+          })
+      if gitmodules:
+        dep_files[".gitmodules"] = "".join(gitmodules).encode("UTF-8")
+      if json_deps:
+        dep_files["module_deps.json"] = json.dumps({"deps": json_deps},
+                                                   indent=2).encode("UTF-8")
+      git_dir = os.path.join(remotes_dir, name + ".git")
+      run_git(["init", "--quiet", "--bare", git_dir], env)
+      run_git(["symbolic-ref", "HEAD", "refs/heads/main"], env, git_dir=git_dir)
+      run_git(["fast-import", "--quiet"],
+              env,
+              git_dir=git_dir,
+              input=fast_import_stream(name, spec.commits, dep_files))
+      heads[name] = run_git(["rev-parse", "refs/heads/main"],
+                            env,
+                            git_dir=git_dir).strip()
+  return len(heads)
+
+
+def run_git(args, env, git_dir=None, input=None) -> str:
+  if git_dir is not None:
+    args = ["--git-dir", git_dir] + args
+  result = subprocess.run(["git"] + args,
+                          env=env,
+                          input=input,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+  if result.returncode != 0:
+    raise BenchmarkError("git {} failed:\n{}".format(
+        " ".join(args), result.stderr.decode("UTF-8", "replace")))
+  return result.stdout.decode("UTF-8")
+
+
+def create_env(work_dir: str):
+  """Creates an environment isolated from the user's and system git config."""
+  gitconfig = os.path.join(work_dir, "gitconfig")
+  with open(gitconfig, "w") as f:
+    f.write("[user]\n\tname = Benchmark\n\temail = bench@example.test\n"
+            "[protocol \"file\"]\n\tallow = always\n"
+            "[init]\n\tdefaultBranch = main\n")
+  env = dict(os.environ)
+  env["GIT_CONFIG_GLOBAL"] = gitconfig
+  env["GIT_CONFIG_NOSYSTEM"] = "1"
+  env["GIT_TERMINAL_PROMPT"] = "0"
+  env["PYTHONPATH"] = os.pathsep.join(
+      [PYTHON_DIR] + [p for p in [env.get("PYTHONPATH")] if p])
+  return env
+
+
+def read_profile(trace_file: str):
+  """Counts (git processes, cat-file queries) in a --profile trace."""
+  with open(trace_file, "r") as f:
+    trace = json.load(f)
+  categories = collections.Counter(
+      event.get("cat") for event in trace["traceEvents"])
+  return categories["git"], categories["cat-file"]
+
+
+def run_steps(scenario: str, root_url: str, trees: int, repo_dir: str, env,
+              log) -> list:
+  """Runs all steps in a new repository directory."""
+  os.makedirs(repo_dir)
+  trace_file = repo_dir + ".profile.json"
+  results = []
+  for step, step_args in STEPS:
+    args = [arg.format(root_url=root_url) for arg in step_args]
+    start_time = time.perf_counter()
+    command = [
+        sys.executable, "-m", "mmrepo.main", "--profile-output", trace_file
+    ] + args
+    result = subprocess.run(command,
+                            cwd=repo_dir,
+                            env=env,
+                            stdout=log,
+                            stderr=subprocess.STDOUT)
+    seconds = time.perf_counter() - start_time
+    if result.returncode != 0:
+      raise BenchmarkError("{}: 'mmr {}' failed (see {})".format(
+          scenario, " ".join(args), log.name))
+    git_processes, cat_file_queries = read_profile(trace_file)
+    results.append(
+        StepResult(scenario=scenario,
+                   step=step,
+                   trees=trees,
+                   seconds=seconds,
+                   git_processes=git_processes,
+                   cat_file_queries=cat_file_queries))
+  return results
+
+
+def run_scenario(scenario: str, spec: GraphSpec, work_dir: str, repeat: int,
+                 env) -> list:
+  scenario_dir = os.path.join(work_dir, scenario)
+  remotes_dir = os.path.join(scenario_dir, "remotes")
+  os.makedirs(remotes_dir)
+  start_time = time.perf_counter()
+  trees = create_graph(spec, remotes_dir, env)
+  print("Generated {} ({} repositories) in {:.2f}s".format(
+      scenario, trees,
+      time.perf_counter() - start_time))
+
+  runs = []
+  with open(os.path.join(scenario_dir, "mmr.log"), "w") as log:
+    for i in range(repeat):
+      runs.append(
+          run_steps(scenario, repo_url(remotes_dir, "root"), trees,
+                    os.path.join(scenario_dir, "repo{}".format(i)), env, log))
+  # Report the median time of each step (git process counts do not vary).
+  return [
+      step_results[0]._replace(seconds=statistics.median(
+          result.seconds for result in step_results))
+      for step_results in zip(*runs)
+  ]
+
+
+def print_results(results):
+  print("{:<10} {:>6}  {:<18} {:>9} {:>10} {:>9}".format(
+      "scenario", "trees", "step", "seconds", "git procs", "cat-file"))
+  for result in results:
+    print("{:<10} {:>6}  {:<18} {:>9.3f} {:>10} {:>9}".format(
+        result.scenario, result.trees, result.step, result.seconds,
+        result.git_processes, result.cat_file_queries))
+
+
+def compare_results(results, baseline_results, tolerance: float,
+                    min_seconds: float) -> list:
+  """Finds regressions against a baseline.
+
+  >>> r = StepResult("s", "status", 3, 1.0, 5, 0)
+  >>> compare_results([r], [r._replace(git_processes=4)], 0.25, 0.1)
+  ['s/status: 5 git processes (baseline 4)']
+  >>> compare_results([r], [r._replace(seconds=0.5)], 0.25, 0.1)
+  ['s/status: 1.000s (baseline 0.500s)']
+  >>> compare_results([r], [r._replace(seconds=0.95)], 0.25, 0.1)
+  []
+  """
+  baseline = {(result.scenario, result.step): result
+              for result in baseline_results}
+  regressions = []
+  for result in results:
+    base = baseline.get((result.scenario, result.step))
+    if base is None:
+      continue
+    name = "{}/{}".format(result.scenario, result.step)
+    if result.git_processes > base.git_processes:
+      regressions.append("{}: {} git processes (baseline {})".format(
+          name, result.git_processes, base.git_processes))
+    if (result.seconds > base.seconds * (1 + tolerance) and
+        result.seconds - base.seconds > min_seconds):
+      regressions.append("{}: {:.3f}s (baseline {:.3f}s)".format(
+          name, result.seconds, base.seconds))
+  return regressions
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="run_benchmarks.sh",
+      description="Benchmarks mmr commands on synthetic dependency graphs")
+  parser.add_argument("--scenario",
+                      dest="scenarios",
+                      action="append",
+                      choices=list(SCENARIOS) + ["custom"],
+                      help="Scenario to run (repeatable; default is all but "
+                      "custom)")
+  parser.add_argument("--depth", type=int, default=2,
+                      help="Depth of the custom graph")
+  parser.add_argument("--fanout", type=int, default=3,
+                      help="Dependencies per tree of the custom graph")
+  parser.add_argument("--sharing", type=float, default=0.0,
+                      help="Chance that a dependency of the custom graph is "
+                      "shared with another tree")
+  parser.add_argument("--json-fraction",
+                      dest="json_fraction",
+                      type=float,
+                      default=0.5,
+                      help="Chance that a dependency of the custom graph is "
+                      "in module_deps.json rather than .gitmodules")
+  parser.add_argument("--commits", type=int, default=5,
+                      help="Commits per repository of the custom graph")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="Random seed of the custom graph")
+  parser.add_argument("--repeat", type=int, default=3,
+                      help="Times to run each scenario (the median time is "
+                      "reported)")
+  parser.add_argument("--work-dir",
+                      dest="work_dir",
+                      default=None,
+                      help="Directory for generated repositories (default is "
+                      "a temporary directory, deleted afterwards)")
+  parser.add_argument("--json",
+                      dest="json_file",
+                      default=None,
+                      help="Write results to a JSON file")
+  parser.add_argument("--baseline",
+                      default=None,
+                      help="JSON results to compare against; exits with an "
+                      "error on regressions")
+  parser.add_argument("--tolerance",
+                      type=float,
+                      default=0.25,
+                      help="Allowed relative slowdown against the baseline")
+  parser.add_argument("--min-seconds",
+                      dest="min_seconds",
+                      type=float,
+                      default=0.1,
+                      help="Ignore slowdowns smaller than this")
+  return parser
+
+
+def main():
+  args = create_argument_parser().parse_args()
+  scenarios = collections.OrderedDict()
+  for scenario in args.scenarios or SCENARIOS:
+    if scenario == "custom":
+      scenarios[scenario] = GraphSpec(args.depth, args.fanout, args.sharing,
+                                      args.json_fraction, args.commits,
+                                      args.seed)
+    else:
+      scenarios[scenario] = SCENARIOS[scenario]
+
+  work_dir = args.work_dir
+  if work_dir is None:
+    work_dir = tempfile.mkdtemp(prefix="mmr-bench-")
+  elif os.path.exists(work_dir) and os.listdir(work_dir):
+    raise BenchmarkError("Work directory {} is not empty".format(work_dir))
+  else:
+    os.makedirs(work_dir, exist_ok=True)
+  work_dir = os.path.realpath(work_dir)
+  try:
+    env = create_env(work_dir)
+    results = []
+    for scenario, spec in scenarios.items():
+      results.extend(run_scenario(scenario, spec, work_dir, args.repeat, env))
+  except BenchmarkError:
+    # Keep the logs for debugging.
+    print("Work directory kept at", work_dir)
+    raise
+  if args.work_dir is None:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  print_results(results)
+  if args.json_file:
+    with open(args.json_file, "w") as f:
+      json.dump([result._asdict() for result in results], f, indent=2)
+  if args.baseline:
+    with open(args.baseline, "r") as f:
+      baseline_results = [StepResult(**result) for result in json.load(f)]
+    regressions = compare_results(results, baseline_results, args.tolerance,
+                                  args.min_seconds)
+    if regressions:
+      print("!! Regressions against {}:".format(args.baseline))
+      for regression in regressions:
+        print("  ", regression)
+      sys.exit(1)
+    print("** No regressions against", args.baseline)
+
+
+if __name__ == "__main__":
+  try:
+    main()
+  except BenchmarkError as e:
+    print("ERROR:", e)
+    sys.exit(1)
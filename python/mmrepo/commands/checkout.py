@@ -12,12 +12,61 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import concurrent.futures
 import os
 
 from mmrepo.common import *
+from mmrepo.parallel import *
+from mmrepo.remote_policy import *
 from mmrepo.repo import *
+from mmrepo import reporting
 
-HELP_MESSAGE = """Checks out a git repository tree.
+
+def add_clone_arguments(parser):
+  """Adds arguments for partial and shallow clone options."""
+  parser.add_argument("--filter",
+                      dest="clone_filter",
+                      default=None,
+                      help="Make partial clones with a filter (i.e. "
+                      "'blob:none' or 'tree:0')")
+  parser.add_argument("--depth",
+                      dest="clone_depth",
+                      type=int,
+                      default=None,
+                      help="Make shallow clones with this many commits")
+  parser.add_argument("--single-branch",
+                      dest="single_branch",
+                      action="store_true",
+                      default=None,
+                      help="Clone only the remote's default branch")
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="checkout",
+      description="Checks out a git repository tree",
+      add_help=False)
+  add_jobs_argument(parser)
+  add_clone_arguments(parser)
+  parser.add_argument("--sparse",
+                      dest="sparse",
+                      action="append",
+                      default=None,
+                      help="Only check out this directory of the tree (can "
+                      "be repeated)")
+  parser.add_argument("tree_url",
+                      nargs="?",
+                      default=None,
+                      help="Repository URL to check out")
+  parser.add_argument("local_path",
+                      nargs="?",
+                      default=None,
+                      help="Local path to link the checked out tree to")
+  return parser
+
+
+HELP_MESSAGE = create_argument_parser().format_help() + """
 
 Syntax:
   mmr checkout <repository url> [local path]
@@ -29,74 +78,239 @@ at a specific local path. This is typically used in bare mm-repos.
 In the second form, the git tree that is mapped to the current working directory
 is checked out (all dependencies are resolved). Typically it will already
 exist, so a clone is skipped.
+
+Dependencies are cloned concurrently (bounded by --jobs). As soon as a tree
+is available, its dependencies are discovered and scheduled.
+
+The --filter, --depth and --single-branch options are remembered for the
+requested tree, overriding the defaults of the repository (see "mmr help
+init"), which apply to its dependencies. When a version is later checked out
+that is missing from a shallow or single branch clone, it is fetched on
+demand.
+
+With --sparse, only the given directories of the requested tree are checked
+out (using cone mode sparse-checkout). Entries in module_deps.json can also
+have a "sparse" list of directories. A tree is checked out sparsely only if
+all of the trees depending on it ask for it to be, and then with the union
+of the requested directories.
 """
 
 
 def checkout(repo, tree, is_root_checkout):
-  print("Checking out tree {}".format(tree))
+  reporting.info("Checking out tree {}", tree)
   tree.checkout()
+  link_default(repo, tree, is_root_checkout)
+
+
+def link_default(repo, tree, is_root_checkout):
   if not is_root_checkout:
     # Create a default link under all/
     all_path = os.path.join(repo.path, "all", tree.default_local_path)
     tree.make_link(all_path)
 
 
+class CheckoutScheduler:
+  """Checks out a graph of trees, cloning independent trees concurrently.
+
+  Only materialization (cloning) runs on the worker pool. Dependency
+  initialization (which mutates the repository config and creates links) is
+  done on the calling thread as each tree completes, at which point its
+  dependencies are discovered and scheduled.
+
+  The parts of a tree that are checked out are the union of what its
+  dependents request, but a dependent can be reached after the tree was
+  checked out. So once all trees are processed, run() applies sparse-checkouts
+  again where the requests changed.
+
+  Trees shared by several dependents are checked out once:
+
+  >>> from mmrepo.testing import TestEnv
+  >>> env = TestEnv()
+  >>> x = env.create_remote("x")
+  >>> a = env.create_remote("a", json_deps=[{"path": "x", "url": x}])
+  >>> b = env.create_remote("b", submodules={"x": x})
+  >>> root = env.create_remote("root", json_deps=[{"path": "a", "url": a},
+  ...                                             {"path": "b", "url": b}])
+  >>> repo = env.init_repo("repo")
+  >>> env.mmr(repo, "checkout", root).splitlines()[-1]
+  '** Processed 4 repositories'
+  >>> sorted(os.listdir(os.path.join(repo, "all")))
+  ['a', 'b', 'root', 'x']
+
+  Existing trees are only repaired (not cloned or reset again):
+
+  >>> os.unlink(os.path.join(repo, "all", "a", "x"))
+  >>> open(os.path.join(repo, "all", "x", "untracked"), "w").close()
+  >>> env.mmr(os.path.join(repo, "all", "root"), "checkout").splitlines()[-1]
+  '** Processed 4 repositories'
+  >>> sorted(os.listdir(os.path.join(repo, "all", "a", "x")))
+  ['.git', 'README', 'untracked']
+
+  Trees which fail are reported once all others are checked out:
+
+  >>> missing = env.remote_url("missing")
+  >>> c = env.create_remote("c", json_deps=[{"path": "m", "url": missing,
+  ...                                        "version": "main"},
+  ...                                       {"path": "x", "url": x}])
+  >>> output = env.mmr(repo, "checkout", c)
+  >>> [line for line in output.splitlines() if line.startswith("!!")]
+  ['!! 1 repositories had errors:', '!! Error messages:']
+  >>> "does not appear to be a git repository" in output
+  True
+  >>> os.path.islink(os.path.join(repo, "all", "c", "x"))
+  True
+  >>> env.close()
+  """
+
+  def __init__(self, repo, executor, is_root_checkout, progress):
+    super().__init__()
+    self.repo = repo
+    self.executor = executor
+    self.is_root_checkout = is_root_checkout
+    self.progress = progress
+    self.processed = set()
+    self.errored = set()
+    self.exceptions = []
+    self._pending = {}
+    # tree -> sparse-checkout directories applied when it completed.
+    self._sparse_directories = {}
+
+  def _materialize(self, tree, sparse_directories):
+    reporting.detail("Checking out tree {}", tree, event="tree_checkout",
+                     tree=tree.tree_id)
+    return tree.materialize(sparse_directories=sparse_directories)
+
+  def schedule(self, tree):
+    if tree in self.processed:
+      return
+    self.processed.add(tree)
+    self.progress.add_total()
+    # Which parts of the tree are needed depends on the graph (so is decided
+    # here, not on the worker).
+    future = self.executor.submit(self._materialize, tree,
+                                  tree.sparse_checkout_directories())
+    self._pending[future] = tree
+
+  def _complete(self, future, tree):
+    try:
+      cloned = future.result()
+      directories = tree.sparse_checkout_directories()
+      tree.apply_sparse_checkout(directories)
+      self._sparse_directories[tree] = directories
+      if cloned:
+        tree.ensure_dep_providers_initialized()
+      else:
+        # Only repair what is broken in existing trees.
+        tree.repair_dep_problems(tree.find_dep_problems())
+      link_default(self.repo, tree, self.is_root_checkout)
+    except UserError as e:
+      self.errored.add(tree)
+      self.exceptions.append(e)
+    self.progress.advance()
+
+    for tree_dep in tree.dependencies:
+      self.schedule(tree_dep)
+
+  def run(self):
+    while self._pending:
+      done, _ = concurrent.futures.wait(
+          self._pending, return_when=concurrent.futures.FIRST_COMPLETED)
+      for future in done:
+        tree = self._pending.pop(future)
+        self._complete(future, tree)
+    self._update_sparse_checkouts()
+
+  def _update_sparse_checkouts(self):
+    """Applies sparse-checkouts again for trees whose requests changed.
+
+    Here x is first reached through a sparse module_deps.json entry, and
+    later (after it was checked out) through a submodule needing all of it:
+
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x", files={"a/f": "", "b/f": ""})
+    >>> a = env.create_remote("a", json_deps=[{"path": "x", "url": x,
+    ...                                        "sparse": ["a"]}])
+    >>> b = env.create_remote("b", submodules={"x": x})
+    >>> c = env.create_remote("c", json_deps=[{"path": "b", "url": b}])
+    >>> d = env.create_remote("d", json_deps=[{"path": "c", "url": c}])
+    >>> root = env.create_remote("root", json_deps=[{"path": "a", "url": a},
+    ...                                             {"path": "d", "url": d}])
+    >>> repo = env.init_repo("repo")
+    >>> _ = env.mmr(repo, "checkout", "--jobs", "1", root)
+    >>> sorted(os.listdir(os.path.join(repo, "all", "x")))
+    ['.git', 'README', 'a', 'b']
+    >>> env.mmr(repo, "fix", "--all", "--dry-run").splitlines()
+    ['** 0 problems would be fixed']
+    >>> env.close()
+    """
+    for tree in self.processed - self.errored:
+      directories = tree.sparse_checkout_directories()
+      if (tree in self._sparse_directories and
+          directories == self._sparse_directories[tree]):
+        continue
+      try:
+        tree.apply_sparse_checkout(directories)
+      except UserError as e:
+        self.errored.add(tree)
+        self.exceptions.append(e)
+
+
 def exec(*args):
+  args = create_argument_parser().parse_args(args)
   repo = Repo.find_from_cwd()
-  local_path = None
+  local_path = args.local_path
   is_root_checkout = False
-  if len(args) == 0:
+  if args.tree_url is None:
     # Re-checkout the current repository.
     tree = repo.tree_from_cwd()
     is_root_checkout = True
   else:
     # Checkout a requested: git_url [local_path]
-    if len(args) == 1:
-      tree_url = args[0]
-    elif len(args) == 2:
-      tree_url, local_path = args
-    tree = repo.get_tree(tree_url)
-
-  # Checkout the repository.
-  checkout(repo, tree, is_root_checkout)
-
-  # Create the requested link.
-  if local_path is not None:
-    if os.path.isdir(local_path):
-      # Treat it like a symlink to a directory where it will create a link
-      # with the source name in that directory.
-      local_path = os.path.join(local_path, tree.default_local_path)
-    tree.make_link(local_path)
-
-  # Collect recursive dependencies.
-  recursive_processed = set()
-  recursive_errored = set()
-  all_exceptions = []
-  all_depends = set()
-
-  all_depends.add(tree)
-  recursive_processed.add(tree)
-  all_depends.update(tree.dependencies)
-
-  while all_depends != recursive_processed:
-    for tree_dep in set(all_depends):
-      if tree_dep in recursive_processed:
-        continue
-      recursive_processed.add(tree_dep)
-      try:
-        checkout(repo, tree_dep, is_root_checkout)
-      except UserError as e:
-        recursive_errored.add(tree_dep)
-        all_exceptions.append(e)
+    tree = repo.get_tree(args.tree_url)
+    tree.set_clone_options(clone_filter=args.clone_filter,
+                           clone_depth=args.clone_depth,
+                           single_branch=args.single_branch)
+    if args.sparse:
+      tree.sparse = args.sparse
 
-      all_depends.update(tree_dep.dependencies)
+  with reporting.progress("Checking out", total=1) as progress:
+    # Checkout the repository.
+    checkout(repo, tree, is_root_checkout)
+    progress.advance()
+
+    # Create the requested link.
+    if local_path is not None:
+      if os.path.isdir(local_path):
+        # Treat it like a symlink to a directory where it will create a link
+        # with the source name in that directory.
+        local_path = os.path.join(local_path, tree.default_local_path)
+      tree.make_link(local_path)
+
+    # Check out recursive dependencies.
+    with create_executor(args.jobs) as executor:
+      scheduler = CheckoutScheduler(repo, executor, is_root_checkout, progress)
+      scheduler.processed.add(tree)
+      for tree_dep in tree.dependencies:
+        scheduler.schedule(tree_dep)
+      scheduler.run()
 
   # Report.
-  print("** Processed {} repositories".format(len(all_depends)))
-  if recursive_errored:
-    print("!! {} repositories had errors:".format(len(recursive_errored)))
-    for error_tree in recursive_errored:
-      print("  {}".format(error_tree))
-    print("!! Error messages:")
-    for ex in all_exceptions:
-      print("  ", ex.message)
+  reporting.info("** Processed {} repositories", len(scheduler.processed))
+  report_remote_stats()
+  if scheduler.errored:
+    lines = ["!! {} repositories had errors:".format(len(scheduler.errored))]
+    for error_tree in scheduler.errored:
+      lines.append("  {}".format(error_tree))
+    lines.append("!! Error messages:")
+    for ex in scheduler.exceptions:
+      lines.append("   {}".format(ex.message))
+    reporting.error("{}",
+                    "\n".join(lines),
+                    event="checkout_errors",
+                    trees=[str(error_tree) for error_tree in scheduler.errored])
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
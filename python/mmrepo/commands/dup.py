@@ -0,0 +1,207 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+
+from mmrepo.commands.checkout import link_default
+from mmrepo.common import *
+from mmrepo import fileutils
+from mmrepo.config import *
+from mmrepo.parallel import *
+from mmrepo.repo import *
+from mmrepo import reporting
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="dup",
+      description="Creates a light-weight duplicate of a repository",
+      add_help=False)
+  mode_group = parser.add_mutually_exclusive_group()
+  mode_group.add_argument("--worktree",
+                          dest="worktree",
+                          action="store_true",
+                          default=True,
+                          help="Make trees linked git worktrees (default)")
+  mode_group.add_argument("--shared",
+                          dest="worktree",
+                          action="store_false",
+                          help="Make trees 'git clone --shared' clones")
+  add_jobs_argument(parser)
+  parser.add_argument("source_path", help="Repository to duplicate")
+  parser.add_argument("local_path",
+                      nargs="?",
+                      default=".",
+                      help="Directory of the new repository (default is the "
+                      "current directory)")
+  return parser
+
+
+HELP_MESSAGE = create_argument_parser().format_help() + """
+
+Syntax:
+  mmr dup <source repository> [local path]
+
+Creates a new repository with the same trees, aliases and settings as the
+source, with each tree at the commit currently checked out in the source.
+Trees share objects with the source instead of being cloned: by default
+they are linked worktrees of the source trees (see "git worktree"), or with
+--shared, "git clone --shared" clones. Either way, the source repository must
+outlive the duplicate. After deleting a duplicate made of worktrees, run
+"git worktree prune" in the source trees (git also does this eventually).
+
+If the source repository is also a git repository (has a __root__ tree), the
+new repository directory is also created from it and must not exist or be
+empty.
+
+Dependency links and skip-worktree flags are then re-created in the new
+repository, as "mmr fix" would. Versions of trees in the duplicate can be
+changed independently (i.e. with "mmr version_map --set").
+"""
+
+
+def dup_root(git, source_tree, local_path, worktree):
+  """Creates the repository directory from the source's root tree."""
+  if os.path.exists(local_path) and os.listdir(local_path):
+    raise UserError(
+        "Cannot duplicate a repository with a root tree into {} "
+        "(directory is not empty)", local_path)
+  if os.path.isdir(local_path):
+    os.rmdir(local_path)
+  commit = git.rev_parse(source_tree.path_in_repo, "HEAD")
+  if worktree:
+    git.worktree_add(source_tree.path_in_repo, local_path, commit)
+  else:
+    git.clone(source_tree.path_in_repo,
+              local_path,
+              clone_args=["--shared", "--no-checkout"])
+    origin_url = git.config_get(source_tree.path_in_repo, "remote.origin.url")
+    if origin_url is not None:
+      git.remote_set_url(local_path, "origin", origin_url)
+    git.checkout_version(local_path, commit, fetch=False)
+
+
+def exec(*args):
+  """Duplicates a repository.
+
+  >>> from mmrepo.testing import TestEnv
+  >>> env = TestEnv()
+  >>> x = env.create_remote("x")
+  >>> a = env.create_remote("a", json_deps=[{"path": "deps/x", "url": x}])
+  >>> b = env.create_remote("b", submodules={"x": x})
+  >>> repo = env.init_repo("repo")
+  >>> _ = env.mmr(repo, "checkout", a)
+  >>> _ = env.mmr(repo, "checkout", b)
+  >>> env.mmr(env.path, "dup", repo, "dup").splitlines()[-1]
+  '** Duplicated 3 trees'
+  >>> env.mmr(env.path, "dup", "--shared", repo, "shared").splitlines()[-1]
+  '** Duplicated 3 trees'
+
+  Trees share objects with the source, and links point within the duplicate:
+
+  >>> dup, shared = os.path.join(env.path, "dup"), os.path.join(env.path,
+  ...                                                            "shared")
+  >>> os.path.isfile(os.path.join(dup, "all", "x", ".git"))
+  True
+  >>> os.path.isfile(os.path.join(shared, "all", "x", ".git", "objects",
+  ...                             "info", "alternates"))
+  True
+  >>> [os.path.realpath(os.path.join(path, "all", "b", "x")) ==
+  ...  os.path.realpath(os.path.join(path, "all", "a", "deps", "x"))
+  ...  for path in (dup, shared)]
+  [True, True]
+  >>> [os.path.realpath(os.path.join(path, "all", "x")).startswith(path + "/")
+  ...  for path in (dup, shared)]
+  [True, True]
+  >>> [env.git(os.path.join(path, "all", "x"), "rev-parse", "HEAD") ==
+  ...  env.head(x) for path in (dup, shared)]
+  [True, True]
+  >>> [env.mmr(path, "fix", "--all", "--dry-run").splitlines()
+  ...  for path in (dup, shared)]
+  [['** 0 problems would be fixed'], ['** 0 problems would be fixed']]
+
+  A repository cannot be duplicated onto an existing one:
+
+  >>> try:
+  ...   env.mmr(env.path, "dup", repo, "dup")
+  ... except AssertionError as e:
+  ...   print(str(e).splitlines()[1])
+  ERROR: Repository cannot be created under existing .../dup
+  >>> env.close()
+  """
+  args = create_argument_parser().parse_args(args)
+  source_repo = Repo.find_existing(args.source_path)
+  if source_repo is None:
+    raise UserError("No repository at {}", args.source_path)
+  local_path = os.path.realpath(args.local_path)
+  if os.path.exists(local_path) and fileutils.is_same_path(
+      local_path, source_repo.path):
+    raise UserError("Cannot duplicate a repository onto itself")
+
+  source_root_tree = None
+  source_trees = []
+  for tree in source_repo.all_trees():
+    if not isinstance(tree, GitTreeRef):
+      reporting.warning("UNKNOWN TREE TYPE: {}", tree.tree_id)
+    elif tree.is_root_tree:
+      source_root_tree = tree
+    else:
+      source_trees.append(tree)
+
+  if source_root_tree is not None:
+    dup_root(source_repo.git, source_root_tree, local_path, args.worktree)
+  else:
+    os.makedirs(local_path, exist_ok=True)
+  repo = Repo.init(from_cwd=local_path, exist_ok=False, exact_path=True)
+  reporting.info("Duplicating {} trees from {} into {}", len(source_trees),
+                 source_repo.path, repo.path)
+
+  # Take on all trees and settings of the source.
+  trees_config = repo.config.trees
+  trees_config.copy_from(source_repo.config.trees)
+  trees_config.aliases.pop(source_repo.path, None)
+  root_tree = None
+  if source_root_tree is not None:
+    # Re-add the root tree, so that it is annotated for the new location.
+    trees_config.tree_dicts.pop(source_root_tree.tree_id)
+    root_tree = repo.get_root_tree()
+
+  # Create the trees concurrently.
+  trees = [repo.tree_from_id(tree.tree_id) for tree in source_trees]
+  with reporting.progress("Duplicating", total=len(trees)) as progress:
+
+    def materialize(tree, source_tree):
+      created = tree.materialize_from(source_tree, worktree=args.worktree)
+      progress.advance()
+      return created
+
+    with create_executor(args.jobs) as executor:
+      created = list(executor.map(materialize, trees, source_trees))
+
+  # Re-create links (which are not shared).
+  if root_tree is not None:
+    root_tree.ensure_dep_providers_initialized()
+  for tree, was_created in zip(trees, created):
+    if not was_created:
+      reporting.info("Skipping {} (not checked out in the source)", tree)
+      continue
+    tree.ensure_dep_providers_initialized()
+    link_default(repo, tree, is_root_checkout=False)
+  reporting.info("** Duplicated {} trees", sum(1 for c in created if c))
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -12,18 +12,149 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+
+from mmrepo.commands.status import format_dep_problem
 from mmrepo.config import *
+from mmrepo.git import *
 from mmrepo.repo import *
+from mmrepo import reporting
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(
+      prog="fix",
+      description="Fixes dependency links of trees",
+      add_help=False)
+  parser.add_argument("--dry-run",
+                      dest="dry_run",
+                      action="store_true",
+                      help="Only report what would be fixed")
+  parser.add_argument("--all",
+                      dest="all",
+                      action="store_true",
+                      help="Fix all trees (instead of the tree of the current "
+                      "directory and its dependencies)")
+  return parser
+
+
+HELP_MESSAGE = create_argument_parser().format_help() + """
 
-HELP_MESSAGE = """Fixes trees after repository events.
+Fixes trees after repository events.
 
 Certain repository events (pull, reset --hard, etc) can leave tree dependency
-links in an inconsistent state. This resets them.
+links in an inconsistent state. This checks the tree of the current directory
+and all of its (transitive) dependencies and repairs only what is wrong:
+dependency symlinks which are missing or point elsewhere, submodule paths
+which are no longer skip-worktree and out of date sparse-checkouts. If
+nothing changed, nothing is touched.
 """
 
+
+def dependency_closure(root_trees):
+  """Gets trees and their transitive dependencies which are checked out."""
+  closure = []
+  seen = set(root_trees)
+  pending = list(root_trees)
+  for tree in pending:
+    if find_git_dirs(tree.path_in_repo) is None:
+      continue
+    closure.append(tree)
+    for dep_tree in tree.dependencies:
+      if dep_tree not in seen:
+        seen.add(dep_tree)
+        pending.append(dep_tree)
+  return closure
+
+
+def fix_tree(tree, dry_run: bool) -> int:
+  """Fixes (or with dry_run, reports) problems of a tree.
+
+  Returns:
+    The number of problems (as reported).
+
+  Here x needs another part checked out, and its link to y is missing:
+
+  >>> import glob, json, os
+  >>> from mmrepo.testing import TestEnv
+  >>> env = TestEnv()
+  >>> y = env.create_remote("y")
+  >>> x = env.create_remote("x", files={"a/f": "", "b/f": ""},
+  ...                       json_deps=[{"path": "deps/y", "url": y}])
+  >>> a = env.create_remote("a", json_deps=[{"path": "x", "url": x,
+  ...                                        "sparse": ["a"]}])
+  >>> repo = env.init_repo("repo")
+  >>> _ = env.mmr(repo, "checkout", a)
+  >>> a_path, = glob.glob(repo + "/.mmrepo/universe/**/a.git", recursive=True)
+  >>> deps_file = os.path.join(a_path, "module_deps.json")
+  >>> with open(deps_file) as f:
+  ...   deps = json.load(f)
+  >>> deps["deps"][0]["sparse"] = ["b"]
+  >>> with open(deps_file, "w") as f:
+  ...   json.dump(deps, f)
+  >>> os.unlink(os.path.join(repo, "all", "x", "deps", "y"))
+  >>> [line.split(" : ")[-1]
+  ...  for line in env.mmr(repo, "fix", "--all").splitlines()]
+  ['not linked: deps/y', 'sparse-checkout: b', '** Fixed 2 problems']
+  >>> sorted(os.listdir(os.path.join(repo, "all", "x")))
+  ['.git', 'README', 'b', 'deps', 'module_deps.json']
+  >>> os.path.islink(os.path.join(repo, "all", "x", "deps", "y"))
+  True
+  >>> env.close()
+  """
+  action = "Would fix" if dry_run else "Fixing"
+  problems = tree.find_dep_problems()
+  for problem in problems:
+    reporting.info("{} {} : {}",
+                   action,
+                   tree.url,
+                   format_dep_problem(tree, problem),
+                   event="dep_problem",
+                   tree=tree.tree_id,
+                   kind=problem.kind,
+                   path=problem.path)
+  sparse_directories = tree.sparse_checkout_directories()
+  sparse_changed = tree.sparse_checkout_needs_update(sparse_directories)
+  if sparse_changed:
+    reporting.info("{} {} : sparse-checkout: {}",
+                   action,
+                   tree.url,
+                   " ".join(sparse_directories or ["(all)"]),
+                   event="sparse_problem",
+                   tree=tree.tree_id)
+  problem_count = len(problems) + int(sparse_changed)
+  if dry_run:
+    return problem_count
+  if sparse_changed:
+    # Also restores skip-worktree flags (and links), so what remains is
+    # looked up again.
+    tree.apply_sparse_checkout()
+    problems = tree.find_dep_problems()
+  tree.repair_dep_problems(problems)
+  return problem_count
+
+
 def exec(*args):
-  if args:
-    raise UserError("Arguments not expected")
-  repo = Repo.find_from_cwd()
-  tree = repo.tree_from_cwd()
-  tree.checkout()
+  args = create_argument_parser().parse_args(args)
+  repo = Repo.find_from_cwd(read_only=args.dry_run)
+  if args.all:
+    root_trees = list(repo.all_trees())
+  else:
+    root_trees = [repo.tree_from_cwd()]
+
+  fixed_count = 0
+  trees = dependency_closure(root_trees)
+  with reporting.progress("Checking", total=len(trees)) as progress:
+    for tree in trees:
+      fixed_count += fix_tree(tree, args.dry_run)
+      progress.advance()
+
+  if args.dry_run:
+    reporting.info("** {} problems would be fixed", fixed_count)
+  else:
+    reporting.info("** Fixed {} problems", fixed_count)
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
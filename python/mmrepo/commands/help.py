@@ -16,21 +16,53 @@
 
 import importlib
 
+from mmrepo.common import *
+from mmrepo import reporting
+
 HELP_MESSAGE = """Manage a magical monorepo.
 
+Syntax:
+  mmr [global options] <command> [command options]
+
 For more information about any command, run:
   mmr help <command>
 
+Global options:
+  --profile - Print where the command spent its time: a summary of the git
+    processes it ran, by git subcommand and by tree. All events are also
+    written as a Chrome trace (viewable in chrome://tracing or
+    https://ui.perfetto.dev) to .mmrepo/cache/profile.json.
+  --profile-output <file> - Write the profile trace to a file instead.
+    Implies --profile.
+  -v, --verbose - Show more detail: each tree as it is processed and links as
+    they are created. Repeat (-vv) to also show every git command.
+  -q, --quiet - Only show warnings, errors and command output.
+  --log-format json - Write each event as a line of JSON to stdout (for CI
+    logs), including progress updates.
+  --no-progress - Do not show the live progress line (which is only shown when
+    stderr is a terminal).
+  --git-timeout <seconds> - Kill git commands which use the network (clone,
+    fetch and ls-remote) if they take longer, so that a hung remote cannot
+    stall a command forever. By default there is no timeout. Commands which
+    fail transiently are retried (see "mmr help init" for the policy of each
+    host).
+  --max-git-processes <n> - Run at most n git commands at once, across all
+    concurrent jobs. --jobs sets how many trees a command works on at once,
+    and jobs wait for a free slot when they would exceed this limit, so it
+    only has an effect when it is lower than --jobs.
+
 Available commands:
   checkout - Checks out a remote git repository.
+  dup - Creates a light-weight duplicate of a repository
   help - Get help on commands and syntax
   info - Show information about the current repo
   init - Initialize a new repo
+  mirror - Manages a local mirror
 """
 
 def exec(*args):
   if not args:
-    print(HELP_MESSAGE)
+    reporting.output(HELP_MESSAGE)
     return
   for command in args:
     norm_command = command.replace("-", "_")
@@ -38,4 +70,4 @@ def exec(*args):
       m = importlib.import_module("mmrepo.commands." + norm_command)
     except ImportError:
       raise UserError("Unknown command: {}", command)
-    print(m.HELP_MESSAGE)
+    reporting.output(m.HELP_MESSAGE)
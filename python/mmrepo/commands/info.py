@@ -15,6 +15,7 @@
 """Show info about the current mmrepo."""
 
 from mmrepo.repo import *
+from mmrepo import reporting
 
 HELP_MESSAGE = """Displays information about the current magical monorepo."""
 
@@ -23,6 +24,6 @@ def exec(*args):
   if args:
     raise UserError("'info' expects no arguments'")
   r = Repo.find_from_cwd()
-  print("top:", r.path)
-  print("mmrepo:", r.mmrepo_dir)
-  print("universe:", r.universe_dir)
+  reporting.output("top: {}", r.path)
+  reporting.output("mmrepo: {}", r.mmrepo_dir)
+  reporting.output("universe: {}", r.universe_dir)
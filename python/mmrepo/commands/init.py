@@ -16,7 +16,10 @@
 import argparse
 import os
 
+from mmrepo.commands.checkout import add_clone_arguments
+from mmrepo.config import *
 from mmrepo.repo import *
+from mmrepo import reporting
 
 
 def create_argument_parser():
@@ -34,6 +37,13 @@ def create_argument_parser():
       help="Clone from reference git trees under this repository "
       "(via git clone --reference)",
       default=None)
+  parser.add_argument(
+      "--mirror-fetch-interval",
+      type=float,
+      default=None,
+      help="With --local-mirror, seconds within which a mirror tree is not "
+      "fetched again (default {})".format(DEFAULT_MIRROR_FETCH_INTERVAL))
+  add_clone_arguments(parser)
   return parser
 
 
@@ -46,6 +56,36 @@ If the current working directory is also a git tree, the existing
 git tree will be mapped into the repo as the __root__ alias. A subsequent
 "mmr checkout" command can fully initialize its dependencies. Such
 root git trees cannot exist recursively in dependencies.
+
+A local mirror can be shared by several repositories. Clones and fetches of
+each mirror tree are serialized with a lock file, and a tree is not fetched
+again if it was fetched within the mirror fetch interval.
+
+The --filter, --depth and --single-branch options set defaults for how trees
+are cloned (i.e. "--filter=blob:none" for blobless clones). They can be
+overridden per tree (see "mmr help checkout"), and do not apply to clones
+from a local mirror, which share its objects instead.
+
+Clones, fetches and ls-remotes of remote hosts follow a policy, which can be
+set per host in the "remote_policies" setting of .mmrepo/config/trees.json
+(of the local mirror, for trees cloned from one). For example:
+
+  "remote_policies": {
+    "*": {"retries": 4, "timeout": 900},
+    "git.example.com": {"failure_threshold": 10, "reset_after": 120}
+  }
+
+Fields not set for a host are taken from "*", then from the defaults:
+  retries (2) - Times to retry a command which failed transiently (timed
+    out, lost its connection or got an HTTP 429 or 5xx response).
+  backoff (1.0), max_backoff (30.0) - Seconds to wait before the first retry,
+    doubling for each retry, up to the maximum.
+  jitter (0.5) - Fraction of each wait which is randomized.
+  timeout (null) - Seconds after which a command is killed (null for the
+    --git-timeout, see "mmr help").
+  failure_threshold (5) - Consecutive failures after which the host is not
+    contacted (commands fail immediately) for reset_after (60.0) seconds.
+    0 to always contact it.
 """
 
 
@@ -56,17 +96,28 @@ def exec(*args):
   # Initialize local mirror mode
   if args.local_mirror:
     local_mirror_path = args.local_mirror
-    print("Using local mirror at", local_mirror_path)
+    reporting.info("Using local mirror at {}", local_mirror_path)
     os.makedirs(local_mirror_path, exist_ok=True)
     # Configure the mirror.
     mirror_r = Repo.init(from_cwd=local_mirror_path, exact_path=True)
     mirror_trees_config = mirror_r.config.trees
     mirror_trees_config.bare_clone = True
+    if args.mirror_fetch_interval is not None:
+      mirror_trees_config.mirror_fetch_interval = args.mirror_fetch_interval
     mirror_trees_config.save()
     # Configure this repo.
     trees_config = r.config.trees
     trees_config.local_mirror_path = local_mirror_path
 
+  # Configure partial and shallow clones.
+  trees_config = r.config.trees
+  if args.clone_filter is not None:
+    trees_config.clone_filter = args.clone_filter
+  if args.clone_depth is not None:
+    trees_config.clone_depth = args.clone_depth
+  if args.single_branch is not None:
+    trees_config.single_branch = args.single_branch
+
   # Configure reference and shared repos.
   if args.reference:
     trees_config = r.config.trees
@@ -74,8 +125,8 @@ def exec(*args):
     trees_config.save()
 
   # Initialize and check out.
-  print("Initialized magical monorepo at {}".format(r.path))
+  reporting.info("Initialized magical monorepo at {}", r.path)
   if r.git.is_git_repository(r.path):
     root_tree = r.get_root_tree()
-    print("Root repository", root_tree.tree_id)
+    reporting.info("Root repository {}", root_tree.tree_id)
     root_tree.checkout()
@@ -0,0 +1,195 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import collections
+import threading
+import time
+
+from mmrepo.common import *
+from mmrepo.git import *
+from mmrepo.mirror import *
+from mmrepo.parallel import *
+from mmrepo.remote_policy import *
+from mmrepo.repo import *
+from mmrepo import reporting
+
+DEFAULT_JOBS_PER_HOST = 4
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(prog="mirror",
+                                   description="Manages a local mirror",
+                                   add_help=False)
+  parser.add_argument("action",
+                      choices=["sync"],
+                      help="Action to perform on the mirror")
+  parser.add_argument("--mirror",
+                      dest="mirror",
+                      default=None,
+                      help="Path of the local mirror (defaults to the mirror "
+                      "of the current repository, or the current repository "
+                      "if it is a mirror)")
+  parser.add_argument("--if-stale",
+                      dest="if_stale",
+                      action="store_true",
+                      help="Skip trees fetched within the mirror fetch "
+                      "interval")
+  parser.add_argument("--jobs-per-host",
+                      dest="jobs_per_host",
+                      type=positive_int,
+                      default=DEFAULT_JOBS_PER_HOST,
+                      help="Maximum concurrent fetches from one host "
+                      "(default %(default)s)")
+  parser.add_argument("--retries",
+                      dest="retries",
+                      type=non_negative_int,
+                      default=None,
+                      help="Times to retry a fetch which failed transiently, "
+                      "with exponential backoff (default from the remote "
+                      "policy of the host, see \"mmr help init\")")
+  add_jobs_argument(parser)
+  return parser
+
+
+HELP_MESSAGE = create_argument_parser().format_help() + """
+
+Actions:
+  sync: Fetches all trees in the local mirror concurrently, so that later
+    clones from the mirror do not need to. Suitable for running periodically.
+    Trees which are concurrently being fetched by another client are not
+    fetched twice (see "mmr help init").
+
+A summary of the time taken and the bytes of objects received is printed for
+each tree, followed by the requests made to each remote host.
+"""
+
+SyncResult = collections.namedtuple("SyncResult",
+                                    "tree,fetched,seconds,bytes,error")
+
+
+def find_mirror_repo(args) -> Repo:
+  if args.mirror:
+    mirror_repo = Repo.find_existing(args.mirror)
+    if mirror_repo is None:
+      raise UserError("No local mirror at {}", args.mirror)
+    return mirror_repo
+  repo = Repo.find_from_cwd()
+  mirror_repo = repo.local_mirror_repo
+  if mirror_repo is not None:
+    return mirror_repo
+  if repo.config.trees.bare_clone:
+    return repo
+  raise UserError("Repository {} does not use a local mirror", repo.path)
+
+
+class MirrorSyncer:
+  """Fetches mirror trees, limiting concurrency per host.
+
+  Failed fetches are retried by the mirror repository's GitExecutor, with the
+  remote policy of each host.
+  """
+
+  def __init__(self, mirror_repo: Repo, args):
+    super().__init__()
+    if args.retries is not None:
+      mirror_repo.git.override_remote_policy(retries=args.retries)
+    self._manager = MirrorManager(mirror_repo)
+    self._args = args
+    self._host_semaphores = collections.defaultdict(
+        lambda: threading.BoundedSemaphore(args.jobs_per_host))
+    self._host_semaphores_lock = threading.Lock()
+
+  def _host_semaphore(self, host: str) -> threading.BoundedSemaphore:
+    with self._host_semaphores_lock:
+      return self._host_semaphores[host]
+
+  def sync(self, tree) -> SyncResult:
+    start_bytes = objects_size(tree.path_in_repo)
+    start_time = time.monotonic()
+    fetched = False
+    error = None
+    with self._host_semaphore(tree.host):
+      try:
+        fetched = self._manager.update(tree, force=not self._args.if_stale)
+      except UserError as e:
+        error = e.message
+    return SyncResult(tree=tree,
+                      fetched=fetched,
+                      seconds=time.monotonic() - start_time,
+                      bytes=objects_size(tree.path_in_repo) - start_bytes,
+                      error=error)
+
+
+def print_sync_result(result: SyncResult):
+  if result.error is not None:
+    status = "FAILED"
+  elif result.fetched:
+    status = "fetched"
+  else:
+    status = "up to date"
+  reporting.output("  {:>7.2f}s {:>12} bytes  {} : {}",
+                   result.seconds,
+                   result.bytes,
+                   result.tree.url,
+                   status,
+                   event="mirror_sync",
+                   url=result.tree.url,
+                   seconds=result.seconds,
+                   bytes=result.bytes,
+                   status=status)
+
+
+def sync(args):
+  mirror_repo = find_mirror_repo(args)
+  trees = [
+      tree for tree in mirror_repo.all_trees()
+      if isinstance(tree, GitTreeRef) and not tree.is_root_tree
+  ]
+  reporting.info("Syncing {} trees in local mirror {}", len(trees),
+                 mirror_repo.path)
+  syncer = MirrorSyncer(mirror_repo, args)
+  start_time = time.monotonic()
+  with reporting.progress("Syncing", total=len(trees)) as progress:
+
+    def sync_tree(tree):
+      # Bytes fetched are added to the progress as each fetch completes.
+      result = syncer.sync(tree)
+      progress.advance()
+      return result
+
+    with create_executor(args.jobs) as executor:
+      results = list(executor.map(sync_tree, trees))
+
+  reporting.output("** Mirror sync summary:")
+  for result in results:
+    print_sync_result(result)
+  errors = [result for result in results if result.error is not None]
+  reporting.output(
+      "** Synced {} trees ({} fetched, {} failed, {} bytes) in {:.2f}s",
+      len(results), sum(1 for result in results if result.fetched),
+      len(errors), sum(result.bytes for result in results),
+      time.monotonic() - start_time)
+  report_remote_stats()
+  if errors:
+    reporting.error(
+        "!! Error messages:\n{}",
+        "\n".join("   {}".format(result.error) for result in errors))
+    raise UserError("Could not sync {} trees", len(errors))
+
+
+def exec(*args):
+  args = create_argument_parser().parse_args(args)
+  if args.action == "sync":
+    sync(args)
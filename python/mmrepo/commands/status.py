@@ -13,9 +13,14 @@
 # limitations under the License.
 
 import argparse
+import json
+import os
 
 from mmrepo.config import *
+from mmrepo.git import *
+from mmrepo.parallel import *
 from mmrepo.repo import *
+from mmrepo import reporting
 
 
 def create_argument_parser():
@@ -23,30 +28,111 @@ def create_argument_parser():
       prog="status",
       description="Displays status of trees in the repository",
       add_help=False)
+  format_group = parser.add_mutually_exclusive_group()
+  format_group.add_argument("--json",
+                            dest="format",
+                            action="store_const",
+                            const="json",
+                            default="text",
+                            help="Output a JSON array of tree status")
+  format_group.add_argument("--jsonl",
+                            dest="format",
+                            action="store_const",
+                            const="jsonl",
+                            help="Output one JSON object per tree and line")
+  add_jobs_argument(parser)
   return parser
 
 
-HELP_MESSAGE = create_argument_parser().format_help()
+HELP_MESSAGE = create_argument_parser().format_help() + """
 
+Status is collected for all trees concurrently and output in a stable order.
 
-def print_git_status(args, tree):
-  url = tree.url
-  message = tree.repo.git.show(tree.path_in_repo,
-                               git_object="HEAD",
-                               option_args=[
-                                   "--format=%H : {} : %s (%cd)".format(
-                                       url),
-                                   "--date=relative",
-                                   "--no-patch",
-                               ])
-  print(message)
+The JSON forms include, for each tree: tree_id, url, path, head (commit),
+subject, commit_time, branch (null if detached), upstream, ahead, behind,
+dirty (tracked changes), dep_problems (dependency links which are missing or
+stale and submodule paths which are not skip-worktree) and error.
+"""
+
+
+def format_dep_problem(tree, problem):
+  path = problem.path
+  if os.path.isabs(path):
+    path = os.path.relpath(path, tree.path_in_repo)
+  return "{}: {}".format(problem.kind, path)
+
+
+def collect_dep_problems(tree):
+  """Checks that dependency links and skip-worktree flags are in place."""
+  return [
+      format_dep_problem(tree, problem)
+      for problem in tree.find_dep_problems()
+  ]
+
+
+def collect_git_status(args, tree):
+  """Collects the status of a tree as a dict."""
+  status = {
+      "tree_id": tree.tree_id,
+      "url": tree.url,
+      "path": tree.path_in_repo,
+      "error": None,
+  }
+  if find_git_dirs(tree.path_in_repo) is None:
+    status["error"] = "not checked out"
+    return status
+  try:
+    commit = tree.repo.git.read_commit(tree.path_in_repo, "HEAD")
+    status["head"] = commit.commit if commit else None
+    status["subject"] = commit.subject if commit else None
+    status["commit_time"] = commit.commit_time if commit else None
+    if args.format != "text":
+      git_status = tree.repo.git.status(tree.path_in_repo)
+      status.update(branch=git_status.branch,
+                    upstream=git_status.upstream,
+                    ahead=git_status.ahead,
+                    behind=git_status.behind,
+                    dirty=git_status.dirty,
+                    dep_problems=collect_dep_problems(tree))
+  except UserError as e:
+    status["error"] = e.message
+  return status
+
+
+def print_git_status(args, status):
+  if args.format == "jsonl":
+    reporting.output(json.dumps(status, sort_keys=True))
+    return
+  if status["error"] is not None:
+    reporting.output("!! {} : {}", status["url"], status["error"])
+  elif status["head"] is None:
+    reporting.output("(no commit) : {}", status["url"])
+  else:
+    # Same as:
+    #   git show HEAD --date=relative --format="%H : url : %s (%cd)"
+    reporting.output("{} : {} : {} ({})", status["head"], status["url"],
+                     status["subject"],
+                     format_relative_time(status["commit_time"]))
 
 
 def exec(*args):
   args = create_argument_parser().parse_args(args)
-  repo = Repo.find_from_cwd()
+  repo = Repo.find_from_cwd(read_only=True)
+  git_trees = []
   for tree in repo.all_trees():
     if isinstance(tree, GitTreeRef):
-      print_git_status(args, tree)
+      git_trees.append(tree)
     else:
-      print("UNKNOWN TREE TYPE:", tree.tree_id)
+      reporting.warning("UNKNOWN TREE TYPE: {}", tree.tree_id)
+
+  all_status = []
+  with create_executor(args.jobs) as executor:
+    # Results are streamed in order as they become available.
+    for status in executor.map(lambda tree: collect_git_status(args, tree),
+                               git_trees):
+      if args.format == "json":
+        all_status.append(status)
+      else:
+        print_git_status(args, status)
+  if args.format == "json":
+    reporting.output(json.dumps(all_status, indent=2, sort_keys=True))
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from mmrepo.repo import *
+from mmrepo import reporting
 
 HELP_MESSAGE = """Prints the top directory of the current repo."""
 
@@ -21,4 +22,4 @@ def exec(*args):
   if args:
     raise UserError("'top' expects no arguments'")
   r = Repo.find_from_cwd()
-  print(r.path)
+  reporting.output(r.path)
@@ -15,7 +15,9 @@
 import argparse
 
 from mmrepo.config import *
+from mmrepo.parallel import *
 from mmrepo.repo import *
+from mmrepo import reporting
 from mmrepo.version_map import *
 
 
@@ -32,6 +34,30 @@ def create_argument_parser():
                       dest="no_fetch",
                       action="store_true",
                       help="Do not fetch prior to checking out")
+  parser.add_argument("--fetch-exact",
+                      dest="fetch_exact",
+                      action="store_true",
+                      help="Fetch only the needed commits if the remote "
+                      "allows it")
+  parser.add_argument("--refresh",
+                      dest="refresh",
+                      action="store_true",
+                      help="Query remotes even if recently cached")
+  resolve_group = parser.add_mutually_exclusive_group()
+  resolve_group.add_argument(
+      "--prefer-local",
+      dest="resolve_mode",
+      action="store_const",
+      const=RESOLVE_PREFER_LOCAL,
+      default=RESOLVE_REMOTE,
+      help="Resolve symbolic versions against local clones when possible")
+  resolve_group.add_argument(
+      "--offline",
+      dest="resolve_mode",
+      action="store_const",
+      const=RESOLVE_OFFLINE,
+      help="Resolve symbolic versions only against local clones")
+  add_jobs_argument(parser)
   parser.add_argument("specs", nargs="*", help="Version specs to apply")
   return parser
 
@@ -52,22 +78,32 @@ of the form:
 For git repositories, the symbolic_version is a ref known to the remote (i.e.
 "HEAD", "refs/heads/master", etc). The resolved_version is a commit hash. If
 both a symbolic and resolved version are omitted, then "HEAD" is assumed.
+Remote refs are cached under .mmrepo/cache for a few minutes; use --refresh
+to always query the remotes. With --prefer-local, symbolic versions are
+resolved against the remote-tracking refs of local clones (as of their last
+fetch), only querying remotes for refs that are missing. With --offline,
+remotes are never queried.
 
 When processing each item in the list, the referenced tree will checkout the
 given version if the tree has not yet been encountered. Then all dependencies
 of the tree are added to the list of version updates. In this way, versions
 are set in a first-come fashion and proceed depthwise. Specific, deep versions
 can be pinned by listing or encountering them first in the graph of deps.
+All trees at the same depth are fetched concurrently (bounded by --jobs).
+Trees are only fetched if the needed commit is not already present locally.
 """
 
 
 def exec(*args):
   args = create_argument_parser().parse_args(args)
-  repo = Repo.find_from_cwd()
+  repo = Repo.find_from_cwd(read_only=not args.set)
 
   version_map = VersionMap.parse(*args.specs)
-  version_map = version_map.resolve(repo)
-  print(version_map)
+  version_map = version_map.resolve(repo,
+                                    jobs=args.jobs,
+                                    refresh=args.refresh,
+                                    mode=args.resolve_mode)
+  reporting.output(str(version_map))
 
   if not args.set: return
 
@@ -76,20 +112,44 @@ def exec(*args):
   for comp in version_map.components:
     pending_tree_specs.append((comp.tree, comp.resolved_version))
 
-  # Process the worklist.
+  # Process the worklist a level at a time: fetch the level concurrently,
+  # then check out in order.
   processed_trees = set()
-  while pending_tree_specs:
-    current_tree_specs = list(pending_tree_specs)
-    pending_tree_specs.clear()
-    for tree, spec in current_tree_specs:
-      if tree in processed_trees:
-        continue
-      processed_trees.add(tree)
-      # Update this tree.
-      print(":: Update {} to {}".format(tree, spec))
-      tree.update_version(spec, fetch=not args.no_fetch)
-
-      # Add deps to worklist.
-      for dep_provider in tree.dep_providers:
-        for dep_tree, dep_version in dep_provider.lookup_versions():
-          pending_tree_specs.append((dep_tree, dep_version))
+  fetch_count = 0
+  with create_executor(args.jobs) as executor, reporting.progress(
+      "Updating") as progress:
+    while pending_tree_specs:
+      current_tree_specs = list()
+      for tree, spec in pending_tree_specs:
+        if tree in processed_trees:
+          continue
+        processed_trees.add(tree)
+        current_tree_specs.append((tree, spec))
+      pending_tree_specs.clear()
+      progress.add_total(len(current_tree_specs))
+
+      if not args.no_fetch:
+        futures = [
+            executor.submit(tree.fetch_version, spec, exact=args.fetch_exact)
+            for tree, spec in current_tree_specs
+        ]
+        for future in futures:
+          if future.result():
+            fetch_count += 1
+
+      for tree, spec in current_tree_specs:
+        # Update this tree.
+        reporting.detail(":: Update {} to {}",
+                         tree,
+                         spec,
+                         event="tree_update",
+                         tree=tree.tree_id,
+                         version=spec)
+        tree.update_version(spec, fetch=False)
+        progress.advance()
+
+        # Add deps to worklist.
+        pending_tree_specs.extend(tree.lookup_dep_versions())
+
+  reporting.info("** Updated {} trees ({} fetched)", len(processed_trees),
+                 fetch_count)
@@ -16,7 +16,10 @@
 
 
 __all__ = [
+  "CircuitOpenError",
+  "GitCommandError",
   "GitError",
+  "GitTimeoutError",
   "UserError",
 ]
 
@@ -41,3 +44,26 @@ class GitError(Exception):
   @property
   def message(self) -> str:
     return self.args[0]
+
+
+class GitCommandError(UserError):
+  """A git command which exited with an error status.
+
+  Attributes:
+    status: The exit status of the command.
+    stderr: What the command wrote to stderr.
+  """
+
+  def __init__(self, message: str, *args, status: int = None,
+               stderr: str = "", **kwargs):
+    super().__init__(message, *args, **kwargs)
+    self.status = status
+    self.stderr = stderr
+
+
+class GitTimeoutError(UserError):
+  """A git command which did not complete within its timeout."""
+
+
+class CircuitOpenError(UserError):
+  """A request to a remote host which was not made, as it keeps failing."""
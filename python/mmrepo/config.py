@@ -15,21 +15,30 @@
 """Manages configuration settings."""
 
 import itertools
-from typing import Sequence
+from typing import Optional, Sequence
 
 from collections import namedtuple
+import copy
 import json
 import os
+import tempfile
+import threading
+
+from mmrepo.remote_policy import *
 
 __all__ = [
+    "flush_configs",
     "read_json_file",
     "write_json_file",
     "DepRecord",
+    "DEFAULT_MIRROR_FETCH_INTERVAL",
     "RepoConfig",
     "RepoTreesConfig",
     "GitConfigAnnotation",
 ]
 
+DEFAULT_MIRROR_FETCH_INTERVAL = 60
+
 
 class RepoConfig:
   """Configuration for the repository."""
@@ -38,7 +47,7 @@ class RepoConfig:
     super().__init__()
     self._repo_dir = repo_dir
     self._config_dir = os.path.join(self._repo_dir, "config")
-    self._trees_config = RepoTreesConfig(
+    self._trees_config = RepoTreesConfig.for_file(
         os.path.join(self._config_dir, "trees.json"))
 
   @property
@@ -47,18 +56,101 @@ class RepoConfig:
 
 
 class RepoTreesConfig:
-  """Configuration for the known trees."""
+  """Configuration for the known trees.
+
+  Mutations are accumulated in memory and only written when save() is called
+  (as an explicit checkpoint) or when all configs are flushed at the end of a
+  command. Writes only happen if something changed, and replace the file
+  atomically.
+
+  Instances are shared per config file (see for_file()) so that all Repo
+  instances in a process see the same state.
+
+  >>> import shutil, tempfile
+  >>> config_dir = tempfile.mkdtemp()
+  >>> config_file = os.path.join(config_dir, "trees.json")
+  >>> config = RepoTreesConfig(config_file)
+  >>> config.bare_clone = True
+  >>> config.set_tree_dict("git/a", {"t": "git", "url": "a"})
+  >>> config.dirty, os.path.exists(config_file)
+  (True, False)
+  >>> config.save()
+  >>> config.dirty, read_json_file(config_file)["bare_clone"]
+  (False, True)
+
+  Unchanged settings do not cause writes:
+
+  >>> inode = os.stat(config_file).st_ino
+  >>> config.bare_clone = True
+  >>> config.set_tree_dict("git/a", {"t": "git", "url": "a"})
+  >>> config.dirty
+  False
+  >>> config.save()
+  >>> os.stat(config_file).st_ino == inode
+  True
+  >>> RepoTreesConfig(config_file).tree_dicts
+  {'git/a': {'t': 'git', 'url': 'a'}}
+  >>> shutil.rmtree(config_dir)
+  """
+  _instances = {}
+  _instances_lock = threading.Lock()
 
   def __init__(self, config_file: str):
     super().__init__()
     self._config_file = config_file
+    self._dirty = False
+    self.lock = threading.RLock()
     if os.path.isfile(self._config_file):
       self._contents = read_json_file(self._config_file)
     else:
       self._contents = {}
 
+  @classmethod
+  def for_file(cls, config_file: str) -> "RepoTreesConfig":
+    """Gets the shared instance for a config file."""
+    key = os.path.realpath(config_file)
+    with cls._instances_lock:
+      instance = cls._instances.get(key)
+      if instance is None:
+        instance = cls(config_file)
+        cls._instances[key] = instance
+      return instance
+
+  @classmethod
+  def flush_all(cls):
+    """Saves all shared instances that have pending changes."""
+    with cls._instances_lock:
+      instances = list(cls._instances.values())
+    for instance in instances:
+      instance.save()
+
+  @property
+  def dirty(self) -> bool:
+    return self._dirty
+
+  def mark_dirty(self):
+    """Marks that the contents have changed and need to be saved."""
+    self._dirty = True
+
   def save(self):
-    write_json_file(self._config_file, self._contents)
+    """Writes the config if it has pending changes."""
+    with self.lock:
+      if not self._dirty:
+        return
+      write_json_file(self._config_file, self._contents)
+      self._dirty = False
+
+  def copy_from(self, other: "RepoTreesConfig"):
+    """Replaces all settings and trees with those of another config."""
+    with self.lock, other.lock:
+      self._contents = copy.deepcopy(other._contents)
+      self.mark_dirty()
+
+  def _set(self, key, value):
+    with self.lock:
+      if self._contents.get(key) != value:
+        self._contents[key] = value
+        self.mark_dirty()
 
   @property
   def reference_repo(self):
@@ -66,7 +158,7 @@ class RepoTreesConfig:
 
   @reference_repo.setter
   def reference_repo(self, reference_repo):
-    self._contents["reference_repo"] = reference_repo
+    self._set("reference_repo", reference_repo)
 
   @property
   def bare_clone(self):
@@ -74,7 +166,7 @@ class RepoTreesConfig:
 
   @bare_clone.setter
   def bare_clone(self, bare_clone):
-    self._contents["bare_clone"] = bool(bare_clone)
+    self._set("bare_clone", bool(bare_clone))
 
   @property
   def local_mirror_path(self):
@@ -82,7 +174,74 @@ class RepoTreesConfig:
 
   @local_mirror_path.setter
   def local_mirror_path(self, local_mirror_path):
-    self._contents["local_mirror_path"] = local_mirror_path
+    self._set("local_mirror_path", local_mirror_path)
+
+  @property
+  def clone_filter(self):
+    """Default partial clone filter (i.e. "blob:none"), or None."""
+    return self._contents.get("clone_filter")
+
+  @clone_filter.setter
+  def clone_filter(self, clone_filter):
+    self._set("clone_filter", clone_filter)
+
+  @property
+  def clone_depth(self):
+    """Default shallow clone depth, or None for full history."""
+    return self._contents.get("clone_depth")
+
+  @clone_depth.setter
+  def clone_depth(self, clone_depth):
+    self._set("clone_depth", clone_depth)
+
+  @property
+  def single_branch(self):
+    """Whether to clone only the remote's default branch by default."""
+    return self._contents.get("single_branch") or False
+
+  @single_branch.setter
+  def single_branch(self, single_branch):
+    self._set("single_branch", bool(single_branch))
+
+  @property
+  def mirror_fetch_interval(self) -> float:
+    """Seconds within which a local mirror tree is not fetched again."""
+    interval = self._contents.get("mirror_fetch_interval")
+    if interval is None:
+      return DEFAULT_MIRROR_FETCH_INTERVAL
+    return interval
+
+  @mirror_fetch_interval.setter
+  def mirror_fetch_interval(self, mirror_fetch_interval):
+    self._set("mirror_fetch_interval", mirror_fetch_interval)
+
+  @property
+  def url_rewrites(self):
+    """URL rewrite rules used to identify trees (see apply_url_rewrites).
+
+    A dict of base -> list of prefixes, like git's url.<base>.insteadOf.
+    """
+    return self._contents.get("url_rewrites") or {}
+
+  @url_rewrites.setter
+  def url_rewrites(self, url_rewrites):
+    self._set("url_rewrites", url_rewrites)
+
+  @property
+  def remote_policies(self):
+    """Retry, timeout and circuit breaker settings of remote hosts.
+
+    A dict of host (or "*" for all hosts) -> dict of RemotePolicy fields.
+    """
+    return self._contents.get("remote_policies") or {}
+
+  @remote_policies.setter
+  def remote_policies(self, remote_policies):
+    self._set("remote_policies", remote_policies)
+
+  def remote_policy(self, host: str) -> RemotePolicy:
+    """Gets the RemotePolicy of a remote host."""
+    return resolve_remote_policy(self.remote_policies, host)
 
   @property
   def tree_dicts(self):
@@ -110,8 +269,11 @@ class RepoTreesConfig:
     aliases = self.aliases
     for i in itertools.count(0):
       existing_tree_id = aliases.get(alias)
-      if existing_tree_id is None or existing_tree_id == tree_id:
+      if existing_tree_id == tree_id:
+        return alias
+      if existing_tree_id is None:
         aliases[alias] = tree_id
+        self.mark_dirty()
         return alias
       alias = requested_alias + "-" + str(i)
 
@@ -119,6 +281,52 @@ class RepoTreesConfig:
     td = self.tree_dicts
     return td.get(tree_id)
 
+  def rename_trees(self, renames: dict):
+    """Changes tree ids, updating aliases to match.
+
+    If a tree is renamed to an existing id, the existing tree is kept.
+
+    >>> import shutil
+    >>> config_dir = tempfile.mkdtemp()
+    >>> config = RepoTreesConfig(os.path.join(config_dir, "trees.json"))
+    >>> config.set_tree_dict("git/a", {"t": "git", "url": "a"})
+    >>> _ = config.add_alias("a", "git/a")
+    >>> config.save()
+    >>> config.rename_trees({})
+    >>> config.rename_trees({"git/b": "git/c"})
+    >>> config.dirty
+    False
+    >>> config.rename_trees({"git/a": "git/x/a"})
+    >>> config.dirty, config.tree_dicts, config.aliases
+    (True, {'git/x/a': {'t': 'git', 'url': 'a'}}, {'a': 'git/x/a'})
+    >>> shutil.rmtree(config_dir)
+    """
+    with self.lock:
+      changed = False
+      td = self.tree_dicts
+      for old_tree_id, new_tree_id in renames.items():
+        if old_tree_id == new_tree_id or old_tree_id not in td:
+          continue
+        d = td.pop(old_tree_id)
+        td.setdefault(new_tree_id, d)
+        changed = True
+      aliases = self.aliases
+      for alias, tree_id in aliases.items():
+        new_tree_id = renames.get(tree_id, tree_id)
+        if new_tree_id != tree_id:
+          aliases[alias] = new_tree_id
+          changed = True
+      if changed:
+        self.mark_dirty()
+
+  def set_tree_dict(self, tree_id, d: dict):
+    """Adds or replaces the dict for a tree."""
+    with self.lock:
+      td = self.tree_dicts
+      if td.get(tree_id) != d:
+        td[tree_id] = d
+        self.mark_dirty()
+
 
 class GitConfigAnnotation(namedtuple("GitConfigAnnotation", "tree_id")):
   """An annotation that gets stored in .git directories linking to the mmr."""
@@ -134,13 +342,26 @@ class GitConfigAnnotation(namedtuple("GitConfigAnnotation", "tree_id")):
     d = read_json_file(cls._get_config_file(git_root_path))
     return cls(tree_id=d["tree_id"])
 
+  @classmethod
+  def find_from_git_root(cls,
+                         git_root_path) -> Optional["GitConfigAnnotation"]:
+    """Gets the annotation of a git root, or None if it has none."""
+    try:
+      return cls.from_git_root(git_root_path)
+    except (OSError, ValueError, KeyError):
+      return None
+
   def save_to_git_root(self, git_root_path):
     write_json_file(self._get_config_file(git_root_path),
                     {"tree_id": self.tree_id})
 
 
-class DepRecord(namedtuple("DepRecord", "paths,version,url")):
-  """Represents a dependency record."""
+class DepRecord(namedtuple("DepRecord", "paths,version,url,sparse")):
+  """Represents a dependency record.
+
+  The optional "sparse" list of directories limits which parts of the
+  dependency need to be checked out (via cone mode sparse-checkout).
+  """
 
   @staticmethod
   def read_from_file(deps_file: str) -> Sequence["DepRecord"]:
@@ -155,7 +376,8 @@ class DepRecord(namedtuple("DepRecord", "paths,version,url")):
       results.append(
           DepRecord(paths=[dep_record["path"]],
                     version=dep_record["version"],
-                    url=dep_record["url"]))
+                    url=dep_record["url"],
+                    sparse=dep_record.get("sparse") or []))
     return results
 
 
@@ -165,6 +387,55 @@ def read_json_file(path):
 
 
 def write_json_file(path, contents):
-  os.makedirs(os.path.dirname(path), exist_ok=True)
-  with open(path, "wt") as f:
-    json.dump(contents, f, indent=2, sort_keys=True)
+  """Writes a JSON file, atomically replacing any existing file.
+
+  >>> import shutil
+  >>> json_dir = tempfile.mkdtemp()
+  >>> path = os.path.join(json_dir, "trees.json")
+  >>> write_json_file(path, {"a": 1})
+  >>> os.chmod(path, 0o664)
+  >>> write_json_file(path, {"a": 2})
+  >>> read_json_file(path), oct(os.stat(path).st_mode & 0o777)
+  ({'a': 2}, '0o664')
+
+  A failed write leaves the file as it was (and no temporary files):
+
+  >>> write_json_file(path, {"a": object()})
+  Traceback (most recent call last):
+  ...
+  TypeError: Object of type object is not JSON serializable
+  >>> read_json_file(path), os.listdir(json_dir)
+  ({'a': 2}, ['trees.json'])
+  >>> shutil.rmtree(json_dir)
+  """
+  dir_name = os.path.dirname(path)
+  os.makedirs(dir_name, exist_ok=True)
+  fd, temp_path = tempfile.mkstemp(dir=dir_name,
+                                   prefix=".{}.".format(os.path.basename(path)),
+                                   suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wt") as f:
+      json.dump(contents, f, indent=2, sort_keys=True)
+      f.flush()
+      os.fsync(f.fileno())
+    # mkstemp creates the file private to the user: preserve the mode of the
+    # file being replaced, since configs (i.e. of a mirror) can be shared.
+    try:
+      mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+      mode = 0o644
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, path)
+  except BaseException:
+    os.unlink(temp_path)
+    raise
+
+
+def flush_configs():
+  """Saves all pending config changes (called at the end of a command)."""
+  RepoTreesConfig.flush_all()
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -50,6 +50,13 @@ def make_relative_link(src, dst, relative_to, target_is_directory=False):
   os.symlink(link_accum, dst, target_is_directory=target_is_directory)
 
 
+def is_link_to(link_path, target_path) -> bool:
+  """Whether link_path is a symlink which resolves to target_path."""
+  if not os.path.islink(link_path):
+    return False
+  return is_same_path(link_path, target_path)
+
+
 def is_same_path(path1, path2) -> bool:
   path1 = Path(path1).resolve()
   path2 = Path(path2).resolve()
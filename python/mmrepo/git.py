@@ -13,31 +13,115 @@
 # limitations under the License.
 """Git helpers."""
 
+import atexit
 import collections
+import contextlib
+import hashlib
 import os
 import re
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import urllib.parse
 
 from mmrepo.common import *
+from mmrepo import profiling
+from mmrepo import reporting
+from mmrepo.remote_policy import *
 
 SubmoduleInfo = collections.namedtuple("SubmoduleInfo", "url,path")
+GitStatus = collections.namedtuple(
+    "GitStatus", "commit,branch,upstream,ahead,behind,dirty")
+CommitInfo = collections.namedtuple(
+    "CommitInfo", "commit,tree,parents,author,author_time,committer,"
+    "commit_time,subject")
 
-PRINT_ALL = False
+# Full SHA-1 or SHA-256 commit ids.
+COMMIT_ID_PAT = re.compile(r"^([0-9a-f]{40}|[0-9a-f]{64})$")
 
 __all__ = [
+    "CommitInfo",
     "GitExecutor",
     "GitOrigin",
+    "GitStatus",
+    "apply_url_rewrites",
+    "cancel_git_processes",
+    "canonicalize_git_url",
+    "configure_git_processes",
+    "find_git_dirs",
+    "format_relative_time",
+    "is_commit_id",
+    "is_skip_worktree_tag",
+    "objects_size",
+    "parse_commit",
+    "parse_git_config",
+    "read_head_commit",
+    "read_local_refs",
 ]
 
+# Timeout (in seconds) of git commands which use the network, or None.
+_network_timeout = None
+# Limits the number of concurrent git commands (None if unlimited).
+_process_slots = None
+# Git commands which are running, so that they can be cancelled.
+_running_processes = set()
+_running_processes_lock = threading.Lock()
+# Set when git commands are cancelled (which also interrupts retry waits).
+_cancelled = threading.Event()
+
+# Parsed .gitmodules contents, keyed by a hash of the file contents.
+_gitmodules_cache = dict()
+
+# Escape sequences allowed in git-config values.
+_CONFIG_VALUE_ESCAPES = {
+    "t": "\t",
+    "b": "\b",
+    "n": "\n",
+    '"': '"',
+    "\\": "\\",
+}
+
+# How git cat-file fails when an object of a partial clone is only available
+# from its promisor remote (and lazy fetches are disabled).
+_PROMISOR_FETCH_ERROR = "from promisor remote"
+
 
 class GitExecutor:
   """Wraps access to running git commands."""
 
+  def __init__(self, remote_policy=None):
+    """Creates an executor.
+
+    Args:
+      remote_policy: Function of host -> RemotePolicy, used for git commands
+        which use the network (see remote_policy). If None, all hosts have
+        DEFAULT_REMOTE_POLICY.
+    """
+    super().__init__()
+    self._remote_policy = remote_policy
+    self._remote_policy_overrides = {}
+
+  def remote_policy(self, host: str) -> RemotePolicy:
+    """Gets the RemotePolicy of a remote host."""
+    policy = (DEFAULT_REMOTE_POLICY
+              if self._remote_policy is None else self._remote_policy(host))
+    return policy._replace(**self._remote_policy_overrides)
+
+  def override_remote_policy(self, **fields):
+    """Overrides RemotePolicy fields for all hosts (i.e. from flags)."""
+    self._remote_policy_overrides.update(fields)
+
   def is_git_repository(self, path):
-    """Returns whether the given path appears to be a git repo."""
-    if not os.path.isfile(os.path.join(path, ".git", "HEAD")):
+    """Returns whether the given path appears to be a git repo.
+
+    Linked worktrees (which have a ".git" file) are git repos.
+    """
+    if (not os.path.lexists(os.path.join(path, ".git")) or
+        find_git_dirs(path) is None):
       return False
     self.find_git_toplevel(cwd=path)  # For sanity
     return True
@@ -49,87 +133,401 @@ class GitExecutor:
                         capture_output=True,
                         silent=True).strip().decode("UTF-8")
 
-  def clone(self, repository, directory, clone_args=()):
-    """Clones the given repository into a directory."""
+  def clone(self, repository, directory, clone_args=(), timeout=None):
+    """Clones the given repository into a directory.
+
+    Remote repositories are cloned with the policy of their host (see
+    _remote_request).
+    """
     if os.path.exists(directory):
       raise GitError("Cannot clone into {} (directory entry exists)", directory)
-    return self.execute(["git", "clone", repository, directory] +
-                        list(clone_args),
-                        cwd=os.getcwd())
 
-  def fetch(self, repository):
-    """Fetches from a repository."""
-    self.execute(["git", "fetch"], cwd=repository)
+    def request(timeout):
+      try:
+        return self.execute(["git", "clone", repository, directory] +
+                            list(clone_args),
+                            cwd=os.getcwd(),
+                            timeout=timeout)
+      except BaseException:
+        # A killed (or interrupted) clone cannot clean up after itself, and
+        # a retry needs the directory to not exist.
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    result = self._remote_request(repository, "Clone of " + repository,
+                                  timeout, request)
+    if reporting.is_showing_bytes():
+      reporting.record_bytes(objects_size(directory))
+    return result
+
+  def worktree_add(self, repository, directory, commit):
+    """Adds a linked worktree of a repository, detached at a commit."""
+    if os.path.exists(directory):
+      raise GitError("Cannot add worktree at {} (directory entry exists)",
+                     directory)
+    self.execute(
+        ["git", "worktree", "add", "--quiet", "--detach", directory, commit],
+        cwd=repository)
+
+  def fetch(self,
+            repository,
+            remote=None,
+            refspecs=(),
+            fetch_args=(),
+            timeout=None):
+    """Fetches from a repository.
+
+    Submodules are not recursed into: their paths are managed by mmr (and
+    are symlinks, which git refuses to fetch through). Remote repositories are
+    fetched from with the policy of their host (see _remote_request).
+    """
+    args = ["git", "fetch", "--no-recurse-submodules"]
+    args.extend(fetch_args)
+    if remote is not None:
+      args.append(remote)
+      args.extend(refspecs)
+    remote_url = self._remote_url(repository, remote)
+    # Measuring walks the object store, so is only done if it is shown.
+    measure_bytes = reporting.is_showing_bytes()
+    if measure_bytes:
+      start_size = objects_size(repository)
+    self._remote_request(
+        remote_url, "Fetch of {}".format(remote_url or repository), timeout,
+        lambda timeout: self.execute(args, cwd=repository, timeout=timeout))
+    if measure_bytes:
+      reporting.record_bytes(objects_size(repository) - start_size)
+
+  def track_remote_branch(self, repository, branch, remote="origin"):
+    """Adds a branch to those fetched from a remote, if it is not included.
+
+    Only single branch clones need this. Branches are only checked out by
+    name (creating a local branch) if they are fetched from a remote.
+    """
+    git_dirs = find_git_dirs(repository)
+    if git_dirs is None:
+      raise GitError("Not a git repository: {}", repository)
+    config_file = os.path.join(git_dirs[1], "config")
+    with open(config_file, "rt") as f:
+      config = parse_git_config(f.read(), config_file)
+    fetch_key = "remote.{}.fetch".format(remote)
+    for key, refspec in config:
+      if key != fetch_key or refspec is None:
+        continue
+      source = refspec.lstrip("+").split(":")[0]
+      if source in ("refs/heads/*", "refs/heads/" + branch):
+        return
+    self.execute(["git", "remote", "set-branches", "--add", remote, branch],
+                 cwd=repository)
+
+  def is_shallow(self, repository) -> bool:
+    """Returns whether a repository is a shallow clone."""
+    git_dirs = find_git_dirs(repository)
+    return git_dirs is not None and os.path.isfile(
+        os.path.join(git_dirs[1], "shallow"))
+
+  def missing_objects(self, repository, objects):
+    """Finds which of the given commits do not exist in the repository.
+
+    Objects are checked with the repository's long-lived
+    'git cat-file --batch-check' process. In partial clones, objects which
+    were left out are reported as missing (they are not fetched):
+
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> env.git(env.remote_path("x"), "config", "uploadpack.allowFilter", "1")
+    ''
+    >>> partial = os.path.join(env.path, "partial")
+    >>> _ = env.git(env.path, "clone", "--quiet", "--filter=blob:none",
+    ...             "--no-checkout", x, partial)
+    >>> pack_dir = os.path.join(partial, ".git", "objects", "pack")
+    >>> packs = sorted(os.listdir(pack_dir))
+    >>> blob = env.git(partial, "rev-parse", "HEAD:README")
+    >>> git = GitExecutor()
+    >>> git.rev_parse(partial, blob) is None
+    True
+    >>> sorted(git.missing_objects(partial, [env.head(x), "0" * 40]))
+    ['0000000000000000000000000000000000000000']
+    >>> sorted(os.listdir(pack_dir)) == packs
+    True
+    >>> _cat_file_pool.close()
+    >>> env.close()
+
+    Returns:
+      Set of the objects which are missing.
+    """
+    return set(o for o in objects
+               if self.rev_parse(repository, o + "^{commit}") is None)
+
+  def rev_parse(self, repository, rev):
+    """Resolves a revision to an object id.
+
+    Uses the repository's long-lived 'git cat-file --batch-check' process.
+
+    Returns:
+      The object id or None if the revision does not exist.
+    """
+    info = _cat_file_pool.get(repository, "--batch-check").query(rev)
+    return info[0] if info else None
+
+  def cat_file(self, repository, rev):
+    """Reads an object.
+
+    Uses the repository's long-lived 'git cat-file --batch' process.
+
+    Returns:
+      Tuple of (object_id, object_type, contents) or None if the revision does
+      not exist.
+    """
+    return _cat_file_pool.get(repository, "--batch").query(rev)
+
+  def read_commit(self, repository, rev="HEAD"):
+    """Reads and parses a commit.
+
+    Returns:
+      A CommitInfo or None if the commit does not exist.
+    """
+    info = self.cat_file(repository, rev + "^{commit}")
+    if info is None:
+      return None
+    return parse_commit(info[0], info[2])
+
+  def status(self, repository) -> GitStatus:
+    """Gets the branch and working tree status of a repository.
+
+    Untracked files and submodules are ignored (mmr places symlinks in the
+    working tree which would otherwise show up).
+
+    Returns:
+      A GitStatus. The branch is None if detached and upstream, ahead and
+      behind are None if there is no upstream.
+    """
+    output = self.execute([
+        "git", "status", "--porcelain=v2", "--branch", "-z",
+        "--untracked-files=no", "--ignore-submodules=all"
+    ],
+                          cwd=repository,
+                          capture_output=True,
+                          silent=True).decode("UTF-8")
+    fields = dict(commit=None,
+                  branch=None,
+                  upstream=None,
+                  ahead=None,
+                  behind=None,
+                  dirty=False)
+    for entry in output.split("\0"):
+      if not entry:
+        continue
+      if not entry.startswith("# "):
+        fields["dirty"] = True
+        continue
+      key, _, value = entry[2:].partition(" ")
+      if key == "branch.oid" and value != "(initial)":
+        fields["commit"] = value
+      elif key == "branch.head" and value != "(detached)":
+        fields["branch"] = value
+      elif key == "branch.upstream":
+        fields["upstream"] = value
+      elif key == "branch.ab":
+        ahead, behind = value.split(" ")
+        fields["ahead"] = int(ahead)
+        fields["behind"] = -int(behind)
+    return GitStatus(**fields)
+
+  def close(self):
+    """Stops any long-lived git processes."""
+    _cat_file_pool.close()
+
+  def config_get(self, repository, name):
+    """Gets a git config value of a repository (or None if not set)."""
+    try:
+      return self.execute(["git", "config", "--get", name],
+                          cwd=repository,
+                          capture_output=True,
+                          silent=True,
+                          stderr=subprocess.DEVNULL).strip().decode("UTF-8")
+    except UserError:
+      return None
+
+  def is_sparse_checkout(self, repository) -> bool:
+    """Returns whether sparse-checkout is enabled (without running git)."""
+    git_dirs = find_git_dirs(repository)
+    if git_dirs is None:
+      return False
+    git_dir, common_dir = git_dirs
+    enabled = False
+    for config_file in (os.path.join(common_dir, "config"),
+                        os.path.join(git_dir, "config.worktree")):
+      if not os.path.isfile(config_file):
+        continue
+      with open(config_file, "rt") as f:
+        entries = parse_git_config(f.read(), config_file)
+      for key, value in entries:
+        if key == "core.sparsecheckout":
+          # Variables without a value are true.
+          enabled = value is None or value.lower() in ("true", "yes", "on",
+                                                       "1")
+    return enabled
+
+  def sparse_checkout_list(self, repository):
+    """Gets the sparse-checkout directories (or None if not sparse)."""
+    if not self.is_sparse_checkout(repository):
+      return None
+    output = self.execute(["git", "sparse-checkout", "list"],
+                          cwd=repository,
+                          capture_output=True,
+                          silent=True).decode("UTF-8")
+    return output.splitlines()
+
+  def sparse_checkout_set(self, repository, directories):
+    """Limits the working tree to directories (with cone mode).
+
+    Git is told to expect files outside of the patterns, since otherwise it
+    clears the skip-worktree bit of any that exist (like the symlinks that
+    replace submodules).
+    """
+    self.execute(
+        ["git", "config", "sparse.expectFilesOutsideOfPatterns", "true"],
+        cwd=repository,
+        silent=True)
+    self.execute(["git", "sparse-checkout", "set", "--cone", "--"] +
+                 list(directories),
+                 cwd=repository)
+
+  def sparse_checkout_disable(self, repository):
+    """Restores a full working tree."""
+    self.execute(["git", "sparse-checkout", "disable"], cwd=repository)
 
   def remote_set_url(self, repository, remote, url):
     """Sets the URL of a remote."""
     self.execute(["git", "remote", "set-url", remote, url], cwd=repository)
 
-  def skip_worktree(self, repository, path):
-    """Marks a path in the repository with --skip-worktree."""
-    self.execute(["git", "update-index", "--skip-worktree", path],
-                 cwd=repository)
+  def skip_worktree_paths(self, repository, paths):
+    """Marks paths in the repository with --skip-worktree.
 
-  def parse_gitmodules(self, repository):
-    """Parses the .gitmodules file into a more sane structure."""
-    gitmodules_file = os.path.join(repository, ".gitmodules")
-    if not os.path.isfile(gitmodules_file):
+    Paths that are already marked (or that are not in the index) are skipped
+    and the rest are marked with a single update-index, so the index is only
+    rewritten if something changes.
+
+    Returns:
+      List of paths that were newly marked.
+    """
+    index_tags = self.index_tags(repository, paths)
+    unmarked = [
+        path for path in paths
+        if path in index_tags and not is_skip_worktree_tag(index_tags[path])
+    ]
+    if not unmarked:
+      return []
+    self.execute(["git", "update-index", "--skip-worktree", "-z", "--stdin"],
+                 cwd=repository,
+                 capture_output=True,
+                 input=b"".join(p.encode("UTF-8") + b"\0" for p in unmarked))
+    return unmarked
+
+  def index_tags(self, repository, paths):
+    """Gets the 'git ls-files -v' status tags of index entries.
+
+    Returns:
+      Dict of path -> tag for each of the paths that is in the index.
+    """
+    if not paths:
       return {}
-    props_lines = self.execute(
-        ["git", "config", "-f", gitmodules_file, "-l"],
+    output = self.execute(
+        ["git", "--literal-pathspecs", "ls-files", "-v", "-z", "--"] +
+        list(paths),
         cwd=repository,
         capture_output=True,
-        silent=True).strip().decode("UTF-8").splitlines()
-    props_splits = [line.split("=", 1) for line in props_lines]
-    props_dict = {s[0]: s[1] for s in props_splits}
-    # Keys are of the form:
-    #   submodule./for/some/path.path
-    # To get unique key prefixes, just scan for keys that end in ".path" and
-    # chop.
-    suffix = ".path"
-    key_prefixes = [
-        k[0:-len(suffix)] for k in props_dict.keys() if k.endswith(suffix)
-    ]
+        silent=True).decode("UTF-8")
+    tags = dict()
+    for entry in output.split("\0"):
+      if not entry:
+        continue
+      tag, path = entry.split(" ", 1)
+      tags[path] = tag
+    return tags
 
-    module_info_dict = {}
-    for key_prefix in key_prefixes:
+  def parse_gitmodules(self, repository):
+    """Parses the .gitmodules file into a more sane structure.
+
+    The file is parsed in-process and results are cached by content, so
+    unchanged files are only parsed once.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as repository:
+    ...   with open(os.path.join(repository, ".gitmodules"), "wb") as f:
+    ...     _ = f.write(b'[submodule "a"]\\r\\n\\tpath = a\\r\\n'
+    ...                 b'\\turl = https://h/a\\r\\n')
+    ...   GitExecutor().parse_gitmodules(repository)
+    {'a': SubmoduleInfo(url='https://h/a', path='a')}
+    >>> with tempfile.TemporaryDirectory() as repository:  # doctest: +ELLIPSIS
+    ...   with open(os.path.join(repository, ".gitmodules"), "wb") as f:
+    ...     _ = f.write(b'[submodule "a"]\\n\\tpath = \\xff\\n')
+    ...   GitExecutor().parse_gitmodules(repository)
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.UserError: Bad encoding of .../.gitmodules: ...
+    """
+    gitmodules_file = os.path.join(repository, ".gitmodules")
+    if not os.path.isfile(gitmodules_file):
+      return {}
+    with open(gitmodules_file, "rb") as f:
+      contents = f.read()
+    cache_key = hashlib.sha1(contents).hexdigest()
+    module_info_dict = _gitmodules_cache.get(cache_key)
+    if module_info_dict is None:
       try:
-        path = props_dict[key_prefix + ".path"]
-        url = props_dict[key_prefix + ".url"]
-      except IndexError:
-        continue
-      module_info_dict[path] = SubmoduleInfo(url=url, path=path)
-    return module_info_dict
+        text = contents.decode("UTF-8")
+      except UnicodeDecodeError as e:
+        raise UserError("Bad encoding of {}: {}", gitmodules_file, e) from None
+      module_info_dict = _parse_gitmodules_contents(text,
+                                                    source=gitmodules_file)
+      _gitmodules_cache[cache_key] = module_info_dict
+    return dict(module_info_dict)
 
-  def parse_submodule_versions(self, repository):
+  def parse_submodule_versions(self, repository, paths=None):
     """Parses the submodule versions.
 
+    Versions are the commits recorded for submodules (gitlinks) in the index,
+    which is what 'git submodule status' reports for submodules that are not
+    initialized (which is always the case for mmr managed submodules).
+
+    Args:
+      repository: Path to the repository.
+      paths: If not None, only consider these submodule paths.
     Returns:
       Sequence of (path, version).
     """
-    # This works even for not inited submodules (but prints a '-' in the first
-    # char).
-    status_lines = self.execute(
-        ["git", "submodule", "status"],
-        cwd=repository,
-        capture_output=True,
-        silent=True).strip().decode("UTF-8").splitlines()
+    args = ["git", "--literal-pathspecs", "ls-files", "--stage", "-z"]
+    if paths is not None:
+      if not paths:
+        return []
+      args.append("--")
+      args.extend(paths)
+    output = self.execute(args,
+                          cwd=repository,
+                          capture_output=True,
+                          silent=True).decode("UTF-8")
     results = []
-    for line in status_lines:
-      line = line.strip()
-      if line.startswith("-"):
-        line = line[1:]
-      version, path = line.split(" ", 1)
-      results.append((path, version))
+    for entry in output.split("\0"):
+      if not entry:
+        continue
+      # Form: <mode> <object> <stage>\t<path>
+      info, path = entry.split("\t", 1)
+      mode, version, _ = info.split(" ")
+      if mode == "160000":
+        results.append((path, version))
     return results
 
   def checkout_version(self, repository, version, *, fetch=True):
     """Checks out a version from a repository.
 
-    Fails if the repository is dirty.
+    If the version is a commit id which already exists locally, it is not
+    fetched. Fails if the repository is dirty.
     """
-    if fetch:
-      self.execute(["git", "fetch"], cwd=repository)
+    if fetch and (not is_commit_id(version) or
+                  self.missing_objects(repository, [version])):
+      self.fetch(repository)
     self.execute(["git", "checkout", "--quiet", version], cwd=repository)
 
   def show(self, repository, git_object, option_args=()):
@@ -140,42 +538,951 @@ class GitExecutor:
     return self.execute(args, silent=True, cwd=repository,
                         capture_output=True).strip().decode("UTF-8")
 
-  def ls_remote(self, remote_url):
-    """Executes ls-remote returning a dict of ref -> commit."""
-    output_lines = self.execute(
-        ["git", "ls-remote", remote_url], cwd=os.getcwd(),
-        capture_output=True, silent=True).strip().decode("UTF-8").splitlines()
+  def head_commit(self, repository):
+    """Gets the commit of HEAD (without running git), or None if unknown."""
+    git_dirs = find_git_dirs(repository)
+    if git_dirs is None:
+      return None
+    return read_head_commit(*git_dirs)
+
+  def local_remote_refs(self, repository, remote="origin"):
+    """Gets the refs of a remote as last fetched into a local repository.
+
+    Refs are read directly from the repository (no git process is spawned)
+    and are returned in the same form as ls_remote: remote-tracking branches
+    are mapped back to refs/heads/*, and tags and HEAD are included.
+
+    Returns:
+      Dict of ref -> commit (empty if the repository does not exist or its
+      refs cannot be read directly).
+    """
+    git_dirs = find_git_dirs(repository)
+    if git_dirs is None:
+      return {}
+    try:
+      local_refs = read_local_refs(*git_dirs)
+    except GitError:
+      # Unsupported ref storage: act as if nothing is known locally.
+      return {}
+    remote_prefix = "refs/remotes/{}/".format(remote)
+    refs = dict()
+    for ref, commit in local_refs.items():
+      if ref.startswith(remote_prefix):
+        name = ref[len(remote_prefix):]
+        if name == "HEAD":
+          refs["HEAD"] = commit
+        else:
+          refs["refs/heads/" + name] = commit
+      elif ref.startswith("refs/tags/"):
+        refs[ref] = commit
+    return refs
+
+  def ls_remote(self, remote_url, timeout=None):
+    """Executes ls-remote returning a dict of ref -> commit.
+
+    Remote URLs are listed with the policy of their host (see
+    _remote_request).
+    """
+    output = self._remote_request(
+        remote_url, "List of " + remote_url, timeout,
+        lambda timeout: self.execute(["git", "ls-remote", remote_url],
+                                     cwd=os.getcwd(),
+                                     capture_output=True,
+                                     silent=True,
+                                     timeout=timeout))
+    output_lines = output.strip().decode("UTF-8").splitlines()
     refs = dict()
     for output_line in output_lines:
       commit, ref = output_line.split("\t", maxsplit=1)
       refs[ref] = commit
     return refs
 
-  def execute(self, args, cwd, capture_output=False, silent=False, **kwargs):
+  def _remote_request(self, url, description, timeout, request):
+    """Runs a git command which may use the network.
+
+    Commands on remote URLs are retried and subject to the circuit breaker of
+    the host, as set by its RemotePolicy (see remote_policy). Commands on
+    local repositories are just run.
+
+    Args:
+      url: URL of the remote (or None if not known).
+      description: Description of the command for messages.
+      timeout: Timeout of the command, or None for that of the policy (or the
+        network timeout, see configure_git_processes).
+      request: Function of the timeout which runs the command.
+    Returns:
+      The result of request.
+    """
+    host = None if url is None else remote_host(url)
+    if host is None:
+      return request(_resolve_network_timeout(timeout))
+    policy = self.remote_policy(host)
+    if timeout is None:
+      timeout = _resolve_network_timeout(policy.timeout)
+    return call_remote(host,
+                       policy,
+                       description,
+                       lambda: request(timeout),
+                       wait=_cancelled.wait)
+
+  def _remote_url(self, repository, remote):
+    """Gets the URL of a remote of a repository (without running git).
+
+    Args:
+      repository: Path of the repository.
+      remote: Name or URL of the remote (None for "origin").
+    Returns:
+      The URL, or None if the remote is not configured.
+    """
+    if remote is None:
+      remote = "origin"
+    if "/" in remote or ":" in remote:
+      return remote
+    git_dirs = find_git_dirs(repository)
+    if git_dirs is None:
+      return None
+    config_file = os.path.join(git_dirs[1], "config")
+    try:
+      with open(config_file, "rt") as f:
+        contents = f.read()
+    except OSError:
+      return None
+    url = None
+    for name, value in parse_git_config(contents, config_file):
+      if name == "remote.{}.url".format(remote):
+        url = value
+    return url
+
+  def execute(self,
+              args,
+              cwd,
+              capture_output=False,
+              silent=False,
+              timeout=None,
+              **kwargs):
     """Executes a command.
+
+    The invocation is reported at the DETAIL level (DEBUG if silent), along
+    with anything the command writes that is not captured. Commands which
+    fail raise GitCommandError, which includes their stderr.
+
     Args:
       args: List of command line arguments.
       cwd: Directory to execute in.
       capture_output: Whether to capture the output.
       silent: Whether to skip logging the invocation.
-      **kwargs: Extra arguments to pass to subprocess.exec
+      timeout: Seconds after which the command is killed and GitTimeoutError
+        is raised (None to wait for it to complete).
+      **kwargs: Extra arguments to pass to subprocess.Popen (and "input")
     Returns:
-      The output if capture_output, otherwise None.
+      The output if capture_output, otherwise 0.
+
+    Errors are reported verbatim (git output often has braces, i.e. in
+    "@{upstream}"):
+
+    >>> GitExecutor().execute(
+    ...     ["sh", "-c", "echo 'no upstream for @{u} {0}' >&2; exit 1"],
+    ...     cwd="/")
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.GitCommandError: Error executing command:
+      cd /
+      sh -c echo 'no upstream for @{u} {0}' >&2; exit 1
+    no upstream for @{u} {0}
+    >>> try:
+    ...   GitExecutor().execute(["sh", "-c", "echo out; echo err >&2; exit 3"],
+    ...                         cwd="/",
+    ...                         capture_output=True)
+    ... except GitCommandError as e:
+    ...   e.status, e.stderr
+    (3, 'err\\n')
+    >>> GitExecutor().execute(["sh", "-c", "sleep 10 # {0}"],
+    ...                       cwd="/",
+    ...                       timeout=0.2)
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.GitTimeoutError: Timed out after 0.2s executing command:
+      cd /
+      sh -c sleep 10 # {0}
     """
+    start_time = time.perf_counter()
+    status = None
+    output = None
+    level = reporting.DEBUG if silent else reporting.DETAIL
+    reporting.log(level,
+                  "+ {}   [from {}]",
+                  " ".join(args),
+                  cwd,
+                  event="git",
+                  argv=args,
+                  cwd=cwd)
+    input = kwargs.pop("input", None)
+    # Output is captured (rather than passed through) so that it does not
+    # interleave with the output of other commands and the progress line.
+    kwargs.setdefault("stderr", subprocess.PIPE)
     try:
-      if PRINT_ALL or not silent:
-        print("+", " ".join(args), "  [from %s]" % cwd)
+      with _process_slot():
+        process = _start_process(
+            args,
+            cwd=cwd,
+            stdin=None if input is None else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            **kwargs)
+        try:
+          stdout, stderr = process.communicate(input=input, timeout=timeout)
+        except subprocess.TimeoutExpired:
+          _kill_process_tree(process)
+          process.communicate()
+          raise GitTimeoutError(
+              "\n".join([
+                  "Timed out after {}s executing command:",
+                  "  cd {}",
+                  "  {}",
+              ]), timeout, cwd, " ".join(args)) from None
+        finally:
+          _finish_process(process)
+      status = process.returncode
       if capture_output:
-        return subprocess.check_output(args, cwd=cwd, **kwargs)
+        output = stdout
+      messages = b"".join(m for m in (
+          None if capture_output else stdout,
+          stderr,
+      ) if m).decode("UTF-8", "replace").rstrip()
+      if status != 0:
+        cancelled = _cancelled.is_set()
+        lines = [
+            "Cancelled command:" if cancelled else "Error executing command:",
+            "  cd {}".format(cwd),
+            "  {}".format(" ".join(args)),
+        ]
+        if messages:
+          lines.append(messages)
+        if cancelled:
+          raise UserError("{}", "\n".join(lines))
+        raise GitCommandError("{}",
+                              "\n".join(lines),
+                              status=status,
+                              stderr=(stderr or b"").decode("UTF-8", "replace"))
+      if messages:
+        reporting.log(level, messages, event="git_output", cwd=cwd)
+      return output if capture_output else 0
+    finally:
+      profiling.record_process(args, cwd, start_time, status,
+                               None if output is None else len(output))
+
+
+def configure_git_processes(*, network_timeout=None, max_processes=None):
+  """Configures how git commands are run (for the rest of the process).
+
+  Args:
+    network_timeout: Default timeout in seconds of git commands which use the
+      network (clone, fetch and ls-remote), or None to wait forever. This
+      keeps a hung remote from stalling a command indefinitely. The
+      RemotePolicy of a host can set another timeout.
+    max_processes: Maximum number of git commands to run at once (across all
+      threads and repositories), or None for no limit. Long-lived cat-file
+      processes are not counted.
+  """
+  global _network_timeout, _process_slots
+  _network_timeout = network_timeout
+  _process_slots = (None if max_processes is None else
+                    threading.BoundedSemaphore(max_processes))
+
+
+def cancel_git_processes():
+  """Kills running git commands and fails any that are started later.
+
+  Used when interrupted, so that concurrent workers finish promptly.
+
+  >>> threading.Timer(0.5, cancel_git_processes).start()
+  >>> GitExecutor().execute(["sh", "-c", "echo '@{u}' >&2; sleep 10"], cwd="/")
+  Traceback (most recent call last):
+  ...
+  mmrepo.common.UserError: Cancelled command:
+    cd /
+    sh -c echo '@{u}' >&2; sleep 10
+  @{u}
+  >>> GitExecutor().execute(["sh", "-c", "exit 0 # {0}"], cwd="/")
+  Traceback (most recent call last):
+  ...
+  mmrepo.common.UserError: Cancelled command: sh -c exit 0 # {0}
+  >>> # Let later examples run commands again.
+  >>> _cancelled.clear()
+  """
+  with _running_processes_lock:
+    _cancelled.set()
+    processes = list(_running_processes)
+  for process in processes:
+    _kill_process_tree(process)
+
+
+def _descendant_pids(pid: int):
+  """Finds the descendants of a process (on Linux, otherwise none)."""
+  children = collections.defaultdict(list)
+  try:
+    proc_entries = os.listdir("/proc")
+  except OSError:
+    return []
+  for entry in proc_entries:
+    if not entry.isdigit():
+      continue
+    try:
+      with open(os.path.join("/proc", entry, "stat"), "r") as f:
+        stat = f.read()
+    except OSError:
+      continue
+    # The command name (in parentheses) can contain spaces.
+    fields = stat[stat.rfind(")") + 2:].split()
+    children[int(fields[1])].append(int(entry))
+  descendants = []
+  pending = [pid]
+  while pending:
+    for child in children.get(pending.pop(), ()):
+      descendants.append(child)
+      pending.append(child)
+  return descendants
+
+
+def _kill_process_tree(process: subprocess.Popen):
+  """Kills a process and (where possible) its descendants.
+
+  Git runs remote helpers (i.e. ssh or git-remote-https) as child processes,
+  which would otherwise keep hung connections open.
+  """
+  # Find descendants first: once the process is killed, they are re-parented.
+  descendants = _descendant_pids(process.pid)
+  try:
+    process.kill()
+  except OSError:
+    pass
+  for pid in descendants:
+    try:
+      os.kill(pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+
+def _resolve_network_timeout(timeout):
+  return _network_timeout if timeout is None else timeout
+
+
+@contextlib.contextmanager
+def _process_slot():
+  process_slots = _process_slots
+  if process_slots is None:
+    yield
+    return
+  with process_slots:
+    yield
+
+
+def _start_process(args, **kwargs) -> subprocess.Popen:
+  if _cancelled.is_set():
+    raise UserError("Cancelled command: {}", " ".join(args))
+  process = subprocess.Popen(args, **kwargs)
+  with _running_processes_lock:
+    if not _cancelled.is_set():
+      _running_processes.add(process)
+      return process
+  process.kill()
+  process.communicate()
+  raise UserError("Cancelled command: {}", " ".join(args))
+
+
+def _finish_process(process: subprocess.Popen):
+  with _running_processes_lock:
+    _running_processes.discard(process)
+
+
+class _CatFileProcess:
+  """A long-lived 'git cat-file --batch[-check]' process for a repository."""
+
+  def __init__(self, repository: str, batch_arg: str):
+    super().__init__()
+    self._repository = repository
+    self._batch_arg = batch_arg
+    self._lock = threading.Lock()
+    self._process = None
+
+  def _start(self):
+    # Objects left out of partial clones must not be fetched lazily: that is
+    # a network operation (while holding the lock). git fails the query
+    # instead, which is reported as a missing object.
+    self._stderr = tempfile.TemporaryFile()
+    args = ["git", "cat-file", self._batch_arg]
+    start_time = time.perf_counter()
+    try:
+      self._process = subprocess.Popen(args,
+                                       cwd=self._repository,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=self._stderr,
+                                       env=dict(os.environ,
+                                                GIT_NO_LAZY_FETCH="1"))
+    except OSError as e:
+      self._stderr.close()
+      profiling.record_process(args, self._repository, start_time, None, None)
+      raise UserError("Error starting git cat-file in {}: {}",
+                      self._repository, e)
+    # The process is long-lived: only its start is recorded here, and each
+    # query is recorded separately.
+    profiling.record_process(args, self._repository, start_time, 0, None)
+
+  def query(self, rev: str):
+    """Queries a revision.
+
+    Returns:
+      Tuple of (object_id, object_type, contents) or None if missing. Contents
+      are None for --batch-check.
+    """
+    if "\n" in rev:
+      raise ValueError("Illegal revision: {!r}".format(rev))
+    start_time = time.perf_counter()
+    result = self._query(rev)
+    profiling.record_cat_file_query(
+        self._repository, self._batch_arg, start_time, result is not None,
+        None if result is None or result[2] is None else len(result[2]))
+    return result
+
+  def _query(self, rev: str):
+    with self._lock:
+      if self._process is None or self._process.poll() is not None:
+        self._start()
+      try:
+        self._process.stdin.write(rev.encode("UTF-8") + b"\n")
+        self._process.stdin.flush()
+        header = self._process.stdout.readline()
+      except OSError:
+        header = b""
+      if not header:
+        errors = self._close_locked()
+        if _PROMISOR_FETCH_ERROR in errors:
+          # Only available from the promisor remote of a partial clone.
+          return None
+        raise UserError("Error reading '{}' with git cat-file in {}: {}", rev,
+                        self._repository, errors.strip())
+      header = header.decode("UTF-8").rstrip("\n")
+      if header.endswith(" missing") or header.endswith(" ambiguous"):
+        return None
+      object_id, object_type, size = header.split(" ")
+      contents = None
+      if self._batch_arg == "--batch":
+        contents = self._process.stdout.read(int(size))
+        self._process.stdout.read(1)  # Trailing newline.
+      return object_id, object_type, contents
+
+  def close(self):
+    with self._lock:
+      self._close_locked()
+
+  def _close_locked(self) -> str:
+    """Stops the process, returning what it wrote to stderr."""
+    if self._process is None:
+      return ""
+    try:
+      self._process.stdin.close()
+    except OSError:
+      pass
+    self._process.wait()
+    self._process.stdout.close()
+    self._process = None
+    self._stderr.seek(0)
+    errors = self._stderr.read().decode("UTF-8", errors="replace")
+    self._stderr.close()
+    return errors
+
+
+class _CatFilePool:
+  """Long-lived cat-file processes, by repository, shared by all executors."""
+
+  def __init__(self):
+    super().__init__()
+    self._lock = threading.Lock()
+    self._processes = dict()
+
+  def get(self, repository: str, batch_arg: str) -> _CatFileProcess:
+    key = (os.path.realpath(repository), batch_arg)
+    with self._lock:
+      process = self._processes.get(key)
+      if process is None:
+        process = _CatFileProcess(key[0], batch_arg)
+        self._processes[key] = process
+      return process
+
+  def close(self):
+    with self._lock:
+      processes = list(self._processes.values())
+      self._processes.clear()
+    for process in processes:
+      process.close()
+
+
+_cat_file_pool = _CatFilePool()
+atexit.register(_cat_file_pool.close)
+
+
+def parse_commit(commit_id: str, contents: bytes) -> CommitInfo:
+  """Parses the raw contents of a commit object.
+
+    >>> parse_commit("abc", b"tree 123\\nparent 456\\n"
+    ...     b"author A <a@x> 1600000000 +0000\\n"
+    ...     b"committer C <c@x> 1600000100 -0700\\n"
+    ...     b"\\nSubject line\\n continued\\n\\nBody\\n")
+    CommitInfo(commit='abc', tree='123', parents=['456'], author='A <a@x>', author_time=1600000000, committer='C <c@x>', commit_time=1600000100, subject='Subject line continued')
+  """
+  text = contents.decode("UTF-8", errors="replace")
+  header, _, message = text.partition("\n\n")
+  fields = dict(tree=None, parents=[], author=None, author_time=None,
+                committer=None, commit_time=None)
+  for line in header.splitlines():
+    key, _, value = line.partition(" ")
+    if key == "tree":
+      fields["tree"] = value
+    elif key == "parent":
+      fields["parents"].append(value)
+    elif key in ("author", "committer"):
+      # Form: Name <email> timestamp tz
+      ident, timestamp, _ = value.rsplit(" ", 2)
+      fields[key] = ident
+      fields["author_time" if key == "author" else "commit_time"] = int(
+          timestamp)
+  # The subject is the first paragraph, joined into one line.
+  subject_lines = []
+  for line in message.splitlines():
+    if not line.strip():
+      if subject_lines:
+        break
+      continue
+    subject_lines.append(line.strip())
+  return CommitInfo(commit=commit_id,
+                    subject=" ".join(subject_lines),
+                    **fields)
+
+
+def format_relative_time(timestamp: int, now: float = None) -> str:
+  """Formats a time relative to now, as git's --date=relative does.
+
+    >>> format_relative_time(1000, now=1001)
+    '1 second ago'
+    >>> format_relative_time(0, now=3 * 3600)
+    '3 hours ago'
+    >>> format_relative_time(0, now=20 * 86400)
+    '3 weeks ago'
+    >>> format_relative_time(0, now=400 * 86400)
+    '1 year, 1 month ago'
+    >>> format_relative_time(0, now=2000 * 86400)
+    '5 years ago'
+    >>> format_relative_time(10, now=0)
+    'in the future'
+  """
+  if now is None:
+    now = time.time()
+  now = int(now)
+  if now < timestamp:
+    return "in the future"
+
+  def plural(n, unit):
+    return "{} {}{}".format(n, unit, "" if n == 1 else "s")
+
+  diff = now - timestamp
+  if diff < 90:
+    return plural(diff, "second") + " ago"
+  diff = (diff + 30) // 60
+  if diff < 90:
+    return plural(diff, "minute") + " ago"
+  diff = (diff + 30) // 60
+  if diff < 36:
+    return plural(diff, "hour") + " ago"
+  diff = (diff + 12) // 24
+  if diff < 14:
+    return plural(diff, "day") + " ago"
+  if diff < 70:
+    return plural((diff + 3) // 7, "week") + " ago"
+  if diff < 365:
+    return plural((diff + 15) // 30, "month") + " ago"
+  if diff < 1825:
+    total_months = (diff * 12 * 2 + 365) // (365 * 2)
+    years, months = divmod(total_months, 12)
+    if months:
+      return "{}, {} ago".format(plural(years, "year"),
+                                 plural(months, "month"))
+    return plural(years, "year") + " ago"
+  return plural((diff + 183) // 365, "year") + " ago"
+
+
+def _parse_gitmodules_contents(contents: str, source: str):
+  """Parses .gitmodules contents into a dict of path -> SubmoduleInfo.
+
+    >>> _parse_gitmodules_contents('''
+    ... [submodule "third_party/foo"]
+    ... \tpath = third_party/foo
+    ... \turl = https://github.com/bar/foo.git
+    ... [submodule "no_url"]
+    ... \tpath = no_url
+    ... ''', source="<test>")
+    {'third_party/foo': SubmoduleInfo(url='https://github.com/bar/foo.git', path='third_party/foo')}
+  """
+  props_dict = dict(parse_git_config(contents, source=source))
+  # Keys are of the form:
+  #   submodule./for/some/path.path
+  # To get unique key prefixes, just scan for keys that end in ".path" and
+  # chop.
+  suffix = ".path"
+  key_prefixes = [
+      k[0:-len(suffix)] for k in props_dict.keys() if k.endswith(suffix)
+  ]
+
+  module_info_dict = {}
+  for key_prefix in key_prefixes:
+    path = props_dict.get(key_prefix + ".path")
+    url = props_dict.get(key_prefix + ".url")
+    if path is None or url is None:
+      continue
+    module_info_dict[path] = SubmoduleInfo(url=url, path=path)
+  return module_info_dict
+
+
+def parse_git_config(contents: str, source: str = "<string>"):
+  r"""Parses text in the git-config file format.
+
+  This is equivalent to `git config -f <file> -l` (without following
+  includes): sections and variable names are case-insensitive (and are
+  lower-cased), subsections are case-sensitive, values are unquoted and
+  unescaped. Variables without a value (implicit booleans) have a value
+  of None.
+
+  Returns:
+    List of (key, value) in file order.
+
+    >>> parse_git_config('''
+    ... # Comment
+    ... [Core]
+    ... \tBare = false ; comment
+    ... [submodule "Third_Party/foo"]
+    ... \tpath = "with space " # comment
+    ... \turl = a\\
+    ... b\\tc\\"d\\\\ \t  e
+    ... [section.Sub] flag
+    ... ''')
+    [('core.bare', 'false'), ('submodule.Third_Party/foo.path', 'with space '), ('submodule.Third_Party/foo.url', 'ab\tc"d\\    e'), ('section.sub.flag', None)]
+    >>> parse_git_config("[a]\nb = \"unterminated")
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.UserError: Bad config line 2 in file <string>
+
+  Like git, a CR before a LF is dropped (so files with CRLF line endings
+  parse the same):
+
+    >>> parse_git_config("[a]\r\n\tflag\r\n\tb = \"c \\\r\n d\"\r\n")
+    [('a.flag', None), ('a.b', 'c  d')]
+  """
+  return _GitConfigParser(contents, source).parse()
+
+
+class _GitConfigParser:
+  """Parser for the git-config format (following git's config.c)."""
+
+  def __init__(self, contents: str, source: str):
+    super().__init__()
+    self._contents = contents
+    self._source = source
+    self._pos = 0
+    self._line = 1
+    if contents.startswith("\ufeff"):
+      self._pos = 1
+
+  def _peek(self) -> str:
+    if self._pos < len(self._contents):
+      c = self._contents[self._pos]
+      if c == "\r" and self._contents.startswith("\n", self._pos + 1):
+        return "\n"
+      return c
+    return ""
+
+  def _next(self) -> str:
+    c = self._peek()
+    if c:
+      if c == "\n":
+        if self._contents[self._pos] == "\r":
+          self._pos += 1
+        self._line += 1
+      self._pos += 1
+    return c
+
+  def _error(self):
+    raise UserError("Bad config line {} in file {}", self._line, self._source)
+
+  def _skip_line(self):
+    while True:
+      c = self._next()
+      if not c or c == "\n":
+        return
+
+  def parse(self):
+    entries = []
+    section = None
+    while True:
+      c = self._next()
+      if not c:
+        return entries
+      if c.isspace():
+        continue
+      if c in "#;":
+        self._skip_line()
+        continue
+      if c == "[":
+        section = self._parse_section_header()
+        continue
+      if not c.isalpha():
+        self._error()
+      name, value = self._parse_variable(c)
+      if section is not None:
+        name = section + "." + name
+      entries.append((name, value))
+
+  def _parse_section_header(self) -> str:
+    name = []
+    while True:
+      c = self._next()
+      if c == "]" and name:
+        # Also handles the deprecated [section.subsection] syntax, which is
+        # case-insensitive throughout.
+        return "".join(name).lower()
+      if c in (" ", "\t") and name:
+        return self._parse_subsection("".join(name).lower())
+      if not (c.isalnum() or c in "-."):
+        self._error()
+      name.append(c)
+
+  def _parse_subsection(self, section: str) -> str:
+    c = self._next()
+    while c in (" ", "\t"):
+      c = self._next()
+    if c != '"':
+      self._error()
+    subsection = []
+    while True:
+      c = self._next()
+      if not c or c == "\n":
+        self._error()
+      if c == '"':
+        break
+      if c == "\\":
+        c = self._next()
+        if not c or c == "\n":
+          self._error()
+      subsection.append(c)
+    if self._next() != "]":
+      self._error()
+    return section + "." + "".join(subsection)
+
+  def _parse_variable(self, first: str):
+    name = [first]
+    while self._peek().isalnum() or self._peek() == "-":
+      name.append(self._next())
+    while self._peek() in (" ", "\t"):
+      self._next()
+    c = self._peek()
+    if not c or c == "\n":
+      self._next()
+      return "".join(name).lower(), None
+    if c != "=":
+      self._error()
+    self._next()
+    return "".join(name).lower(), self._parse_value()
+
+  def _parse_value(self) -> str:
+    value = []
+    quoted = False
+    # Whitespace is collapsed into pending spaces which are only emitted if
+    # followed by more value (dropping leading and trailing whitespace).
+    pending_spaces = 0
+    while True:
+      c = self._next()
+      if not c or c == "\n":
+        if quoted:
+          self._error()
+        return "".join(value)
+      if not quoted:
+        if c.isspace():
+          if value:
+            pending_spaces += 1
+          continue
+        if c in "#;":
+          self._skip_line()
+          return "".join(value)
+      value.extend(" " * pending_spaces)
+      pending_spaces = 0
+      if c == "\\":
+        c = self._next()
+        if c == "\n":
+          # Line continuation.
+          continue
+        if c not in _CONFIG_VALUE_ESCAPES:
+          self._error()
+        value.append(_CONFIG_VALUE_ESCAPES[c])
+      elif c == '"':
+        quoted = not quoted
       else:
-        return subprocess.check_call(args, cwd=cwd, **kwargs)
-    except subprocess.CalledProcessError:
-      message = "\n".join([
-          "Error executing command:",
-          "  cd {}".format(cwd),
-          "  {}".format(" ".join(args)),
-      ])
-      raise UserError(message)
+        value.append(c)
+
+
+def find_git_dirs(path: str):
+  """Finds the git directories of a working tree (or bare repository).
+
+  Handles ".git" files (i.e. of worktrees), which point at a private git dir
+  that shares refs and objects with a common dir.
+
+  Returns:
+    Tuple of (git_dir, common_dir) or None if not a git repository.
+  """
+  git_dir = os.path.join(path, ".git")
+  if os.path.isfile(git_dir):
+    with open(git_dir, "rt") as f:
+      contents = f.read().strip()
+    if not contents.startswith("gitdir:"):
+      return None
+    git_dir = os.path.join(path, contents[len("gitdir:"):].strip())
+  elif not os.path.isdir(git_dir):
+    # Bare repository?
+    git_dir = path
+  if not os.path.isfile(os.path.join(git_dir, "HEAD")):
+    return None
+  common_dir = git_dir
+  commondir_file = os.path.join(git_dir, "commondir")
+  if os.path.isfile(commondir_file):
+    with open(commondir_file, "rt") as f:
+      common_dir = os.path.join(git_dir, f.read().strip())
+  return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def read_local_refs(git_dir: str, common_dir: str = None):
+  """Reads refs directly from the files of a git repository.
+
+  Loose refs take precedence over packed-refs and symbolic refs are resolved.
+  As with ls-remote, peeled tags are included as "<tag>^{}".
+
+  Returns:
+    Dict of ref -> commit.
+  """
+  if common_dir is None:
+    common_dir = git_dir
+  if os.path.isdir(os.path.join(common_dir, "reftable")):
+    raise GitError("Cannot read refs from reftable repository {}", common_dir)
+  raw_refs = dict()
+
+  # Packed refs.
+  packed_refs_file = os.path.join(common_dir, "packed-refs")
+  if os.path.isfile(packed_refs_file):
+    last_ref = None
+    with open(packed_refs_file, "rt", encoding="UTF-8") as f:
+      for line in f:
+        line = line.rstrip("\n")
+        if not line or line.startswith("#"):
+          continue
+        if line.startswith("^"):
+          if last_ref is not None:
+            raw_refs[last_ref + "^{}"] = line[1:]
+          continue
+        commit, last_ref = line.split(" ", 1)
+        raw_refs[last_ref] = commit
+
+  # Loose refs.
+  refs_dir = os.path.join(common_dir, "refs")
+  for dir_path, _, file_names in os.walk(refs_dir):
+    for file_name in file_names:
+      file_path = os.path.join(dir_path, file_name)
+      ref = os.path.relpath(file_path, common_dir).replace(os.path.sep, "/")
+      with open(file_path, "rt", encoding="UTF-8") as f:
+        raw_refs[ref] = f.read().strip()
+  head_file = os.path.join(git_dir, "HEAD")
+  if os.path.isfile(head_file):
+    with open(head_file, "rt", encoding="UTF-8") as f:
+      raw_refs["HEAD"] = f.read().strip()
+
+  # Resolve symbolic refs.
+  refs = dict()
+  for ref, value in raw_refs.items():
+    for _ in range(10):
+      if not value.startswith("ref:"):
+        break
+      value = raw_refs.get(value[len("ref:"):].strip(), "")
+    if value and not value.startswith("ref:"):
+      refs[ref] = value
+  return refs
+
+
+def read_head_commit(git_dir: str, common_dir: str = None):
+  """Reads the commit of HEAD directly from the files of a git repository.
+
+  This is much cheaper than read_local_refs() when only HEAD is needed.
+
+  Returns:
+    The commit id, or None if HEAD cannot be resolved (i.e. an unborn branch).
+  """
+  if common_dir is None:
+    common_dir = git_dir
+  try:
+    with open(os.path.join(git_dir, "HEAD"), "rt", encoding="UTF-8") as f:
+      head = f.read().strip()
+  except FileNotFoundError:
+    return None
+  if not head.startswith("ref:"):
+    return head if is_commit_id(head) else None
+  ref = head[len("ref:"):].strip()
+  try:
+    with open(os.path.join(common_dir, ref), "rt", encoding="UTF-8") as f:
+      commit = f.read().strip()
+    return commit if is_commit_id(commit) else None
+  except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+    pass
+  packed_refs_file = os.path.join(common_dir, "packed-refs")
+  if os.path.isfile(packed_refs_file):
+    suffix = " " + ref
+    with open(packed_refs_file, "rt", encoding="UTF-8") as f:
+      for line in f:
+        line = line.rstrip("\n")
+        if line.endswith(suffix) and not line.startswith(("#", "^")):
+          return line[:-len(suffix)]
+  return None
+
+
+def objects_size(path: str) -> int:
+  """Gets the total size of the object database of a git tree."""
+  git_dirs = find_git_dirs(path)
+  if git_dirs is None:
+    return 0
+  total = 0
+  for dirpath, _, filenames in os.walk(os.path.join(git_dirs[1], "objects")):
+    for filename in filenames:
+      try:
+        total += os.lstat(os.path.join(dirpath, filename)).st_size
+      except FileNotFoundError:
+        # Loose objects can be removed by a concurrent repack.
+        pass
+  return total
+
+
+def is_commit_id(version: str) -> bool:
+  """Whether a version is a full (and therefore immutable) commit id.
+
+    >>> is_commit_id("c2ad2f0ab54c8aa3e2d4bcb5b5a0f1cd0fa5a5d7")
+    True
+    >>> is_commit_id("c2ad2f0"), is_commit_id("HEAD"), is_commit_id("main")
+    (False, False, False)
+  """
+  return bool(COMMIT_ID_PAT.match(version))
+
+
+def is_skip_worktree_tag(tag: str) -> bool:
+  """Whether a 'git ls-files -v' tag indicates a skip-worktree entry.
+
+    >>> is_skip_worktree_tag("S"), is_skip_worktree_tag("s")
+    (True, True)
+    >>> is_skip_worktree_tag("H"), is_skip_worktree_tag("h")
+    (False, False)
+  """
+  return tag in ("S", "s")
 
 
 class GitOrigin:
@@ -189,6 +1496,8 @@ class GitOrigin:
     'github.com/stellaraccident/mlir-federation.git'
     >>> https_origin.default_alias
     'mlir-federation'
+    >>> https_origin.canonical_id
+    'github.com/stellaraccident/mlir-federation'
 
   SSH origins:
     >>> ssh_origin = GitOrigin("git@github.com:stellaraccident/mlir-federation.git")
@@ -198,11 +1507,26 @@ class GitOrigin:
     'github.com/stellaraccident/mlir-federation.git'
     >>> ssh_origin.default_alias
     'mlir-federation'
+    >>> ssh_origin.canonical_id
+    'github.com/stellaraccident/mlir-federation'
+    >>> ssh_origin.host
+    'github.com'
+
+  Local origins:
+    >>> file_origin = GitOrigin("file:///srv/git/mlir-federation.git")
+    >>> file_origin.universe_path
+    'file/srv/git/mlir-federation.git'
+    >>> file_origin.canonical_id
+    'file/srv/git/mlir-federation'
   """
 
-  def __init__(self, spec):
+  def __init__(self, spec, rewrites=None):
     super().__init__()
     self._spec = spec
+    self._rewrites = rewrites
+    # Memoized normalizations.
+    self._universe_path = None
+    self._canonical_id = None
 
   def __eq__(self, other):
     return self._spec == other._spec
@@ -217,6 +1541,21 @@ class GitOrigin:
   def git_origin(self) -> str:
     return self._spec
 
+  @property
+  def canonical_id(self) -> str:
+    """Returns an identity for the repository, independent of URL spelling.
+
+    See canonicalize_git_url().
+    """
+    if self._canonical_id is None:
+      self._canonical_id = canonicalize_git_url(self._spec, self._rewrites)
+    return self._canonical_id
+
+  @property
+  def host(self) -> str:
+    """Returns the (canonical) host serving the repository."""
+    return self.canonical_id.split("/", 1)[0]
+
   @property
   def universe_path(self) -> str:
     """Returns a unique path for this in the universe.
@@ -224,6 +1563,11 @@ class GitOrigin:
     Ideally, this normalizes SSH and HTTPS access mechanisms for a host
     so that they produce the same universe location.
     """
+    if self._universe_path is None:
+      self._universe_path = self._compute_universe_path()
+    return self._universe_path
+
+  def _compute_universe_path(self) -> str:
     if self._spec.startswith("https://") or self._spec.startswith("http://"):
       # Extract {netloc}{path}
       url = urllib.parse.urlsplit(self._spec)
@@ -235,6 +1579,11 @@ class GitOrigin:
       norm_path = norm_path.replace("/", os.path.sep)
       assert not os.path.isabs(norm_path)
       return os.path.join(url.netloc, norm_path)
+    elif self._spec.startswith("file://") or os.path.isabs(self._spec):
+      # Local repositories are placed under a pseudo host named "file".
+      path = urllib.parse.urlsplit(self._spec).path
+      norm_path = path.lstrip("/").replace("/", os.path.sep)
+      return os.path.join("file", norm_path)
     else:
       # Assume SSH.
       try:
@@ -270,6 +1619,91 @@ class GitOrigin:
     return basename
 
 
+def apply_url_rewrites(url: str, rewrites=None) -> str:
+  """Applies URL rewrite rules, like git's url.<base>.insteadOf.
+
+  Rewrites are a dict of base -> prefix or list of prefixes. A URL starting
+  with a prefix has it replaced by the base (the longest match wins).
+
+    >>> rewrites = {
+    ...     "https://github.com/": ["git@github.com:", "ssh://git@github.com/"],
+    ...     "https://github.com/llvm/": "https://llvm.googlesource.com/",
+    ... }
+    >>> apply_url_rewrites("git@github.com:google/iree.git", rewrites)
+    'https://github.com/google/iree.git'
+    >>> apply_url_rewrites("https://llvm.googlesource.com/llvm-project", rewrites)
+    'https://github.com/llvm/llvm-project'
+    >>> apply_url_rewrites("https://gitlab.com/foo/bar", rewrites)
+    'https://gitlab.com/foo/bar'
+  """
+  if not rewrites:
+    return url
+  best_base = None
+  best_prefix = ""
+  for base, prefixes in rewrites.items():
+    if isinstance(prefixes, str):
+      prefixes = [prefixes]
+    for prefix in prefixes:
+      if url.startswith(prefix) and len(prefix) > len(best_prefix):
+        best_base = base
+        best_prefix = prefix
+  if best_base is None:
+    return url
+  return best_base + url[len(best_prefix):]
+
+
+def canonicalize_git_url(url: str, rewrites=None) -> str:
+  """Canonicalizes a git URL into a "host/path" identity.
+
+  Rewrite rules are applied first (see apply_url_rewrites). Then, the access
+  mechanism, user and port are dropped, the host is lower-cased and any
+  redundant slashes and ".git" suffix are stripped from the path. Local
+  repositories get a pseudo host of "file".
+
+    >>> canonicalize_git_url("https://GitHub.com/llvm/llvm-project.git")
+    'github.com/llvm/llvm-project'
+    >>> canonicalize_git_url("https://user@github.com/llvm/llvm-project/")
+    'github.com/llvm/llvm-project'
+    >>> canonicalize_git_url("git@github.com:llvm/llvm-project")
+    'github.com/llvm/llvm-project'
+    >>> canonicalize_git_url("ssh://git@github.com:22//llvm/llvm-project.git")
+    'github.com/llvm/llvm-project'
+    >>> canonicalize_git_url("file:///srv/git/foo.git")
+    'file/srv/git/foo'
+    >>> canonicalize_git_url("/srv/git/foo.git")
+    'file/srv/git/foo'
+    >>> canonicalize_git_url("https://llvm.googlesource.com/llvm-project",
+    ...     {"https://github.com/llvm/": "https://llvm.googlesource.com/"})
+    'github.com/llvm/llvm-project'
+    >>> canonicalize_git_url("not-a-url")
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.UserError: Git origin does not appear to be an SSH path: not-a-url
+  """
+  url = apply_url_rewrites(url, rewrites)
+  if "://" in url:
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "file":
+      host = "file"
+    else:
+      # Note that hostname is lower-cased and excludes any user and port.
+      host = parts.hostname or ""
+    path = parts.path
+  elif os.path.isabs(url):
+    host = "file"
+    path = url
+  else:
+    # SSH (scp-like) syntax: [user@]host:path
+    netloc, sep, path = url.partition(":")
+    if not sep:
+      raise UserError("Git origin does not appear to be an SSH path: {}", url)
+    host = netloc.rpartition("@")[2].lower()
+  path = "/".join(segment for segment in path.split("/") if segment)
+  if path.endswith(".git"):
+    path = path[:-4]
+  return host + "/" + path
+
+
 if __name__ == "__main__":
   import doctest
   doctest.testmod()
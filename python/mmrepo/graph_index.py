@@ -0,0 +1,232 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""An on-disk index of the dependency graph.
+
+For each checked out tree, the index records facts about its dependencies
+which otherwise take git processes to discover (i.e. the versions of
+submodules, which are read from the git index, and whether submodule paths
+are skip-worktree). Facts are keyed by the state they were derived from:
+the HEAD commit of the tree and the stat of its git index and dependency
+files. When any of these change, the facts are discarded and recomputed.
+Computing the key does not run git.
+"""
+
+import os
+import threading
+
+from mmrepo.config import *
+from mmrepo.git import *
+
+__all__ = [
+    "GraphIndex",
+]
+
+INDEX_FILENAME = "graph_index.json"
+# Files of a working tree which dependencies are read from.
+DEPS_FILENAMES = (".gitmodules", "module_deps.json")
+
+
+def _stat_key(path: str):
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+class GraphIndex:
+  """Index of tree_id -> facts about the tree's dependencies.
+
+  Like RepoTreesConfig, instances are shared per file and are written (if
+  changed) when all are flushed at the end of a command. Read-only
+  repositories (i.e. of status and fix --dry-run) share instances which are
+  never written.
+  """
+  _instances = {}
+  _instances_lock = threading.Lock()
+
+  def __init__(self, index_file: str):
+    super().__init__()
+    self._index_file = index_file
+    self._dirty = False
+    self._lock = threading.Lock()
+    self._entries = {}
+    if os.path.isfile(index_file):
+      try:
+        self._entries = read_json_file(index_file)
+      except ValueError:
+        # Corrupt indexes are just rebuilt.
+        self._entries = {}
+
+  @classmethod
+  def for_file(cls, index_file: str, saved: bool = True) -> "GraphIndex":
+    """Gets the shared instance for an index file.
+
+    Args:
+      index_file: Path of the index file.
+      saved: Whether the instance is saved by flush_all().
+    """
+    key = (os.path.realpath(index_file), saved)
+    with cls._instances_lock:
+      instance = cls._instances.get(key)
+      if instance is None:
+        instance = cls(index_file)
+        cls._instances[key] = instance
+      return instance
+
+  @classmethod
+  def for_repo(cls, repo) -> "GraphIndex":
+    """Gets the shared instance for a repository.
+
+    >>> import glob
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> a = env.create_remote("a", json_deps=[{"url": x, "path": "deps/x"}])
+    >>> repo = env.init_repo("repo")
+    >>> _ = env.mmr(repo, "checkout", a)
+    >>> index_file = os.path.join(repo, ".mmrepo", "cache", INDEX_FILENAME)
+    >>> with open(index_file) as f:
+    ...   index_json = f.read()
+    >>> env.mmr(repo, "fix", "--all", "--dry-run").splitlines()
+    ['** 0 problems would be fixed']
+    >>> env.mmr(repo, "fix", "--all").splitlines()
+    ['** Fixed 0 problems']
+
+    Facts are recomputed after the tree changes, but only saved if not a dry
+    run:
+
+    >>> a_path, = glob.glob(repo + "/.mmrepo/universe/**/a.git", recursive=True)
+    >>> with open(os.path.join(a_path, "module_deps.json"), "a") as f:
+    ...   _ = f.write("\\n")
+    >>> _ = env.mmr(repo, "fix", "--all", "--dry-run")
+    >>> with open(index_file) as f:
+    ...   f.read() == index_json
+    True
+    >>> _ = env.mmr(repo, "fix", "--all")
+    >>> with open(index_file) as f:
+    ...   f.read() == index_json
+    False
+    >>> env.close()
+    """
+    return cls.for_file(os.path.join(repo.cache_dir, INDEX_FILENAME),
+                        saved=not repo.read_only)
+
+  @classmethod
+  def flush_all(cls):
+    """Saves all shared instances that have pending changes."""
+    with cls._instances_lock:
+      instances = [
+          instance for (_, saved), instance in cls._instances.items() if saved
+      ]
+    for instance in instances:
+      instance.save()
+
+  def save(self):
+    with self._lock:
+      if not self._dirty:
+        return
+      write_json_file(self._index_file, self._entries)
+      self._dirty = False
+
+  @staticmethod
+  def tree_key(tree):
+    """Computes the key of the current state of a tree (without running git).
+
+    Returns:
+      The key, or None if the tree is not checked out or has no HEAD commit.
+
+    >>> from mmrepo.repo import Repo
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> a = env.create_remote("a", json_deps=[{"url": x, "path": "deps/x"}])
+    >>> repo_path = env.init_repo("repo")
+    >>> _ = env.mmr(repo_path, "checkout", a)
+    >>> tree = Repo(repo_path).get_tree(a)
+    >>> index = GraphIndex(os.path.join(env.path, INDEX_FILENAME))
+    >>> key = GraphIndex.tree_key(tree)
+    >>> index.update(tree, key, skip_worktree_ok=True)
+    >>> index.lookup(tree, key)
+    {'skip_worktree_ok': True}
+    >>> index.save()
+    >>> GraphIndex(os.path.join(env.path, INDEX_FILENAME)).lookup(tree, key)
+    {'skip_worktree_ok': True}
+
+    Untracked files do not change the key, but the HEAD commit, the git
+    index and dependency files do:
+
+    >>> open(os.path.join(tree.path_in_repo, "untracked"), "w").close()
+    >>> GraphIndex.tree_key(tree) == key
+    True
+    >>> def changed(*git_args):
+    ...   global key
+    ...   env.git(tree.path_in_repo, *git_args)
+    ...   new_key = GraphIndex.tree_key(tree)
+    ...   is_changed = index.lookup(tree, new_key) is None
+    ...   key = new_key
+    ...   index.update(tree, key, skip_worktree_ok=True)
+    ...   return is_changed
+    >>> changed("commit", "--allow-empty", "-m", "Empty")
+    True
+    >>> changed("add", "untracked")
+    True
+    >>> with open(os.path.join(tree.path_in_repo, "module_deps.json"),
+    ...           "a") as f:
+    ...   _ = f.write(" ")
+    >>> changed("rev-parse", "HEAD")
+    True
+    >>> env.close()
+    """
+    path = tree.path_in_repo
+    git_dirs = find_git_dirs(path)
+    if git_dirs is None:
+      return None
+    git_dir, common_dir = git_dirs
+    head_commit = read_head_commit(git_dir, common_dir)
+    if head_commit is None:
+      return None
+    key = [head_commit, _stat_key(os.path.join(git_dir, "index"))]
+    for deps_filename in DEPS_FILENAMES:
+      key.append(_stat_key(os.path.join(path, deps_filename)))
+    return key
+
+  def lookup(self, tree, key):
+    """Gets the facts recorded for a tree at a key (or None)."""
+    if key is None:
+      return None
+    with self._lock:
+      entry = self._entries.get(tree.tree_id)
+      if entry is None or entry["key"] != key:
+        return None
+      return entry["facts"]
+
+  def update(self, tree, key, **facts):
+    """Records facts about a tree at a key, discarding any for other keys."""
+    if key is None:
+      return
+    with self._lock:
+      entry = self._entries.get(tree.tree_id)
+      if entry is None or entry["key"] != key:
+        entry = {"key": key, "facts": {}}
+        self._entries[tree.tree_id] = entry
+      for name, value in facts.items():
+        if entry["facts"].get(name) != value:
+          entry["facts"][name] = value
+          self._dirty = True
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
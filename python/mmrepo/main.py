@@ -14,12 +14,79 @@
 
 """Main entry-point."""
 
+import argparse
 import importlib
+import os
+import signal
 import sys
 
 from mmrepo.common import *
+from mmrepo.config import flush_configs
+from mmrepo.git import cancel_git_processes, configure_git_processes
+from mmrepo.graph_index import GraphIndex
+from mmrepo.parallel import positive_int
+from mmrepo import profiling
+from mmrepo import reporting
 from mmrepo.repo import *
 
+PROFILE_FILENAME = "profile.json"
+
+
+def create_argument_parser():
+  parser = argparse.ArgumentParser(prog="mmr", add_help=False)
+  parser.add_argument("--profile",
+                      dest="profile",
+                      action="store_true",
+                      help="Record the time taken by the command and each git "
+                      "process it runs, and print a summary")
+  parser.add_argument("--profile-output",
+                      dest="profile_output",
+                      default=None,
+                      help="File to write the profile to as a Chrome trace "
+                      "(implies --profile; default is "
+                      ".mmrepo/cache/{} in the repository)".format(
+                          PROFILE_FILENAME))
+  parser.add_argument("--verbose",
+                      "-v",
+                      dest="verbose",
+                      action="count",
+                      default=0,
+                      help="Show more detail (repeat to also show every git "
+                      "command)")
+  parser.add_argument("--quiet",
+                      "-q",
+                      dest="quiet",
+                      action="store_true",
+                      help="Only show warnings, errors and command output")
+  parser.add_argument("--log-format",
+                      dest="log_format",
+                      choices=["text", "json"],
+                      default="text",
+                      help="Format of events: text, or a line of JSON per "
+                      "event (default %(default)s)")
+  parser.add_argument("--no-progress",
+                      dest="progress",
+                      action="store_false",
+                      help="Do not show a live progress line")
+  parser.add_argument("--git-timeout",
+                      dest="git_timeout",
+                      type=float,
+                      default=None,
+                      help="Seconds after which git commands which use the "
+                      "network (clone, fetch, ls-remote) are killed and fail "
+                      "(default is no timeout)")
+  parser.add_argument("--max-git-processes",
+                      dest="max_git_processes",
+                      type=positive_int,
+                      default=None,
+                      help="Maximum number of git commands to run at once "
+                      "(default is no limit beyond --jobs)")
+  parser.add_argument("command", nargs="?", help="Command to execute")
+  parser.add_argument("args",
+                      nargs=argparse.REMAINDER,
+                      help="Arguments of the command")
+  return parser
+
 
 def exec_command(command: str, *args):
   norm_command = command.replace("-", "_")
@@ -27,23 +94,77 @@ def exec_command(command: str, *args):
     m = importlib.import_module("mmrepo.commands." + norm_command)
   except ImportError:
     raise UserError("Unknown command: {}", command)
-  m.exec(*args)
+  try:
+    with profiling.profile_span("mmr " + command, args=list(args)):
+      m.exec(*args)
+  finally:
+    # Config changes are batched in memory: write them once per command.
+    with profiling.profile_span("flush"):
+      flush_configs()
+      GraphIndex.flush_all()
+
+
+def default_profile_output() -> str:
+  try:
+    return os.path.join(Repo.find_from_cwd().cache_dir, PROFILE_FILENAME)
+  except UserError:
+    return os.path.join(os.getcwd(), "mmr-" + PROFILE_FILENAME)
+
+
+def report_profile(profiler: profiling.Profiler, profile_output):
+  profiler.stop()
+  reporting.output(profiler.format_summary(), event="profile")
+  if profile_output is None:
+    profile_output = default_profile_output()
+  profiler.write_trace(profile_output)
+  reporting.info("** Wrote profile trace to {}", profile_output)
+
+
+def log_level(args) -> int:
+  if args.quiet:
+    return reporting.WARNING
+  if args.verbose >= 2:
+    return reporting.DEBUG
+  if args.verbose == 1:
+    return reporting.DETAIL
+  return reporting.INFO
+
+
+def _interrupt(signum, frame):
+  # Kill git commands first: workers are waited for as the interrupt unwinds.
+  cancel_git_processes()
+  raise KeyboardInterrupt()
 
 
 def main():
-  _, *args = sys.argv
-  if not args:
-    print("Expected command to execute.")
+  args = create_argument_parser().parse_args(sys.argv[1:])
+  reporting.configure(level=log_level(args),
+                      json_format=args.log_format == "json",
+                      show_progress=args.progress)
+  configure_git_processes(network_timeout=args.git_timeout,
+                          max_processes=args.max_git_processes)
+  signal.signal(signal.SIGINT, _interrupt)
+  signal.signal(signal.SIGTERM, _interrupt)
+  if not args.command:
+    reporting.error("Expected command to execute.")
     exec_command("help")
     sys.exit(1)
 
-  command, *args = args
+  profiler = None
+  if args.profile or args.profile_output:
+    profiler = profiling.enable_profiling()
   try:
-    exec_command(command, *args)
+    exec_command(args.command, *args.args)
   except UserError as e:
-    print("ERROR:", e.message)
+    reporting.error("ERROR: {}", e.message, event="command_error")
     raise
     sys.exit(1)
+  except KeyboardInterrupt:
+    reporting.error("Interrupted", event="interrupted")
+    sys.exit(130)
+  finally:
+    if profiler is not None:
+      report_profile(profiler, args.profile_output)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Coordinates updates of trees in a shared local mirror.
+
+A local mirror may be shared by many workspaces (and processes). Each mirror
+tree has a lock file, which is held while cloning or fetching it, and a stamp
+file recording when it was last fetched. A request to update a tree:
+
+  * Is skipped if the tree was fetched within the mirror's fetch interval.
+  * Otherwise waits for the lock. If another client fetched the tree while
+    waiting, that fetch is used instead of starting a new one (so concurrent
+    requests coalesce onto the one in flight).
+"""
+
+import contextlib
+import fcntl
+import os
+import time
+
+from mmrepo.common import *
+from mmrepo import reporting
+
+__all__ = [
+    "MirrorManager",
+]
+
+MIRROR_CACHE_DIR = "mirror"
+LOCK_SUFFIX = ".lock"
+STAMP_SUFFIX = ".fetched"
+
+
+class MirrorManager:
+  """Clones and fetches trees of a local mirror repository."""
+
+  def __init__(self, mirror_repo):
+    super().__init__()
+    self._mirror_repo = mirror_repo
+
+  @property
+  def fetch_interval(self) -> float:
+    return self._mirror_repo.config.trees.mirror_fetch_interval
+
+  def _state_path(self, mirror_tree, suffix: str) -> str:
+    return os.path.join(self._mirror_repo.cache_dir, MIRROR_CACHE_DIR,
+                        mirror_tree.tree_id + suffix)
+
+  @contextlib.contextmanager
+  def lock(self, mirror_tree):
+    """Holds the exclusive (inter-process) lock for a mirror tree."""
+    lock_path = self._state_path(mirror_tree, LOCK_SUFFIX)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "a") as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+  def last_fetch_time(self, mirror_tree) -> float:
+    """Gets the time that a tree was last fetched (or 0 if unknown)."""
+    try:
+      return os.stat(self._state_path(mirror_tree, STAMP_SUFFIX)).st_mtime
+    except FileNotFoundError:
+      return 0
+
+  def _stamp(self, mirror_tree, fetch_time: float):
+    stamp_path = self._state_path(mirror_tree, STAMP_SUFFIX)
+    os.makedirs(os.path.dirname(stamp_path), exist_ok=True)
+    with open(stamp_path, "w"):
+      pass
+    os.utime(stamp_path, (fetch_time, fetch_time))
+
+  def _is_fresh(self, mirror_tree, requested_time: float) -> bool:
+    last_fetch_time = self.last_fetch_time(mirror_tree)
+    return (last_fetch_time >= requested_time or
+            requested_time - last_fetch_time < self.fetch_interval)
+
+  def update(self, mirror_tree, *, force: bool = False) -> bool:
+    """Makes sure that a mirror tree exists and is recently fetched.
+
+    Args:
+      mirror_tree: GitTreeRef in the mirror repository.
+      force: Fetch even if the tree was fetched within the fetch interval (a
+        fetch that started after this request is still reused).
+    Returns:
+      Whether this call cloned or fetched.
+
+    >>> import threading
+    >>> from mmrepo.repo import Repo
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> os.mkdir("mirror")
+    >>> mirror_repo = Repo.init(from_cwd="mirror", exact_path=True)
+    >>> mirror_repo.config.trees.bare_clone = True
+    >>> mirror_tree = mirror_repo.get_tree(x)
+    >>> manager = MirrorManager(mirror_repo)
+    >>> manager.update(mirror_tree)
+    Mirror tree does not exist. Cloning https://mmr.test/x.git
+    True
+
+    It is not fetched again within the fetch interval (unless forced):
+
+    >>> manager.update(mirror_tree)
+    False
+    >>> manager.update(mirror_tree, force=True)
+    True
+
+    A request waiting for the lock uses the fetch of the holder:
+
+    >>> results = []
+    >>> with manager.lock(mirror_tree):
+    ...   waiter = threading.Thread(
+    ...       target=lambda: results.append(
+    ...           manager.update(mirror_tree, force=True)))
+    ...   waiter.start()
+    ...   time.sleep(0.5)
+    ...   manager._stamp(mirror_tree, time.time())
+    >>> waiter.join()
+    >>> results
+    [False]
+    >>> env.close()
+    """
+    git = self._mirror_repo.git
+    path = mirror_tree.path_in_repo
+    requested_time = time.time()
+    # The stamp is only written once a clone completes, so a fresh stamp means
+    # that the tree can be used without looking at it (which could race with
+    # a clone in another process).
+    if not force and self._is_fresh(mirror_tree, requested_time):
+      return False
+    with self.lock(mirror_tree):
+      # Re-check now that no one else can be updating the tree.
+      if not git.is_git_repository(path):
+        reporting.info("Mirror tree does not exist. Cloning {}",
+                       mirror_tree.url)
+        start_time = time.time()
+        mirror_tree.clone()
+      else:
+        if self.last_fetch_time(mirror_tree) >= requested_time:
+          reporting.detail("Mirror tree {} was fetched concurrently",
+                           mirror_tree.url)
+          return False
+        if not force and self._is_fresh(mirror_tree, requested_time):
+          return False
+        start_time = time.time()
+        mirror_tree.fetch()
+      # Stamp with the start time: anything pushed after it may be missing.
+      self._stamp(mirror_tree, start_time)
+      return True
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod(optionflags=doctest.ELLIPSIS)
@@ -0,0 +1,84 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for running tree operations concurrently."""
+
+import argparse
+import concurrent.futures
+import os
+
+__all__ = [
+    "add_jobs_argument",
+    "create_executor",
+    "default_jobs",
+    "non_negative_int",
+    "positive_int",
+]
+
+# Most of the work fanned out is network or subprocess bound, so allow more
+# workers than cores, but keep it bounded to be polite to git hosts.
+MAX_DEFAULT_JOBS = 8
+
+
+def default_jobs() -> int:
+  """Returns the default number of concurrent jobs."""
+  return min(MAX_DEFAULT_JOBS, (os.cpu_count() or 1) * 2)
+
+
+def positive_int(value: str) -> int:
+  """Argument type of positive integers."""
+  try:
+    i = int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected an integer: {}".format(value))
+  if i < 1:
+    raise argparse.ArgumentTypeError("must be >= 1: {}".format(value))
+  return i
+
+
+def non_negative_int(value: str) -> int:
+  """Argument type of integers which are 0 or more."""
+  try:
+    i = int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected an integer: {}".format(value))
+  if i < 0:
+    raise argparse.ArgumentTypeError("must be >= 0: {}".format(value))
+  return i
+
+
+def add_jobs_argument(parser: argparse.ArgumentParser):
+  """Adds a standard --jobs/-j argument to a command parser."""
+  parser.add_argument("--jobs",
+                      "-j",
+                      dest="jobs",
+                      type=positive_int,
+                      default=default_jobs(),
+                      help="Number of concurrent jobs (default %(default)s)")
+
+
+class _Executor(concurrent.futures.ThreadPoolExecutor):
+  """Executor which drops queued work when its block exits with an error.
+
+  Otherwise (i.e. on an interrupt), all queued tree operations would still
+  run before the error propagates.
+  """
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.shutdown(wait=True, cancel_futures=exc_type is not None)
+    return False
+
+
+def create_executor(jobs: int) -> concurrent.futures.ThreadPoolExecutor:
+  """Creates a bounded executor for tree operations."""
+  return _Executor(max_workers=max(1, jobs), thread_name_prefix="mmr")
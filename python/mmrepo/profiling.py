@@ -0,0 +1,296 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Profiling of commands and the git processes that they run.
+
+Profiling is enabled for a whole command (with "mmr --profile"). While it is
+enabled, every git invocation made through GitExecutor and every query to a
+long-lived cat-file process is recorded, along with any spans that code
+opens with profile_span(). At the end of the command, the events are written
+as a Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev)
+and a summary is printed.
+
+When profiling is not enabled, the hooks do nothing.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+__all__ = [
+    "ProfileEvent",
+    "Profiler",
+    "disable_profiling",
+    "enable_profiling",
+    "get_profiler",
+    "profile_span",
+    "record_cat_file_query",
+    "record_process",
+]
+
+# Number of trees listed in the summary.
+SUMMARY_TOP_TREES = 10
+
+ProfileEvent = collections.namedtuple(
+    "ProfileEvent", "name,category,start,duration,thread,args")
+
+
+def git_subcommand(argv) -> str:
+  """Gets the git subcommand of an argument list.
+
+  >>> git_subcommand(["git", "-c", "a=b", "fetch", "origin"])
+  'fetch'
+  >>> git_subcommand(["git", "--no-pager", "log"])
+  'log'
+  >>> git_subcommand(["ls"])
+  'ls'
+  """
+  if not argv or os.path.basename(argv[0]) != "git":
+    return os.path.basename(argv[0]) if argv else "?"
+  i = 1
+  while i < len(argv):
+    arg = argv[i]
+    if arg in ("-c", "-C"):
+      i += 2
+    elif arg.startswith("-"):
+      i += 1
+    else:
+      return arg
+  return "git"
+
+
+def invocation_tree(argv, cwd: str) -> str:
+  """Gets the tree directory that a git invocation works on.
+
+  This is the working directory, except for clones, which run elsewhere.
+
+  >>> invocation_tree(["git", "clone", "url", "/ws/a", "--shared"], "/ws")
+  '/ws/a'
+  >>> invocation_tree(["git", "fetch"], "/ws/a")
+  '/ws/a'
+  """
+  if git_subcommand(argv) == "clone":
+    positional = [arg for arg in argv[2:] if not arg.startswith("-")]
+    if len(positional) >= 2:
+      return os.path.join(cwd, positional[1])
+  return cwd
+
+
+class Profiler:
+  """Collects profile events for a command."""
+
+  def __init__(self):
+    super().__init__()
+    self._lock = threading.Lock()
+    self._events = []
+    self._thread_names = {}
+    self._start_time = time.perf_counter()
+    self._end_time = None
+
+  def now(self) -> float:
+    return time.perf_counter()
+
+  def add_event(self, name: str, category: str, start: float,
+                duration: float, **args):
+    thread = threading.current_thread()
+    with self._lock:
+      self._thread_names.setdefault(thread.ident, thread.name)
+      self._events.append(
+          ProfileEvent(name=name,
+                       category=category,
+                       start=start - self._start_time,
+                       duration=duration,
+                       thread=thread.ident,
+                       args=args))
+
+  def stop(self):
+    if self._end_time is None:
+      self._end_time = time.perf_counter()
+
+  @property
+  def wall_time(self) -> float:
+    end_time = (self._end_time
+                if self._end_time is not None else time.perf_counter())
+    return end_time - self._start_time
+
+  @property
+  def events(self):
+    with self._lock:
+      return list(self._events)
+
+  def trace(self) -> dict:
+    """Gets the events in the Chrome trace event format."""
+    with self._lock:
+      events = list(self._events)
+      thread_names = dict(self._thread_names)
+    # Small thread ids read better than idents in trace viewers.
+    tids = {ident: i for i, ident in enumerate(thread_names)}
+    pid = os.getpid()
+    trace_events = []
+    for ident, name in thread_names.items():
+      trace_events.append({
+          "name": "thread_name",
+          "ph": "M",
+          "pid": pid,
+          "tid": tids[ident],
+          "args": {
+              "name": name
+          },
+      })
+    for event in events:
+      trace_events.append({
+          "name": event.name,
+          "cat": event.category,
+          "ph": "X",
+          "ts": round(event.start * 1e6),
+          "dur": round(event.duration * 1e6),
+          "pid": pid,
+          "tid": tids[event.thread],
+          "args": event.args,
+      })
+    return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+  def write_trace(self, trace_file: str):
+    os.makedirs(os.path.dirname(os.path.abspath(trace_file)), exist_ok=True)
+    with open(trace_file, "w") as f:
+      json.dump(self.trace(), f)
+
+  def _aggregate(self, key_fn):
+    """Aggregates git events into key -> [count, seconds, max, bytes, fails]."""
+    totals = collections.defaultdict(lambda: [0, 0.0, 0.0, 0, 0])
+    for event in self.events:
+      if event.category not in ("git", "cat-file"):
+        continue
+      total = totals[key_fn(event)]
+      total[0] += 1
+      total[1] += event.duration
+      total[2] = max(total[2], event.duration)
+      total[3] += event.args.get("output_bytes") or 0
+      if event.args.get("status", 0) != 0:
+        total[4] += 1
+    return sorted(totals.items(), key=lambda item: item[1][1], reverse=True)
+
+  def format_summary(self) -> str:
+    """Formats a summary table of where time was spent."""
+    lines = []
+    wall_time = self.wall_time
+    events = self.events
+    processes = [event for event in events if event.category == "git"]
+    queries = [event for event in events if event.category == "cat-file"]
+    lines.append(
+        "** Profile: {:.2f}s wall time, {} git processes ({:.2f}s), "
+        "{} cat-file queries ({:.2f}s)".format(
+            wall_time, len(processes),
+            sum(event.duration for event in processes), len(queries),
+            sum(event.duration for event in queries)))
+    header = "{:>6} {:>9} {:>9} {:>12} {:>6}".format("count", "total s",
+                                                     "max s", "out bytes",
+                                                     "failed")
+
+    def format_totals(total):
+      return "{:>6} {:>9.3f} {:>9.3f} {:>12} {:>6}".format(*total)
+
+    lines.append("By git subcommand:")
+    lines.append("  {:<24} {}".format("", header))
+    for key, total in self._aggregate(lambda event: event.name):
+      lines.append("  {:<24} {}".format(key, format_totals(total)))
+
+    by_tree = self._aggregate(lambda event: event.args["tree"])
+    lines.append("By tree (top {} of {}):".format(
+        min(SUMMARY_TOP_TREES, len(by_tree)), len(by_tree)))
+    lines.append("  {}  tree".format(header))
+    for key, total in by_tree[:SUMMARY_TOP_TREES]:
+      lines.append("  {}  {}".format(format_totals(total), key))
+    return "\n".join(lines)
+
+
+_profiler = None
+
+
+def enable_profiling() -> Profiler:
+  """Starts recording profile events (for the rest of the process)."""
+  global _profiler
+  _profiler = Profiler()
+  return _profiler
+
+
+def disable_profiling():
+  global _profiler
+  _profiler = None
+
+
+def get_profiler():
+  """Gets the active Profiler, or None if profiling is not enabled."""
+  return _profiler
+
+
+@contextlib.contextmanager
+def profile_span(name: str, category: str = "mmr", **args):
+  """Records the time taken by a block of code."""
+  profiler = _profiler
+  if profiler is None:
+    yield
+    return
+  start = profiler.now()
+  try:
+    yield
+  finally:
+    profiler.add_event(name, category, start, profiler.now() - start, **args)
+
+
+def record_process(argv, cwd: str, start: float, status, output_bytes):
+  """Records a completed git process.
+
+  Args:
+    argv: Command line of the process.
+    cwd: Directory that it ran in.
+    start: time.perf_counter() when it was started.
+    status: Exit status, or None if it could not be run.
+    output_bytes: Size of its captured output (None if not captured).
+  """
+  profiler = _profiler
+  if profiler is None:
+    return
+  profiler.add_event(git_subcommand(argv),
+                     "git",
+                     start,
+                     profiler.now() - start,
+                     argv=list(argv),
+                     cwd=cwd,
+                     tree=invocation_tree(argv, cwd),
+                     status=status,
+                     output_bytes=output_bytes)
+
+
+def record_cat_file_query(repository: str, batch_arg: str, start: float,
+                          found: bool, output_bytes):
+  """Records a query to a long-lived cat-file process."""
+  profiler = _profiler
+  if profiler is None:
+    return
+  profiler.add_event("cat-file " + batch_arg,
+                     "cat-file",
+                     start,
+                     profiler.now() - start,
+                     cwd=repository,
+                     tree=repository,
+                     found=found,
+                     output_bytes=output_bytes)
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,526 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Retry, timeout and circuit breaker policy for requests to remote hosts.
+
+Git hosts under load intermittently throttle or drop connections, which
+should not fail a large checkout wholesale. Git commands which use the network
+(clone, fetch and ls-remote of a remote URL) are run with the policy of the
+remote's host:
+
+  * Transient failures (timeouts, dropped connections, HTTP 429 and 5xx) are
+    retried with exponential backoff and jitter. Other failures (i.e. a
+    missing repository or commit) are reported immediately.
+  * Commands are killed after the policy's timeout (which defaults to that of
+    "mmr --git-timeout").
+  * A circuit breaker per host stops contacting it after a number of
+    consecutive transient failures: requests fail immediately until the
+    breaker resets, after which a single request probes whether the host has
+    recovered.
+
+Breakers and statistics are kept for the whole process, so that they are
+shared by all repositories (i.e. a repository and its local mirror).
+"""
+
+import collections
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+from mmrepo.common import *
+from mmrepo import reporting
+
+__all__ = [
+    "ANY_HOST",
+    "CircuitBreaker",
+    "DEFAULT_REMOTE_POLICY",
+    "RemotePolicy",
+    "RemoteStats",
+    "backoff_delay",
+    "call_remote",
+    "is_transient_error",
+    "remote_host",
+    "remote_stats",
+    "report_remote_stats",
+    "resolve_remote_policy",
+]
+
+RemotePolicy = collections.namedtuple(
+    "RemotePolicy",
+    "retries,backoff,max_backoff,jitter,timeout,failure_threshold,reset_after")
+
+# retries: Times to retry a request which failed transiently.
+# backoff: Seconds to wait before the first retry (doubling for each retry).
+# max_backoff: Maximum seconds to wait before a retry.
+# jitter: Fraction of each wait which is randomized (so that concurrent
+#   requests do not retry in lockstep).
+# timeout: Seconds after which a git command is killed (None for the
+#   default, see configure_git_processes).
+# failure_threshold: Consecutive transient failures after which the circuit
+#   breaker of the host opens (0 to never open it).
+# reset_after: Seconds for which an open circuit breaker rejects requests.
+DEFAULT_REMOTE_POLICY = RemotePolicy(retries=2,
+                                     backoff=1.0,
+                                     max_backoff=30.0,
+                                     jitter=0.5,
+                                     timeout=None,
+                                     failure_threshold=5,
+                                     reset_after=60.0)
+
+# Key of the remote_policies setting which applies to all hosts.
+ANY_HOST = "*"
+
+# Git errors which mean that the remote understood, and refused, the request.
+_PERMANENT_ERROR_PAT = re.compile(
+    r"not found|not our ref|couldn't find remote ref|unadvertised object|"
+    r"does not appear to be a git repository|Permission denied|"
+    r"Authentication failed|returned error: 40[0-4]", re.IGNORECASE)
+# Git errors which are worth retrying.
+_TRANSIENT_ERROR_PAT = re.compile(
+    r"returned error: (429|5\d\d)|RPC failed|early EOF|"
+    r"the remote end hung up unexpectedly|unexpected disconnect|"
+    r"Connection (reset|refused|timed out|closed)|Operation timed out|"
+    r"Could not resolve host|Temporary failure in name resolution|"
+    r"SSL_ERROR|GnuTLS|TLS connection|"
+    r"remote: .*(try again|rate limit|too many requests|unavailable)",
+    re.IGNORECASE)
+
+
+def remote_host(url: str):
+  """Gets the host of a remote URL, or None if it is a local repository.
+
+  >>> remote_host("https://user@Git.Example.com:8443/a/b.git")
+  'git.example.com'
+  >>> remote_host("git@example.com:a/b.git")
+  'example.com'
+  >>> remote_host("ssh://git@example.com:29418/a/b")
+  'example.com'
+  >>> [remote_host(url) for url in ["/src/a.git", "../a", "file:///src/a"]]
+  [None, None, None]
+  """
+  if "://" in url:
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "file":
+      return None
+    return parts.hostname
+  # Like git, scp-like syntax is a colon before any slash.
+  match = re.match(r"^(?:[^@/]+@)?([^:/]+):", url)
+  if match is None:
+    return None
+  return match.group(1).lower()
+
+
+def resolve_remote_policy(settings, host: str) -> RemotePolicy:
+  """Resolves the policy of a host from the remote_policies setting.
+
+  The setting maps hosts (or ANY_HOST) to dicts of RemotePolicy fields.
+  Fields which are not set for a host are taken from ANY_HOST, then from
+  DEFAULT_REMOTE_POLICY.
+
+  >>> settings = {"*": {"retries": 4}, "Git.Example.com": {"timeout": 600}}
+  >>> policy = resolve_remote_policy(settings, "git.example.com")
+  >>> policy.retries, policy.timeout, policy.backoff
+  (4, 600, 1.0)
+  >>> resolve_remote_policy(settings, "other.com").timeout is None
+  True
+  >>> resolve_remote_policy({"*": {"retry": 1}}, "other.com")
+  Traceback (most recent call last):
+  ...
+  mmrepo.common.UserError: Unknown remote policy setting 'retry' for '*' (expected one of retries, backoff, max_backoff, jitter, timeout, failure_threshold, reset_after)
+  """
+  fields = {}
+  for key in (ANY_HOST, host):
+    for settings_host, host_settings in settings.items():
+      if settings_host.lower() != key:
+        continue
+      for name, value in host_settings.items():
+        if name not in RemotePolicy._fields:
+          raise UserError(
+              "Unknown remote policy setting '{}' for '{}' (expected one "
+              "of {})", name, settings_host, ", ".join(RemotePolicy._fields))
+        fields[name] = value
+  return DEFAULT_REMOTE_POLICY._replace(**fields)
+
+
+def backoff_delay(policy: RemotePolicy, attempt: int, rand=random.random):
+  """Gets the seconds to wait after a failed attempt (numbered from 1).
+
+  >>> policy = DEFAULT_REMOTE_POLICY._replace(backoff=2.0, max_backoff=10.0)
+  >>> [backoff_delay(policy, attempt, lambda: 0.0) for attempt in (1, 2, 3, 4)]
+  [2.0, 4.0, 8.0, 10.0]
+  >>> backoff_delay(policy, 2, lambda: 1.0)
+  2.0
+  """
+  delay = min(policy.max_backoff, policy.backoff * 2**(attempt - 1))
+  return delay * (1.0 - policy.jitter * rand())
+
+
+def is_transient_error(error: UserError) -> bool:
+  """Whether a failed request is worth retrying.
+
+  Only what git wrote to stderr is matched: the message also has the command
+  and its directory, whose URLs and paths can contain anything. The exit
+  status does not tell (git exits with 128 on all fatal errors).
+
+  >>> def git_error(url, stderr):
+  ...   return GitCommandError("Error executing command:\\n  cd /src\\n"
+  ...                          "  git fetch {}\\n{}", url, stderr,
+  ...                          status=128, stderr=stderr)
+  >>> is_transient_error(git_error("https://h/a", "fatal: unable to access "
+  ...                              "'https://h/a/': The requested URL "
+  ...                              "returned error: 503"))
+  True
+  >>> is_transient_error(git_error("https://h/a",
+  ...                              "fatal: couldn't find remote ref abc"))
+  False
+  >>> is_transient_error(git_error("https://h/ssl_error_handling.git",
+  ...                              "fatal: bad object abc"))
+  False
+  >>> is_transient_error(GitTimeoutError("Timed out"))
+  True
+  >>> is_transient_error(UserError("Cancelled command: early EOF"))
+  False
+  """
+  if isinstance(error, GitTimeoutError):
+    return True
+  if not isinstance(error, GitCommandError):
+    # i.e. cancelled commands and open circuit breakers.
+    return False
+  if _PERMANENT_ERROR_PAT.search(error.stderr):
+    return False
+  return _TRANSIENT_ERROR_PAT.search(error.stderr) is not None
+
+
+def _error_summary(error: UserError) -> str:
+  """Gets the line of a transient error which gives the reason.
+
+  >>> stderr = ("ssh: connect to host h: Connection reset by peer\\n"
+  ...           "fatal: Could not read from remote repository.")
+  >>> _error_summary(GitCommandError("Error executing command:\\n  cd /\\n{}",
+  ...                                stderr,
+  ...                                stderr=stderr))
+  'ssh: connect to host h: Connection reset by peer'
+  >>> _error_summary(GitTimeoutError("Timed out after 5s executing command:"))
+  'Timed out after 5s executing command'
+  """
+  if isinstance(error, GitTimeoutError):
+    return error.message.splitlines()[0].rstrip(":")
+  output = error.stderr if isinstance(error, GitCommandError) else ""
+  lines = [line.strip() for line in output.splitlines() if line.strip()]
+  if not lines:
+    return "unknown error"
+  for line in lines:
+    if _TRANSIENT_ERROR_PAT.search(line):
+      return line
+  return lines[-1]
+
+
+class CircuitBreaker:
+  """Stops requests to a host after consecutive transient failures.
+
+  While closed, requests are made. After failure_threshold consecutive
+  failures, the breaker opens and requests fail with CircuitOpenError for
+  reset_after seconds. Then it lets a single request through: if that
+  succeeds the breaker closes, otherwise it opens again.
+  """
+
+  def __init__(self, host: str, clock=time.monotonic):
+    super().__init__()
+    self.host = host
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._failures = 0
+    self._opened_at = None
+    self._probing = False
+
+  @property
+  def is_open(self) -> bool:
+    return self._opened_at is not None
+
+  def before_request(self, policy: RemotePolicy) -> bool:
+    """Checks that a request may be made.
+
+    Returns:
+      Whether the request probes the host (after the breaker was open).
+    Raises:
+      CircuitOpenError if the breaker is open.
+    """
+    with self._lock:
+      if self._opened_at is None:
+        return False
+      remaining = self._opened_at + policy.reset_after - self._clock()
+      if remaining > 0 or self._probing:
+        raise CircuitOpenError(
+            "Not contacting {} after {} consecutive failures (retrying "
+            "in {:.0f}s)", self.host, self._failures, max(0, remaining))
+      self._probing = True
+      return True
+
+  def cancel_probe(self):
+    """Records that a probe ended without an outcome (i.e. interrupted).
+
+    The breaker stays open, and the next request after reset_after probes the
+    host instead:
+
+    >>> policy = DEFAULT_REMOTE_POLICY._replace(retries=0,
+    ...                                         failure_threshold=1,
+    ...                                         reset_after=0)
+    >>> def fail(error):
+    ...   def request():
+    ...     raise error
+    ...   return request
+    >>> call_remote("probe.test", policy, "Fetch",
+    ...             fail(GitTimeoutError("Timed out")), wait=lambda _: False)
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.GitTimeoutError: Timed out
+    >>> call_remote("probe.test", policy, "Fetch",
+    ...             fail(OSError("Too many open files")),
+    ...             wait=lambda _: False)
+    Traceback (most recent call last):
+    ...
+    OSError: Too many open files
+    >>> call_remote("probe.test", policy, "Fetch", lambda: "fetched",
+    ...             wait=lambda _: False)
+    'fetched'
+    """
+    with self._lock:
+      self._probing = False
+
+  def record_success(self):
+    """Records that the host responded (even if refusing the request)."""
+    with self._lock:
+      self._failures = 0
+      self._opened_at = None
+      self._probing = False
+
+  def record_failure(self, policy: RemotePolicy) -> bool:
+    """Records a transient failure.
+
+    Returns:
+      Whether the breaker opened as a result.
+
+    >>> now = [0.0]
+    >>> breaker = CircuitBreaker("h", clock=lambda: now[0])
+    >>> policy = DEFAULT_REMOTE_POLICY._replace(failure_threshold=2,
+    ...                                         reset_after=10)
+    >>> breaker.record_failure(policy), breaker.record_failure(policy)
+    (False, True)
+    >>> breaker.before_request(policy)
+    Traceback (most recent call last):
+    ...
+    mmrepo.common.CircuitOpenError: Not contacting h after 2 consecutive failures (retrying in 10s)
+    >>> now[0] = 11.0
+    >>> breaker.before_request(policy)  # Probes the host.
+    True
+    >>> breaker.record_success()
+    >>> breaker.is_open
+    False
+    """
+    with self._lock:
+      self._failures += 1
+      probing = self._probing
+      self._probing = False
+      if not policy.failure_threshold:
+        return False
+      if not probing and (self._opened_at is not None or
+                          self._failures < policy.failure_threshold):
+        return False
+      self._opened_at = self._clock()
+      return True
+
+
+class RemoteStats:
+  """Counts of requests to a host."""
+
+  _COUNTERS = ("requests", "attempts", "retries", "failed", "timeouts",
+               "trips", "rejected")
+
+  def __init__(self):
+    super().__init__()
+    for counter in self._COUNTERS:
+      setattr(self, counter, 0)
+
+  def as_dict(self) -> dict:
+    return {counter: getattr(self, counter) for counter in self._COUNTERS}
+
+  @property
+  def had_errors(self) -> bool:
+    return bool(self.retries or self.failed)
+
+  def format(self) -> str:
+    """Formats the counts for humans.
+
+    >>> stats = RemoteStats()
+    >>> stats.requests, stats.attempts, stats.retries = 12, 14, 2
+    >>> stats.format()
+    '12 requests, 2 retries'
+    >>> stats.failed, stats.trips, stats.rejected = 3, 1, 2
+    >>> stats.format()
+    '12 requests, 2 retries, 3 failed, circuit breaker opened 1 times (2 requests rejected)'
+    """
+    parts = ["{} requests".format(self.requests)]
+    if self.retries:
+      parts.append("{} retries".format(self.retries))
+    if self.timeouts:
+      parts.append("{} timed out".format(self.timeouts))
+    if self.failed:
+      parts.append("{} failed".format(self.failed))
+    if self.trips:
+      parts.append(
+          "circuit breaker opened {} times ({} requests rejected)".format(
+              self.trips, self.rejected))
+    return ", ".join(parts)
+
+
+# host -> (CircuitBreaker, RemoteStats), for the whole process.
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+
+def _host_state(host: str):
+  with _hosts_lock:
+    state = _hosts.get(host)
+    if state is None:
+      state = (CircuitBreaker(host), RemoteStats())
+      _hosts[host] = state
+    return state
+
+
+def _count(stats: RemoteStats, **counts):
+  with _hosts_lock:
+    for counter, count in counts.items():
+      setattr(stats, counter, getattr(stats, counter) + count)
+
+
+def call_remote(host: str, policy: RemotePolicy, description: str, request,
+                wait):
+  """Makes a request to a remote host, with the host's policy.
+
+  Args:
+    host: The remote host.
+    policy: The RemotePolicy of the host.
+    description: Description of the request for messages (i.e. "fetch of
+      <url>").
+    request: Function which makes the request, raising UserError if it fails.
+    wait: Function of seconds which waits before a retry, returning True if
+      the wait was interrupted (i.e. by cancellation).
+  Returns:
+    The result of the request.
+
+  When the retries run out, the error of the last attempt is raised with a
+  note of the attempts:
+
+  >>> policy = DEFAULT_REMOTE_POLICY._replace(retries=1, backoff=0.5,
+  ...                                         jitter=0.0)
+  >>> def request():
+  ...   raise GitCommandError("Error executing command:\\n{}", stderr,
+  ...                         status=128, stderr=stderr)
+  >>> stderr = "fatal: unable to access 'https://h/a': Connection timed out"
+  >>> try:
+  ...   call_remote("retry.test", policy, "Fetch", request, lambda _: False)
+  ... except GitCommandError as e:
+  ...   error = e
+  Fetch failed (fatal: unable to access 'https://h/a': Connection timed out); retrying in 0.5s (attempt 2 of 2)
+  >>> print(error.message)
+  Error executing command:
+  fatal: unable to access 'https://h/a': Connection timed out
+  (Gave up after 2 attempts)
+  >>> error.status, error.stderr == stderr
+  (128, True)
+  """
+  breaker, stats = _host_state(host)
+  _count(stats, requests=1)
+  attempt = 0
+  while True:
+    attempt += 1
+    try:
+      probing = breaker.before_request(policy)
+    except CircuitOpenError:
+      _count(stats, failed=1, rejected=1)
+      raise
+    _count(stats, attempts=1)
+    try:
+      result = request()
+    except UserError as e:
+      if not is_transient_error(e):
+        # The host is up, it refused the request.
+        breaker.record_success()
+        _count(stats, failed=1)
+        raise
+      if isinstance(e, GitTimeoutError):
+        _count(stats, timeouts=1)
+      if breaker.record_failure(policy):
+        _count(stats, trips=1)
+        reporting.warning(
+            "Circuit breaker opened for {}: not contacting it for {}s",
+            host,
+            policy.reset_after,
+            event="circuit_open",
+            host=host)
+      if attempt > policy.retries or breaker.is_open:
+        _count(stats, failed=1)
+        if attempt == 1:
+          raise
+        e.args = ("{}\n(Gave up after {} attempts)".format(
+            e.message, attempt),) + e.args[1:]
+        raise
+      delay = backoff_delay(policy, attempt)
+      reporting.warning("{} failed ({}); retrying in {:.1f}s (attempt {} "
+                        "of {})",
+                        description,
+                        _error_summary(e),
+                        delay,
+                        attempt + 1,
+                        policy.retries + 1,
+                        event="remote_retry",
+                        host=host)
+      _count(stats, retries=1)
+      if wait(delay):
+        raise UserError("Cancelled {}", description) from None
+      continue
+    except BaseException:
+      # Not a response of the host (i.e. an interrupt or a bug).
+      if probing:
+        breaker.cancel_probe()
+      raise
+    breaker.record_success()
+    return result
+
+
+def remote_stats():
+  """Gets a dict of host -> RemoteStats of requests made by this process."""
+  with _hosts_lock:
+    return {host: stats for host, (_, stats) in _hosts.items()}
+
+
+def report_remote_stats():
+  """Reports the requests made to each remote host.
+
+  Hosts which had errors are reported at the INFO level, others at DETAIL.
+  """
+  for host, stats in sorted(remote_stats().items()):
+    reporting.log(reporting.INFO if stats.had_errors else reporting.DETAIL,
+                  "** Remote host {}: {}",
+                  host,
+                  stats.format(),
+                  event="remote_stats",
+                  host=host,
+                  **stats.as_dict())
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
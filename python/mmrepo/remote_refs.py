@@ -0,0 +1,115 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cached and concurrent lookup of refs advertised by remotes."""
+
+from typing import Dict, Optional, Sequence
+import os
+import time
+
+from mmrepo.common import *
+from mmrepo.config import *
+from mmrepo.parallel import *
+
+__all__ = [
+    "RemoteRefsCache",
+    "lookup_remote_refs",
+]
+
+CACHE_FILENAME = "remote_refs.json"
+DEFAULT_TTL_SECONDS = 300
+
+
+class RemoteRefsCache:
+  """An on-disk cache of `git ls-remote` results, keyed by remote URL.
+
+  Entries older than the TTL are ignored.
+  """
+
+  def __init__(self, cache_file: str, ttl: float = DEFAULT_TTL_SECONDS):
+    super().__init__()
+    self._cache_file = cache_file
+    self._ttl = ttl
+    self._dirty = False
+    self._contents = {}
+    if os.path.isfile(cache_file):
+      try:
+        self._contents = read_json_file(cache_file)
+      except ValueError:
+        # Corrupt caches are just discarded.
+        self._contents = {}
+
+  @classmethod
+  def for_repo(cls, repo, ttl: float = DEFAULT_TTL_SECONDS):
+    return cls(os.path.join(repo.cache_dir, CACHE_FILENAME), ttl=ttl)
+
+  def get(self, url: str) -> Optional[Dict[str, str]]:
+    """Gets the cached refs for a URL if present and not expired."""
+    entry = self._contents.get(url)
+    if entry is None:
+      return None
+    if time.time() - entry["time"] > self._ttl:
+      return None
+    return entry["refs"]
+
+  def put(self, url: str, refs: Dict[str, str]):
+    self._contents[url] = {"time": time.time(), "refs": refs}
+    self._dirty = True
+
+  def save(self):
+    if not self._dirty:
+      return
+    write_json_file(self._cache_file, self._contents)
+    self._dirty = False
+
+
+def lookup_remote_refs(repo,
+                       urls: Sequence[str],
+                       *,
+                       jobs: int = None,
+                       refresh: bool = False,
+                       ttl: float = DEFAULT_TTL_SECONDS):
+  """Looks up the refs of a number of remotes.
+
+  Each distinct URL is queried at most once, concurrently, and results are
+  served from (and stored to) the repository's ref cache unless refresh is
+  True.
+
+  Returns:
+    Dict of url -> {ref: commit}.
+  """
+  cache = RemoteRefsCache.for_repo(repo, ttl=ttl)
+  results = dict()
+  missing_urls = []
+  for url in urls:
+    if url in results or url in missing_urls:
+      continue
+    refs = None if refresh else cache.get(url)
+    if refs is None:
+      missing_urls.append(url)
+    else:
+      results[url] = refs
+
+  if not missing_urls:
+    return results
+  try:
+    with create_executor(jobs or default_jobs()) as executor:
+      futures = [(url, executor.submit(repo.git.ls_remote, url))
+                 for url in missing_urls]
+      for url, future in futures:
+        refs = future.result()
+        cache.put(url, refs)
+        results[url] = refs
+  finally:
+    cache.save()
+  return results
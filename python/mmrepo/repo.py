@@ -13,40 +13,155 @@
 # limitations under the License.
 """Overall repository management."""
 
-from typing import Optional
+from typing import Optional, Sequence
+from collections import namedtuple
+import collections
 import os
 
 from mmrepo.common import *
 from mmrepo.config import *
 from mmrepo import fileutils
 from mmrepo.git import *
+from mmrepo.graph_index import *
+from mmrepo.mirror import *
+from mmrepo import reporting
 
 MMREPO_DIR = ".mmrepo"
 UNIVERSE_DIR = "universe"
+CACHE_DIR = "cache"
 DEFAULT_WORKING_TREE = "defaultwt"
+# Kinds of DepProblem.
+NOT_LINKED = "not linked"
+NOT_SKIP_WORKTREE = "not skip-worktree"
+GIT_TREE_ID_PREFIX = "git/"
+# Clone options which can be set for the repository (in RepoTreesConfig) and
+# overridden per tree.
+CLONE_OPTIONS = ("clone_filter", "clone_depth", "single_branch")
+# When a commit is missing from a shallow clone, it is deepened by this factor
+# of the clone depth (compounded) a few times before fetching all history.
+DEEPEN_FACTOR = 10
+MAX_DEEPEN_STEPS = 3
+ROOT_URL_SPEC = "__root__"
+# Default of GitTreeRef.apply_sparse_checkout(), where None is meaningful.
+_FROM_DEPENDENTS = object()
 
 __all__ = [
     "BaseTreeRef",
+    "DepProblem",
     "GitTreeRef",
     "Repo",
 ]
 
 
+class DepProblem(namedtuple("DepProblem", "kind,path,dep_tree")):
+  """A dependency of a tree which is not set up as expected.
+
+  Either a link (at the absolute path) which does not point at the dep_tree
+  (NOT_LINKED), or a submodule path (relative to the tree) which is not
+  skip-worktree (NOT_SKIP_WORKTREE).
+  """
+
+
 class Repo:
-  """Represents an on-disk repository."""
+  """Represents an on-disk repository.
 
-  def __init__(self, path: str):
+  A read-only repository (for commands which only report, like status) does
+  not add the trees that it first sees as dependencies to the config, does
+  not migrate tree ids in the config and does not save its graph index.
+  """
+
+  def __init__(self, path: str, read_only: bool = False):
     super().__init__()
     self._path = os.path.realpath(path)
-    self._git = GitExecutor()
+    self._read_only = read_only
     self._config = RepoConfig(self.mmrepo_dir)
+    self._git = GitExecutor(remote_policy=self._config.trees.remote_policy)
+    # Guards mutation of the trees config, which can happen from worker
+    # threads when trees are checked out concurrently.
+    self._config_lock = self._config.trees.lock
+    self._local_mirror_repo = None
+    # (path, Repo or None) of the reference repository, as last looked up.
+    self._reference_repo = None
+    # Identity map of tree_id -> tree, so that each tree is a single long-lived
+    # object (which caches its dependencies).
+    self._trees = dict()
+    # Memo of url -> tree_id.
+    self._url_tree_ids = dict()
+    # Tree ids of the config which are not canonical -> canonical tree id, and
+    # the reverse (only in read-only repositories, which do not migrate them).
+    self._renamed_tree_ids = dict()
+    self._config_tree_ids = dict()
+    # Sparse-checkout requests, as dep tree -> {dependent: [directories]},
+    # built on first use and updated as dependents change (see
+    # sparse_requests_for()).
+    self._sparse_requests = None
+    # dependent -> dep trees that it has requests for.
+    self._sparse_request_deps = dict()
+    self._migrate_tree_ids()
 
   @property
   def local_mirror_repo(self) -> Optional["Repo"]:
     local_mirror_path = self._config.trees.local_mirror_path
     if local_mirror_path is None:
       return None
-    return Repo(local_mirror_path)
+    # Cache the instance so that concurrent clones share its config lock.
+    with self._config_lock:
+      if self._local_mirror_repo is None:
+        self._local_mirror_repo = Repo(local_mirror_path,
+                                       read_only=self._read_only)
+      return self._local_mirror_repo
+
+  @property
+  def reference_repo(self) -> Optional["Repo"]:
+    """Gets the repository whose trees are referenced by clones, if any.
+
+    It is only read, so (unlike a local mirror) its config is never changed,
+    even if it has tree ids written by older versions:
+
+    >>> import glob, json
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> reference_path = env.init_repo("reference")
+    >>> _ = env.mmr(reference_path, "checkout", x)
+    >>> trees_file = os.path.join(reference_path, ".mmrepo", "config",
+    ...                           "trees.json")
+    >>> with open(trees_file) as f:
+    ...   trees = json.load(f)
+    >>> trees["trees"] = {"git/" + d["url"]: d for d in trees["trees"].values()}
+    >>> trees["aliases"] = {"x": "git/" + x}
+    >>> with open(trees_file, "w") as f:
+    ...   json.dump(trees, f)
+    >>> with open(trees_file) as f:
+    ...   trees_json = f.read()
+    >>> repo = Repo(env.init_repo("repo"))
+    >>> repo.config.trees.reference_repo = reference_path
+    >>> tree = repo.get_tree(x)
+    >>> x_path, = glob.glob(reference_path + "/.mmrepo/universe/**/x.git",
+    ...                     recursive=True)
+    >>> tree.clone_args == ["--reference-if-able", x_path]
+    True
+    >>> repo.reference_repo is repo.reference_repo
+    True
+    >>> repo.reference_repo.read_only
+    True
+    >>> from mmrepo.config import RepoTreesConfig
+    >>> RepoTreesConfig.flush_all()
+    >>> with open(trees_file) as f:
+    ...   f.read() == trees_json
+    True
+    >>> env.close()
+    """
+    reference_repo_path = self._config.trees.reference_repo
+    if not reference_repo_path:
+      return None
+    with self._config_lock:
+      if (self._reference_repo is None or
+          self._reference_repo[0] != reference_repo_path):
+        self._reference_repo = (reference_repo_path,
+                                Repo.find_existing(reference_repo_path,
+                                                   read_only=True))
+      return self._reference_repo[1]
 
   @property
   def config(self) -> RepoConfig:
@@ -56,6 +171,65 @@ class Repo:
   def path(self) -> str:
     return self._path
 
+  @property
+  def read_only(self) -> bool:
+    """Whether trees first seen as dependencies are kept out of the config.
+
+    >>> import glob, json
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> y = env.create_remote("y")
+    >>> a = env.create_remote("a", json_deps=[{"url": x, "path": "deps/x"}])
+    >>> repo = env.init_repo("repo")
+    >>> _ = env.mmr(repo, "checkout", a)
+
+    A dependency which is not checked out yet (i.e. after a pull):
+
+    >>> a_path, = glob.glob(repo + "/.mmrepo/universe/**/a.git", recursive=True)
+    >>> deps_file = os.path.join(a_path, "module_deps.json")
+    >>> with open(deps_file) as f:
+    ...   deps = json.load(f)
+    >>> deps["deps"].append({"url": y, "path": "deps/y",
+    ...                      "version": env.head(y)})
+    >>> with open(deps_file, "w") as f:
+    ...   json.dump(deps, f)
+    >>> trees_file = os.path.join(repo, ".mmrepo", "config", "trees.json")
+    >>> with open(trees_file) as f:
+    ...   trees_json = f.read()
+    >>> json.loads(env.mmr(repo, "status", "--json"))[0]["dep_problems"]
+    ['not linked: deps/y']
+    >>> env.mmr(repo, "fix", "--all", "--dry-run").splitlines()[-1]
+    '** 1 problems would be fixed'
+    >>> with open(trees_file) as f:
+    ...   f.read() == trees_json
+    True
+
+    Tree ids which are not canonical (i.e. written by older versions) are
+    only resolved in memory:
+
+    >>> with open(trees_file) as f:
+    ...   trees = json.load(f)
+    >>> old_ids = {tree_id: "git/" + d["url"]
+    ...            for tree_id, d in trees["trees"].items()}
+    >>> trees["trees"] = {old_ids[tree_id]: d
+    ...                   for tree_id, d in trees["trees"].items()}
+    >>> trees["aliases"] = {alias: old_ids[tree_id]
+    ...                     for alias, tree_id in trees["aliases"].items()}
+    >>> with open(trees_file, "w") as f:
+    ...   json.dump(trees, f)
+    >>> with open(trees_file) as f:
+    ...   trees_json = f.read()
+    >>> [status["dep_problems"]
+    ...  for status in json.loads(env.mmr(repo, "status", "--json"))]
+    [['not linked: deps/y'], []]
+    >>> with open(trees_file) as f:
+    ...   f.read() == trees_json
+    True
+    >>> env.close()
+    """
+    return self._read_only
+
   @property
   def universe_dir(self) -> str:
     return os.path.join(self._path, MMREPO_DIR, UNIVERSE_DIR)
@@ -64,22 +238,30 @@ class Repo:
   def mmrepo_dir(self) -> str:
     return os.path.join(self._path, MMREPO_DIR)
 
+  @property
+  def cache_dir(self) -> str:
+    """Directory for disposable, locally cached state."""
+    return os.path.join(self._path, MMREPO_DIR, CACHE_DIR)
+
   @property
   def git(self) -> GitExecutor:
     return self._git
 
+  @property
+  def graph_index(self) -> GraphIndex:
+    return GraphIndex.for_repo(self)
+
   def tree_from_cwd(self, cwd=None):
     """Gets the tree from a current working directory."""
     if cwd is None:
       cwd = os.getcwd()
     toplevel = self.git.find_git_toplevel(cwd)
     annotation = GitConfigAnnotation.from_git_root(toplevel)
-    existing_dict = self._config.trees.get_tree_by_id(annotation.tree_id)
-    if existing_dict is None:
+    tree = self.tree_from_id(annotation.tree_id)
+    if tree is None:
       raise UserError(
           "The directory does not seem to be an MMR managed git tree: {}", cwd)
-    tree = BaseTreeRef.from_dict(self, d=existing_dict)
-    print("Found tree for cwd:", tree)
+    reporting.detail("Found tree for cwd: {}", tree)
     return tree
 
   def tree_from_alias(self, alias):
@@ -90,25 +272,119 @@ class Repo:
     return self.tree_from_id(tree_id)
 
   def tree_from_id(self, tree_id):
-    tree_info = self.config.trees.tree_dicts.get(tree_id)
-    if tree_info is None:
-      return None
-    return self.get_tree(remote_url=tree_info["url"],
-                         working_tree=tree_info["working_tree"],
-                         remote_type=tree_info["t"],
-                         create=False)
+    tree = self._tree_for_id(tree_id)
+    if tree is None and tree_id.startswith(GIT_TREE_ID_PREFIX):
+      # Also accept non-canonical ids (i.e. "git/<url>" as used by older
+      # versions and in annotations).
+      try:
+        tree = self._tree_for_id(
+            self.tree_id_for_url(tree_id[len(GIT_TREE_ID_PREFIX):]))
+      except UserError:
+        pass
+    return tree
+
+  def tree_id_for_url(self, url: str) -> str:
+    """Gets the (canonical) tree_id for a git URL."""
+    tree_id = self._url_tree_ids.get(url)
+    if tree_id is None:
+      tree_id = GitTreeRef.make_tree_id(url,
+                                        rewrites=self._config.trees.url_rewrites)
+      self._url_tree_ids[url] = tree_id
+    return tree_id
+
+  def _migrate_tree_ids(self):
+    """Re-keys trees whose ids are not canonical.
+
+    This happens for configs written by older versions and when URL rewrite
+    rules change.
+    """
+    trees_config = self._config.trees
+    with self._config_lock:
+      renames = dict()
+      for tree_id, d in trees_config.tree_dicts.items():
+        if d.get("t") != GitTreeRef.CONFIG_TYPE:
+          continue
+        try:
+          canonical_tree_id = self.tree_id_for_url(d["url"])
+        except UserError:
+          continue
+        if canonical_tree_id != tree_id:
+          renames[tree_id] = canonical_tree_id
+      if not renames:
+        return
+      if self._read_only:
+        # Resolve them in memory only (see _tree_for_id()).
+        self._renamed_tree_ids = renames
+        for tree_id, canonical_tree_id in renames.items():
+          self._config_tree_ids.setdefault(canonical_tree_id, tree_id)
+      else:
+        trees_config.rename_trees(renames)
 
   def all_trees(self):
     """Yields all trees known by the repository."""
-    for tree_info in self.config.trees.tree_dicts.values():
-
-      tree = self.get_tree(remote_url=tree_info["url"],
-                           working_tree=tree_info["working_tree"],
-                           remote_type=tree_info["t"],
-                           create=False)
+    seen_tree_ids = set()
+    for tree_id in list(self.config.trees.tree_dicts.keys()):
+      tree_id = self._renamed_tree_ids.get(tree_id, tree_id)
+      if tree_id in seen_tree_ids:
+        continue
+      seen_tree_ids.add(tree_id)
+      tree = self._tree_for_id(tree_id)
       if tree is not None:
         yield tree
 
+  def sparse_requests_for(self, tree):
+    """Gets what the checked out trees depending on a tree need of it.
+
+    Returns:
+      List of directories requested by each dependency on the tree, where
+      empty directories means that the whole tree is needed.
+    """
+    with self._config_lock:
+      if self._sparse_requests is None:
+        self._sparse_requests = collections.defaultdict(dict)
+        for dependent in self.all_trees():
+          self._index_sparse_requests(dependent)
+      return [
+          directories for dependent, requests in self._sparse_requests.get(
+              tree, {}).items() if dependent is not tree
+          for directories in requests
+      ]
+
+  def update_sparse_requests(self, dependent):
+    """Updates the requests of a tree after its dependencies changed."""
+    with self._config_lock:
+      if self._sparse_requests is not None:
+        self._index_sparse_requests(dependent)
+
+  def _index_sparse_requests(self, dependent):
+    for dep_tree in self._sparse_request_deps.pop(dependent, ()):
+      self._sparse_requests[dep_tree].pop(dependent, None)
+    if find_git_dirs(dependent.path_in_repo) is None:
+      return
+    dep_trees = set()
+    for dep_provider in dependent.dep_providers:
+      for dep_tree, directories in dep_provider.sparse_requests():
+        self._sparse_requests[dep_tree].setdefault(dependent,
+                                                   []).append(directories)
+        dep_trees.add(dep_tree)
+    self._sparse_request_deps[dependent] = dep_trees
+
+  def _tree_for_id(self, tree_id):
+    """Gets the tree instance for a tree_id known to the config (or None)."""
+    tree_id = self._renamed_tree_ids.get(tree_id, tree_id)
+    with self._config_lock:
+      tree = self._trees.get(tree_id)
+      if tree is None:
+        existing_dict = self._config.trees.get_tree_by_id(tree_id)
+        if existing_dict is None and tree_id in self._config_tree_ids:
+          existing_dict = self._config.trees.get_tree_by_id(
+              self._config_tree_ids[tree_id])
+        if existing_dict is None:
+          return None
+        tree = BaseTreeRef.from_dict(self, d=existing_dict)
+        self._trees[tree_id] = tree
+      return tree
+
   def get_tree(self,
                remote_url: str,
                working_tree=DEFAULT_WORKING_TREE,
@@ -116,19 +392,22 @@ class Repo:
                create=True) -> "GitTreeRef":
     assert remote_type == "git"
     assert working_tree == "defaultwt"
-    prototype = GitTreeRef(self, url_spec=remote_url, working_tree=working_tree)
-    prototype.validate()
-    tree_id = prototype.tree_id
-    existing_dict = self._config.trees.get_tree_by_id(tree_id)
-    if existing_dict is None:
-      if not create:
-        return None
-      print("Added new tree {}".format(tree_id))
-      self._config.trees.add_alias(prototype.default_local_path, tree_id)
-      prototype.save()
-      return prototype
-    else:
-      return BaseTreeRef.from_dict(self, d=existing_dict)
+    tree_id = self.tree_id_for_url(remote_url)
+    with self._config_lock:
+      tree = self._tree_for_id(tree_id)
+      if tree is not None or not create:
+        return tree
+      tree = GitTreeRef(self, url_spec=remote_url, working_tree=working_tree)
+      tree.validate()
+      self._trees[tree_id] = tree
+      if self._read_only:
+        # Only known to this instance (all_trees() does not yield it).
+        return tree
+      reporting.detail("Added new tree {}", tree_id, event="tree_added",
+                       tree=tree_id)
+      self._config.trees.add_alias(tree.default_local_path, tree_id)
+      tree.save()
+      return tree
 
   def get_root_tree(self,
                     working_tree=DEFAULT_WORKING_TREE,
@@ -140,29 +419,37 @@ class Repo:
     """
     assert remote_type == "git"
     assert working_tree == "defaultwt"
-    tree_id = "git/__root__"
-    existing_dict = self._config.trees.get_tree_by_id(tree_id)
-    if existing_dict is not None:
-      return BaseTreeRef.from_dict(self, d=existing_dict)
-    new_tree = GitTreeRef(self, url_spec="__root__", working_tree=working_tree)
-    print("Adding new tree __root__")
-    annotation = GitConfigAnnotation(tree_id=tree_id)
-    annotation.save_to_git_root(self.path)
-    self._config.trees.add_alias(self.path, tree_id)
-    new_tree.save()
-    return new_tree
+    tree_id = GitTreeRef.make_tree_id(ROOT_URL_SPEC)
+    with self._config_lock:
+      existing_tree = self._tree_for_id(tree_id)
+      if existing_tree is not None:
+        return existing_tree
+      new_tree = GitTreeRef(self,
+                            url_spec=ROOT_URL_SPEC,
+                            working_tree=working_tree)
+      reporting.detail("Adding new tree __root__",
+                       event="tree_added",
+                       tree=tree_id)
+      annotation = GitConfigAnnotation(tree_id=tree_id)
+      annotation.save_to_git_root(self.path)
+      self._config.trees.add_alias(self.path, tree_id)
+      new_tree.save()
+      self._trees[tree_id] = new_tree
+      return new_tree
 
   @staticmethod
-  def find_existing(existing_path):
+  def find_existing(existing_path, read_only: bool = False):
     mmrepo_dir = os.path.join(existing_path, MMREPO_DIR)
     universe_dir = os.path.join(mmrepo_dir, UNIVERSE_DIR)
     if os.path.isdir(mmrepo_dir) and os.path.isdir(universe_dir):
-      return Repo(existing_path)
+      return Repo(existing_path, read_only=read_only)
     else:
       return None
 
   @staticmethod
-  def find_from_cwd(from_cwd: Optional[str] = None, exact_path: bool = False):
+  def find_from_cwd(from_cwd: Optional[str] = None,
+                    exact_path: bool = False,
+                    read_only: bool = False):
     if from_cwd is None:
       from_cwd = os.getcwd()
     prev_cwd = None
@@ -171,7 +458,7 @@ class Repo:
       mmrepo_dir = os.path.join(cwd, MMREPO_DIR)
       universe_dir = os.path.join(mmrepo_dir, UNIVERSE_DIR)
       if os.path.isdir(mmrepo_dir) and os.path.isdir(universe_dir):
-        return Repo(cwd)
+        return Repo(cwd, read_only=read_only)
       prev_cwd = cwd
       cwd = os.path.dirname(cwd)
       if exact_path:
@@ -215,8 +502,7 @@ class BaseTreeRef:
     """Saves this tree to the config."""
     d = self.as_dict()
     d["t"] = self.CONFIG_TYPE
-    self._repo.config.trees.tree_dicts[self.tree_id] = d
-    self._repo.config.trees.save()
+    self._repo.config.trees.set_tree_dict(self.tree_id, d)
 
   @property
   def repo(self) -> Repo:
@@ -247,6 +533,21 @@ class BaseTreeRef:
     """A unique identifier for the tree"""
     raise NotImplementedError()
 
+  def materialize(self, sparse_directories=None) -> bool:
+    """Makes the tree's contents exist in the universe (i.e. clones it).
+
+    Unlike checkout(), this does not initialize dependencies and does not
+    mutate the repository config, so it is safe to run concurrently for
+    distinct trees.
+
+    Args:
+      sparse_directories: If not None, only these directories are checked out
+        (see sparse_checkout_directories()).
+    Returns:
+      Whether the tree was newly materialized.
+    """
+    raise NotImplementedError()
+
   def checkout(self):
     """Checks out the tree into the universe."""
     raise NotImplementedError()
@@ -265,10 +566,18 @@ class GitTreeRef(BaseTreeRef):
   """A reference to a git tree mapped into an mmr."""
   CONFIG_TYPE = "git"
 
-  def __init__(self, repo: Repo, url_spec: str, working_tree: str):
+  def __init__(self,
+               repo: Repo,
+               url_spec: str,
+               working_tree: str,
+               clone_options: Optional[dict] = None,
+               sparse: Sequence[str] = ()):
     super().__init__(repo)
-    self._origin = GitOrigin(url_spec)
+    self._origin = GitOrigin(url_spec,
+                             rewrites=repo.config.trees.url_rewrites)
     self._working_tree = working_tree
+    self._clone_options = dict(clone_options or {})
+    self._sparse = list(sparse or [])
     self._deps = None
     self._submodule_deps_provider = None
 
@@ -276,16 +585,222 @@ class GitTreeRef(BaseTreeRef):
   def from_dict(repo: Repo, d):
     url_spec = d["url"]
     working_tree = d["working_tree"]
-    return GitTreeRef(repo=repo, url_spec=url_spec, working_tree=working_tree)
+    clone_options = {k: d[k] for k in CLONE_OPTIONS if k in d}
+    return GitTreeRef(repo=repo,
+                      url_spec=url_spec,
+                      working_tree=working_tree,
+                      clone_options=clone_options,
+                      sparse=d.get("sparse") or ())
 
   def as_dict(self) -> dict:
-    return {"url": self._origin.git_origin, "working_tree": self._working_tree}
+    d = {"url": self._origin.git_origin, "working_tree": self._working_tree}
+    d.update(self._clone_options)
+    if self._sparse:
+      d["sparse"] = list(self._sparse)
+    return d
+
+  def clone_option(self, name: str):
+    """Gets a clone option for this tree, defaulting to the repository's."""
+    assert name in CLONE_OPTIONS
+    if name in self._clone_options:
+      return self._clone_options[name]
+    return getattr(self.repo.config.trees, name)
+
+  @property
+  def sparse(self) -> Sequence[str]:
+    """Directories of this tree configured to be checked out (or empty)."""
+    return self._sparse
+
+  @sparse.setter
+  def sparse(self, sparse: Sequence[str]):
+    self._sparse = list(sparse)
+    self.save()
+
+  def sparse_checkout_directories(self) -> Optional[Sequence[str]]:
+    """Gets the directories to check out, or None for the whole tree.
+
+    This is the union of the directories configured for the tree and those
+    requested by the (checked out) trees which depend on it. If any of them
+    requests the whole tree, then the whole tree is checked out. With no
+    requests, the whole tree is checked out.
+
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x", files={"a/f": "", "b/f": "", "c/f": ""})
+    >>> a = env.create_remote("a", json_deps=[{"path": "x", "url": x,
+    ...                                        "sparse": ["a"]}])
+    >>> b = env.create_remote("b", json_deps=[{"path": "x", "url": x,
+    ...                                        "sparse": ["b"]}])
+    >>> path = env.init_repo("repo")
+    >>> _ = env.mmr(path, "checkout", a)
+    >>> env.git(os.path.join(path, "all", "x"), "sparse-checkout", "list")
+    'a'
+    >>> _ = env.mmr(path, "checkout", b)
+    >>> env.git(os.path.join(path, "all", "x"), "sparse-checkout",
+    ...         "list").split()
+    ['a', 'b']
+    >>> repo = Repo(path)
+    >>> repo.get_tree(x).sparse_checkout_directories()
+    ['a', 'b']
+    >>> repo.get_tree(a).sparse_checkout_directories() is None
+    True
+    >>> env.close()
+    """
+    directories = set(self._sparse)
+    requested = bool(self._sparse)
+    for dep_directories in self.repo.sparse_requests_for(self):
+      if not dep_directories:
+        return None
+      directories.update(dep_directories)
+      requested = True
+    return sorted(directories) if requested else None
+
+  def sparse_checkout_needs_update(self, directories) -> bool:
+    """Whether the working tree is not limited to the given directories."""
+    if self.is_root_tree:
+      return False
+    git = self.repo.git
+    path = self.path_in_repo
+    if directories is None and not git.is_sparse_checkout(path):
+      return False
+    return directories != git.sparse_checkout_list(path)
+
+  def apply_sparse_checkout(self, directories=_FROM_DEPENDENTS):
+    """Updates the sparse-checkout of the working tree if needed.
+
+    Args:
+      directories: The directories to check out (None for the whole tree).
+        Defaults to sparse_checkout_directories().
+    """
+    if directories is _FROM_DEPENDENTS:
+      directories = self.sparse_checkout_directories()
+    if not self.sparse_checkout_needs_update(directories):
+      return
+    git = self.repo.git
+    path = self.path_in_repo
+    if directories is None:
+      git.sparse_checkout_disable(path)
+    else:
+      git.sparse_checkout_set(path, directories)
+    # Sparse-checkout rewrites skip-worktree bits, so restore ours.
+    self._initialize_dep_providers()
+
+  def find_dep_problems(self) -> Sequence[DepProblem]:
+    """Compares the dependency links and index flags to what is expected.
+
+    Only checks (nothing is modified), so this is cheap when all is well: no
+    more than one git process per dep provider. Trees whose skip-worktree
+    flags were set (or checked) since their git index last changed need none:
+
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> b = env.create_remote("b", submodules={"x": x})
+    >>> repo_path = env.init_repo("repo")
+    >>> _ = env.mmr(repo_path, "checkout", b)
+    >>> repo = Repo(repo_path)
+    >>> tree = repo.get_tree(b)
+    >>> commands = []
+    >>> execute = repo.git.execute
+    >>> repo.git.execute = lambda args, *a, **kw: (commands.append(args) or
+    ...                                            execute(args, *a, **kw))
+    >>> tree.find_dep_problems(), commands
+    ([], [])
+    >>> env.close()
+    """
+    # Skip-worktree flags are in the git index, so need only be checked if it
+    # changed since they were last found to be set.
+    graph_index = self.repo.graph_index
+    key = graph_index.tree_key(self)
+    facts = graph_index.lookup(self, key) or {}
+    check_skip_worktree = not facts.get("skip_worktree_ok")
+    problems = []
+    for dep_provider in self.dep_providers:
+      for local_path, dep_tree in dep_provider.expected_links():
+        if not fileutils.is_link_to(local_path, dep_tree.path_in_repo):
+          problems.append(DepProblem(NOT_LINKED, local_path, dep_tree))
+      if not check_skip_worktree:
+        continue
+      paths = dep_provider.expected_skip_worktree_paths
+      index_tags = self.repo.git.index_tags(self.path_in_repo, paths)
+      for path in paths:
+        if path in index_tags and not is_skip_worktree_tag(index_tags[path]):
+          problems.append(DepProblem(NOT_SKIP_WORKTREE, path, None))
+    if check_skip_worktree and not any(
+        problem.kind == NOT_SKIP_WORKTREE for problem in problems):
+      graph_index.update(self, key, skip_worktree_ok=True)
+    return problems
+
+  def repair_dep_problems(self, problems: Sequence[DepProblem]):
+    """Repairs problems found by find_dep_problems()."""
+    skip_worktree_paths = []
+    for problem in problems:
+      if problem.kind == NOT_SKIP_WORKTREE:
+        skip_worktree_paths.append(problem.path)
+        continue
+      assert problem.kind == NOT_LINKED
+      local_path = problem.path
+      if os.path.islink(local_path):
+        os.unlink(local_path)
+      elif os.path.isdir(local_path) and not os.listdir(local_path):
+        # Empty directory left for a submodule by git.
+        os.rmdir(local_path)
+      elif os.path.exists(local_path):
+        raise UserError("Dependency path {} must not exist or be a symlink",
+                        local_path)
+      problem.dep_tree.make_link(local_path)
+    if skip_worktree_paths:
+      self.repo.git.skip_worktree_paths(self.path_in_repo, skip_worktree_paths)
+
+  def lookup_dep_versions(self):
+    """Looks up the versions of all dependencies requested by this tree.
+
+    Results are recorded in the graph index, and are reused (without running
+    git) until the tree changes.
+
+    Returns:
+      Sequence of (dep_tree, version).
+    """
+    graph_index = self.repo.graph_index
+    key = graph_index.tree_key(self)
+    facts = graph_index.lookup(self, key) or {}
+    dep_versions = facts.get("dep_versions")
+    if dep_versions is not None:
+      return [(self.repo.get_tree(url), version)
+              for url, version in dep_versions]
+    results = []
+    for dep_provider in self.dep_providers:
+      results.extend(dep_provider.lookup_versions())
+    graph_index.update(self,
+                       key,
+                       dep_versions=[[dep_tree.url, version]
+                                     for dep_tree, version in results])
+    return results
+
+  def set_clone_options(self, **clone_options):
+    """Overrides clone options for this tree (ignoring None values)."""
+    for name, value in clone_options.items():
+      assert name in CLONE_OPTIONS
+      if value is not None:
+        self._clone_options[name] = value
+    self.save()
+
+  @staticmethod
+  def make_tree_id(url_spec: str, rewrites=None) -> str:
+    """Makes the tree_id of a git tree from its URL.
+
+    The id is based on the canonicalized URL, so that different spellings of
+    the same remote (i.e. SSH and HTTPS) are the same tree.
+    """
+    if url_spec == ROOT_URL_SPEC:
+      return GIT_TREE_ID_PREFIX + ROOT_URL_SPEC
+    return GIT_TREE_ID_PREFIX + canonicalize_git_url(url_spec, rewrites)
 
   @property
   def tree_id(self) -> str:
-    # TODO: The id should really be canonicalized based on some knowledge
-    # of the origin.
-    return "git/{}".format(self._origin.git_origin)
+    if self.is_root_tree:
+      return GIT_TREE_ID_PREFIX + ROOT_URL_SPEC
+    return GIT_TREE_ID_PREFIX + self._origin.canonical_id
 
   def validate(self):
     if not self.is_root_tree:
@@ -296,18 +811,22 @@ class GitTreeRef(BaseTreeRef):
       return True
     if type(other) is not GitTreeRef:
       return False
-    return self._origin == other._origin
+    return self.tree_id == other.tree_id
 
   def __hash__(self):
-    return hash(self._origin)
+    return hash(self.tree_id)
 
   @property
   def url(self):
     return self._origin.git_origin
 
+  @property
+  def host(self) -> str:
+    return self._origin.host
+
   @property
   def is_root_tree(self):
-    return self.url == "__root__"
+    return self.url == ROOT_URL_SPEC
 
   @property
   def path_in_repo(self) -> str:
@@ -360,11 +879,37 @@ class GitTreeRef(BaseTreeRef):
     This should be done after any working tree disruptions to ensure links
     are current.
     """
+    # Initialization applies the sparse-checkouts of dependencies, which
+    # depend on what this tree requests.
+    self.repo.update_sparse_requests(self)
+    self._initialize_dep_providers()
+
+  def _initialize_dep_providers(self):
     for dep_provider in self.dep_providers:
       dep_provider.initialize()
+    # Initialization sets all skip-worktree flags, so they need not be checked
+    # again until the git index changes.
+    graph_index = self.repo.graph_index
+    graph_index.update(self, graph_index.tree_key(self), skip_worktree_ok=True)
 
   @property
   def clone_args(self):
+    """Arguments for git clone.
+
+    Clone options of the tree override those of the repository:
+
+    >>> import shutil, tempfile
+    >>> repo = Repo.init(from_cwd=tempfile.mkdtemp(), exact_path=True)
+    >>> repo.config.trees.clone_filter = "blob:none"
+    >>> repo.config.trees.clone_depth = 10
+    >>> tree = repo.get_tree("https://example.com/x.git")
+    >>> tree.clone_args
+    ['--filter=blob:none', '--depth=10']
+    >>> tree.set_clone_options(clone_depth=1, single_branch=True)
+    >>> tree.clone_args
+    ['--filter=blob:none', '--depth=1', '--single-branch']
+    >>> shutil.rmtree(repo.path)
+    """
     trees_config = self.repo.config.trees
     args = []
 
@@ -372,19 +917,32 @@ class GitTreeRef(BaseTreeRef):
     if trees_config.bare_clone:
       args.append("--no-checkout")
 
+    # Partial and shallow clones. These do not apply to clones from a local
+    # mirror, which are --shared and so do not copy objects anyway.
+    if self.repo.local_mirror_repo is None:
+      clone_filter = self.clone_option("clone_filter")
+      if clone_filter:
+        args.append("--filter={}".format(clone_filter))
+      clone_depth = self.clone_option("clone_depth")
+      if clone_depth:
+        args.append("--depth={}".format(clone_depth))
+      if self.clone_option("single_branch"):
+        args.append("--single-branch")
+
     # Reference.
-    other_repo_path = trees_config.reference_repo
-    if other_repo_path:
-      other_repo = Repo.find_existing(other_repo_path)
-      if other_repo:
-        other_tree = other_repo.get_tree(self.url, create=False)
-        if other_tree:
-          if trees_config.reference_repo:
-            args.extend(["--reference-if-able", other_tree.path_in_repo])
+    other_repo = self.repo.reference_repo
+    if other_repo:
+      other_tree = other_repo.get_tree(self.url, create=False)
+      if other_tree:
+        args.extend(["--reference-if-able", other_tree.path_in_repo])
     return args
 
-  def clone(self):
-    """Clones the repository to this path."""
+  def clone(self, sparse_directories=None):
+    """Clones the repository to this path.
+
+    Args:
+      sparse_directories: If not None, only check out these directories.
+    """
     local_mirror = self.repo.local_mirror_repo
     # Resolve any local mirror.
     mirror_tree = None
@@ -397,11 +955,14 @@ class GitTreeRef(BaseTreeRef):
                                           remote_type="git")
       source_path = mirror_tree.path_in_repo
       clone_args.append("--shared")
-      if not self.repo.git.is_git_repository(mirror_tree.path_in_repo):
-        print("Mirror tree does not exist. Cloning", url)
-        mirror_tree.clone()
-      else:
-        mirror_tree.fetch()
+      MirrorManager(local_mirror).update(mirror_tree)
+
+    # Only check out top-level files to start with when sparse, rather than
+    # the whole tree.
+    sparse = (sparse_directories is not None and
+              not self.repo.config.trees.bare_clone)
+    if sparse:
+      clone_args.append("--sparse")
 
     # Clone from either the upstream source or the local mirror.
     self.repo.git.clone(source_path, self.path_in_repo, clone_args=clone_args)
@@ -409,46 +970,235 @@ class GitTreeRef(BaseTreeRef):
     # If using a local mirror, rewrite the remotes.
     self.repo.git.remote_set_url(self.path_in_repo, "origin", url)
 
+    if sparse:
+      self.repo.git.sparse_checkout_set(self.path_in_repo, sparse_directories)
+
   def fetch(self):
     """Fetches from remotes."""
     self.repo.git.fetch(self.path_in_repo)
 
+  def fetch_version(self, version, *, exact=False) -> bool:
+    """Fetches from remotes only if needed to have a version locally.
+
+    Versions which are not commit ids (i.e. branch names) are always fetched.
+
+    Shallow and single branch clones may not get a commit with a plain fetch.
+    For them, the commit is fetched directly and, failing that, shallow clones
+    are progressively deepened and single branch clones fetch all branches.
+
+    Args:
+      version: The version that will be checked out.
+      exact: Whether to try to fetch just the commit (which not all servers
+        allow), before falling back to a full fetch.
+    Returns:
+      Whether a fetch was done.
+
+    >>> import contextlib, io
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> old_commit = env.head(x)
+    >>> for i in range(3):
+    ...   _ = env.create_remote("x", files={"f": str(i)})
+    >>> x_work = os.path.join(env.path, "work", "x")
+    >>> _ = env.git(x_work, "checkout", "--quiet", "-b", "other", old_commit)
+    >>> _ = env.git(x_work, "commit", "--quiet", "--allow-empty", "-m", "Other")
+    >>> _ = env.git(x_work, "push", "--quiet", env.remote_path("x"), "other")
+    >>> repo_path = env.init_repo("repo")
+    >>> _ = env.mmr(repo_path, "checkout", "--depth", "1", "--single-branch",
+    ...             x)
+    >>> tree = Repo(repo_path).get_tree(x)
+    >>> path = tree.path_in_repo
+    >>> env.git(path, "rev-parse", "--is-shallow-repository")
+    'true'
+    >>> env.git(path, "rev-list", "--count", "--all")
+    '1'
+
+    Older commits and other branches are fetched on demand:
+
+    >>> def update_version(version):
+    ...   with contextlib.redirect_stdout(io.StringIO()):
+    ...     tree.update_version(version)
+    ...   return env.git(path, "rev-parse", "HEAD")
+    >>> update_version(old_commit) == old_commit
+    True
+    >>> update_version("other") == env.git(x_work, "rev-parse", "other")
+    True
+    >>> _ = update_version("other")
+    >>> env.git(path, "config", "--get-all", "remote.origin.fetch").split()
+    ['+refs/heads/main:refs/remotes/origin/main', '+refs/heads/other:refs/remotes/origin/other']
+    >>> env.git(path, "rev-parse", "--is-shallow-repository")
+    'true'
+    >>> env.close()
+    """
+    git = self.repo.git
+    path = self.path_in_repo
+    single_branch = self.clone_option("single_branch")
+    if not is_commit_id(version):
+      if single_branch:
+        # A plain fetch only gets the cloned branch: fetch the version if it
+        # is another branch, and track it (so that it can be checked out).
+        try:
+          self._fetch_shallow_aware(
+              "+refs/heads/{0}:refs/remotes/origin/{0}".format(version))
+        except UserError:
+          pass  # Not a branch (i.e. a tag).
+        else:
+          git.track_remote_branch(path, version)
+          return True
+      self.fetch()
+      return True
+    if (git.head_commit(path) == version or
+        not git.missing_objects(path, [version])):
+      return False
+    shallow = git.is_shallow(path)
+    clone_depth = self.clone_option("clone_depth") or 1
+    if exact or shallow or single_branch:
+      try:
+        self._fetch_shallow_aware(version)
+      except UserError:
+        reporting.warning(
+            "Could not fetch commit {} of {} (falling back to a broader "
+            "fetch)", version, self._origin)
+      else:
+        if not git.missing_objects(path, [version]):
+          return True
+    if shallow:
+      deepen = clone_depth
+      for _ in range(MAX_DEEPEN_STEPS):
+        deepen *= DEEPEN_FACTOR
+        git.fetch(path, fetch_args=["--deepen={}".format(deepen)])
+        if not git.missing_objects(path, [version]):
+          return True
+      git.fetch(path, fetch_args=["--unshallow"])
+      if not git.missing_objects(path, [version]):
+        return True
+    if single_branch:
+      git.fetch(path,
+                remote="origin",
+                refspecs=["+refs/heads/*:refs/remotes/origin/*"])
+    else:
+      self.fetch()
+    return True
+
+  def _fetch_shallow_aware(self, refspec):
+    """Fetches a refspec from the origin, at the clone depth if shallow."""
+    git = self.repo.git
+    path = self.path_in_repo
+    fetch_args = []
+    if git.is_shallow(path):
+      fetch_args.append("--depth={}".format(
+          self.clone_option("clone_depth") or 1))
+    git.fetch(path, remote="origin", refspecs=[refspec], fetch_args=fetch_args)
+
+  def local_remote_refs(self):
+    """Gets the refs of the origin, as last fetched into the local clone.
+
+    Returns:
+      Dict of ref -> commit, in the same form as GitExecutor.ls_remote.
+    """
+    return self.repo.git.local_remote_refs(self.path_in_repo)
+
   def __repr__(self):
     return "GitTree(url={}, working_tree={})".format(self._origin,
                                                      self._working_tree)
 
+  def materialize(self, sparse_directories=None) -> bool:
+    if self.is_root_tree:
+      return False
+    if self.repo.git.is_git_repository(self.path_in_repo):
+      reporting.detail("Skipping clone of {} (already exists)", self._origin)
+      return False
+    self.clone(sparse_directories=sparse_directories)
+    self._deps = None
+    return True
+
+  def materialize_from(self, source_tree: "GitTreeRef", *,
+                       worktree: bool = True) -> bool:
+    """Materializes this tree as a light-weight copy of a tree in another repo.
+
+    The copy is detached at the source's current commit and shares its
+    objects, either as a linked worktree or as a "git clone --shared".
+
+    Returns:
+      Whether the tree was created (False if the source is not checked out).
+    """
+    git = self.repo.git
+    source_path = source_tree.path_in_repo
+    if not git.is_git_repository(source_path):
+      return False
+    commit = git.rev_parse(source_path, "HEAD")
+    if commit is None:
+      return False
+    os.makedirs(os.path.dirname(self.path_in_repo), exist_ok=True)
+    if worktree:
+      git.worktree_add(source_path, self.path_in_repo, commit)
+    else:
+      git.clone(source_path,
+                self.path_in_repo,
+                clone_args=["--shared", "--no-checkout"])
+      git.remote_set_url(self.path_in_repo, "origin", self.url)
+      git.checkout_version(self.path_in_repo, commit, fetch=False)
+    self._deps = None
+    return True
+
   def checkout(self):
-    path = self.path_in_repo
-    if not self.is_root_tree:
-      if not self.repo.git.is_git_repository(path):
-        self.clone()
-        self._deps = None
-      else:
-        print("Skipping clone of {} (already exists)".format(self._origin))
+    cloned = self.materialize(
+        sparse_directories=self.sparse_checkout_directories())
+    self.apply_sparse_checkout()
 
     # Make sure that submodule initialization has been done.
     # Even though we aren't actually doing recursive checkouts here, it is
-    # necessary to initialize various git structures.
-    for dep_provider in self.dep_providers:
-      dep_provider.initialize()
+    # necessary to initialize various git structures. For existing trees,
+    # only what is broken is repaired.
+    if cloned:
+      self.ensure_dep_providers_initialized()
+    else:
+      self.repair_dep_problems(self.find_dep_problems())
 
   def make_link(self, target_path):
+    """Links the tree to a path, annotating its git root with the tree id.
+
+    The annotation is only written when it changed, so linking trees that
+    are already linked does not write anything:
+
+    >>> from mmrepo.testing import TestEnv
+    >>> env = TestEnv()
+    >>> x = env.create_remote("x")
+    >>> a = env.create_remote("a", json_deps=[{"path": "x", "url": x}])
+    >>> repo_path = env.init_repo("repo")
+    >>> _ = env.mmr(repo_path, "checkout", a)
+    >>> tree = Repo(repo_path).get_tree(x)
+    >>> annotation_file = GitConfigAnnotation._get_config_file(
+    ...     tree.path_in_repo)
+    >>> inode = os.stat(annotation_file).st_ino
+    >>> tree.make_link(os.path.join(repo_path, "all", "x"))
+    >>> os.stat(annotation_file).st_ino == inode
+    True
+    >>> env.close()
+    """
     if self.is_root_tree:
       return
     source_path = self.path_in_repo
-    # Update the annotation.
+    # Update the annotation (if needed: writes are fsync'd replaces).
     annotation = GitConfigAnnotation(tree_id=self.tree_id)
-    annotation.save_to_git_root(source_path)
+    if GitConfigAnnotation.find_from_git_root(source_path) != annotation:
+      annotation.save_to_git_root(source_path)
 
     if os.path.exists(target_path) or os.path.islink(target_path):
       if not os.path.islink(target_path):
         raise UserError("Cannot link tree: {} (path exists)", target_path)
-      existing_target = os.readlink(target_path)
-      if existing_target == source_path:
+      # Links are relative (see fileutils.make_relative_link()).
+      if fileutils.is_same_path(target_path, source_path):
         return
       raise UserError("Cannot link tree: {} (path is already linked to {})",
-                      target_path, source_path)
-    print("Create symlink {} -> '{}'".format(source_path, target_path))
+                      target_path, os.readlink(target_path))
+    reporting.detail("Create symlink {} -> '{}'",
+                     source_path,
+                     target_path,
+                     event="link_created",
+                     source=source_path,
+                     target=target_path)
     os.makedirs(os.path.dirname(target_path), exist_ok=True)
     fileutils.make_relative_link(source_path,
                                  target_path,
@@ -457,9 +1207,18 @@ class GitTreeRef(BaseTreeRef):
 
   def update_version(self, version, *, fetch=True):
     """Updates the version for this tree."""
+    if self.repo.git.head_commit(self.path_in_repo) == version:
+      # Already checked out: only repair the dependencies if needed.
+      self.repair_dep_problems(self.find_dep_problems())
+      return
+    if fetch:
+      self.fetch_version(version)
     self.repo.git.checkout_version(repository=self.path_in_repo,
                                    version=version,
-                                   fetch=fetch)
+                                   fetch=False)
+    # The dependencies may have changed with the working tree.
+    self._deps = None
+    self.apply_sparse_checkout()
     self.ensure_dep_providers_initialized()
 
 
@@ -475,6 +1234,29 @@ class BaseDepProvider:
     """Performs clone or update time initialization."""
     raise NotImplementedError()
 
+  def expected_links(self):
+    """Gets the links that initialize() maintains.
+
+    Returns:
+      Sequence of (local_path, tree) for each dependency path that should be
+      a symlink to a tree.
+    """
+    raise NotImplementedError()
+
+  @property
+  def expected_skip_worktree_paths(self):
+    """Paths (relative to the repository) which should be skip-worktree."""
+    return []
+
+  def sparse_requests(self):
+    """Gets the parts of dependent trees that need to be checked out.
+
+    Returns:
+      Sequence of (tree, directories), where empty directories means that the
+      whole tree is needed.
+    """
+    return [(tree, ()) for tree in self.trees]
+
 
 class JsonDepProvider(BaseDepProvider):
   """Light-weight dep provider that processes a module_deps.json file."""
@@ -484,6 +1266,8 @@ class JsonDepProvider(BaseDepProvider):
     super().__init__()
     self._repo = repo
     self._deps_file = deps_file
+    self._records_key = None
+    self._records = None
 
   @property
   def parent_dir(self):
@@ -497,17 +1281,69 @@ class JsonDepProvider(BaseDepProvider):
       return cls(repo=repo, deps_file=deps_file)
     return None
 
-  def initialize(self):
-    dep_records = DepRecord.read_from_file(self._deps_file)
+  def _file_key(self):
+    """Key identifying the current contents of the deps file."""
+    try:
+      st = os.stat(self._deps_file)
+    except FileNotFoundError:
+      return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+  def _resolved_records(self):
+    """Gets a sequence of (dep_record, tree) for each valid dependency.
+
+    The deps file is parsed (and trees looked up) only when its contents
+    change.
+
+    >>> import json, shutil, tempfile
+    >>> repo = Repo.init(from_cwd=tempfile.mkdtemp(), exact_path=True)
+    >>> deps_file = os.path.join(repo.path, "module_deps.json")
+    >>> def write_deps(*urls):
+    ...   with open(deps_file, "w") as f:
+    ...     json.dump({"deps": [{"url": url, "path": os.path.basename(url),
+    ...                          "version": "main"} for url in urls]}, f)
+    >>> write_deps("https://example.com/x.git")
+    >>> provider = JsonDepProvider(repo, deps_file)
+    >>> records = provider._resolved_records()
+    >>> provider._resolved_records() is records
+    True
+    >>> [tree.url for tree in provider.trees]
+    ['https://example.com/x.git']
+    >>> write_deps("https://example.com/x.git", "https://example.com/y.git")
+    >>> [tree.url for tree in provider.trees]
+    ['https://example.com/x.git', 'https://example.com/y.git']
+    >>> provider.trees[0] is records[0][1]
+    True
+    >>> os.unlink(deps_file)
+    >>> provider.trees
+    []
+    >>> shutil.rmtree(repo.path)
+    """
+    file_key = self._file_key()
+    if self._records is not None and file_key == self._records_key:
+      return self._records
+    dep_records = (DepRecord.read_from_file(self._deps_file)
+                   if file_key is not None else [])
+    results = []
     for dep_record in dep_records:
       try:
         tree = self._repo.get_tree(dep_record.url,
                                    working_tree=DEFAULT_WORKING_TREE,
                                    remote_type="git")
       except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", dep_record.url)
-        print(e.message)
+        reporting.error("** ERROR INITIALIZING DEPENDENCY (skipped): {}\n{}",
+                        dep_record.url,
+                        e.message,
+                        event="dep_error",
+                        dep=dep_record.url)
         continue
+      results.append((dep_record, tree))
+    self._records_key = file_key
+    self._records = results
+    return results
+
+  def initialize(self):
+    for dep_record, tree in self._resolved_records():
       for target_path in dep_record.paths:
         local_path = os.path.join(self.parent_dir, target_path)
         # Setup the symlink.
@@ -519,21 +1355,18 @@ class JsonDepProvider(BaseDepProvider):
               "Dependency path {} must not exist or be a symlink".format(
                   local_path))
         tree.make_link(local_path)
+      # The parts of the tree needed may have changed.
+      if find_git_dirs(tree.path_in_repo) is not None:
+        tree.apply_sparse_checkout()
 
   @property
   def trees(self):
-    dep_records = DepRecord.read_from_file(self._deps_file)
-    trees = []
-    for dep_record in dep_records:
-      try:
-        trees.append(
-            self._repo.get_tree(dep_record.url,
-                                working_tree=DEFAULT_WORKING_TREE,
-                                remote_type="git"))
-      except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", dep_record.url)
-        print(e.message)
-    return trees
+    return [tree for _, tree in self._resolved_records()]
+
+  def expected_links(self):
+    return [(os.path.join(self.parent_dir, target_path), tree)
+            for dep_record, tree in self._resolved_records()
+            for target_path in dep_record.paths]
 
   def lookup_versions(self):
     """Looks up requested versions for dependent trees.
@@ -541,18 +1374,12 @@ class JsonDepProvider(BaseDepProvider):
     Returns:
       Sequence of (dep_tree, version).
     """
-    dep_records = DepRecord.read_from_file(self._deps_file)
-    results = []
-    for dep_record in dep_records:
-      try:
-        results.append(
-            (self._repo.get_tree(dep_record.url,
-                                 working_tree=DEFAULT_WORKING_TREE,
-                                 remote_type="git"), dep_record.version))
-      except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", dep_record.url)
-        print(e.message)
-    return results
+    return [(tree, dep_record.version)
+            for dep_record, tree in self._resolved_records()]
+
+  def sparse_requests(self):
+    return [(tree, dep_record.sparse)
+            for dep_record, tree in self._resolved_records()]
 
 
 class SubmoduleDepProvider(BaseDepProvider):
@@ -584,11 +1411,28 @@ class SubmoduleDepProvider(BaseDepProvider):
       try:
         trees.append(self._tree_for_module_info(info))
       except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", info)
-        print(e.message)
+        reporting.error("** ERROR INITIALIZING DEPENDENCY (skipped): {}\n{}",
+                        info,
+                        e.message,
+                        event="dep_error",
+                        dep=str(info))
         continue
     return trees
 
+  def expected_links(self):
+    results = []
+    for module_info in self._module_info_dict.values():
+      try:
+        tree = self._tree_for_module_info(module_info)
+      except UserError:
+        continue
+      results.append((os.path.join(self._git_path, module_info.path), tree))
+    return results
+
+  @property
+  def expected_skip_worktree_paths(self):
+    return list(self._module_info_dict.keys())
+
   def _tree_for_module_info(self, module_info):
     return self._repo.get_tree(remote_url=module_info.url,
                                working_tree=DEFAULT_WORKING_TREE,
@@ -605,21 +1449,27 @@ class SubmoduleDepProvider(BaseDepProvider):
     """
     if not self.has_submodules:
       return
+    module_trees = []
     for module_info in self._module_info_dict.values():
       try:
         module_tree_ref = self._tree_for_module_info(module_info)
       except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", module_info)
-        print(e.message)
+        reporting.error("** ERROR INITIALIZING DEPENDENCY (skipped): {}\n{}",
+                        module_info,
+                        e.message,
+                        event="dep_error",
+                        dep=str(module_info))
         continue
+      module_trees.append((module_info, module_tree_ref))
+
+    # Tell git "hands off"!
+    self.repo.git.skip_worktree_paths(
+        repository=self._git_path, paths=self.expected_skip_worktree_paths)
 
+    for module_info, module_tree_ref in module_trees:
       module_tree_path = module_tree_ref.path_in_repo
       module_path = os.path.join(self._git_path, module_info.path)
 
-      # Tell git "hands off"!
-      self.repo.git.skip_worktree(repository=self._git_path,
-                                  path=module_info.path)
-
       # Setup the symlink.
       if os.path.islink(module_path):
         # Update the link (for tidyness and better self correction).
@@ -627,8 +1477,8 @@ class SubmoduleDepProvider(BaseDepProvider):
         module_tree_ref.make_link(module_path)
       elif (not os.path.exists(module_path) or os.path.isdir(module_path)):
         # Create the symlink.
-        print("Redirecting submodule {} to {}".format(module_info.path,
-                                                      module_tree_path))
+        reporting.detail("Redirecting submodule {} to {}", module_info.path,
+                         module_tree_path)
         if os.path.exists(module_path):
           os.rmdir(module_path)
         module_tree_ref.make_link(module_path)
@@ -640,14 +1490,17 @@ class SubmoduleDepProvider(BaseDepProvider):
       Sequence of (dep_tree, version).
     """
     path_versions = self.repo.git.parse_submodule_versions(
-        repository=self._git_path)
+        repository=self._git_path, paths=list(self._module_info_dict.keys()))
     results = []
     for path, version in path_versions:
       try:
         results.append((self._tree_for_path(path), version))
       except UserError as e:
-        print("** ERROR INITIALIZING DEPENDENCY (skipped):", path)
-        print(e.message)
+        reporting.error("** ERROR INITIALIZING DEPENDENCY (skipped): {}\n{}",
+                        path,
+                        e.message,
+                        event="dep_error",
+                        dep=path)
         continue
     return results
 
@@ -659,3 +1512,8 @@ def _make_dir(path: str, exist_ok=False):
     raise UserError("Unable to create directory {} (exists)", path)
   except OSError:
     raise UserError("Unable to create directory {}", path)
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
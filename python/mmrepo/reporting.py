@@ -0,0 +1,342 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reporting of events, progress and command output.
+
+All user-visible output goes through this module, which:
+
+  * Filters events by level (ERROR, WARNING, INFO, DETAIL, DEBUG). Command
+    output (i.e. the listing of "mmr status") is always shown.
+  * Serializes output from concurrent workers, so that lines never interleave.
+  * Shows a live progress line (items done/total, bytes fetched and an ETA)
+    on an interactive stderr, redrawn below other output.
+  * In JSON mode, writes each event (and progress update) as a line of JSON
+    to stdout instead, for ingestion by CI logs.
+
+Messages are formatted like UserError: with str.format() and positional
+args. Keyword args are extra fields of the event, only written in JSON mode.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+__all__ = [
+    "DEBUG",
+    "DETAIL",
+    "ERROR",
+    "INFO",
+    "LEVEL_NAMES",
+    "Progress",
+    "WARNING",
+    "configure",
+    "debug",
+    "detail",
+    "error",
+    "format_bytes",
+    "info",
+    "is_enabled",
+    "is_showing_bytes",
+    "log",
+    "output",
+    "progress",
+    "record_bytes",
+    "warning",
+]
+
+ERROR = 40
+WARNING = 30
+INFO = 20
+DETAIL = 15
+DEBUG = 10
+# Command output is shown at every level.
+OUTPUT = 100
+
+LEVEL_NAMES = {
+    ERROR: "error",
+    WARNING: "warning",
+    INFO: "info",
+    DETAIL: "detail",
+    DEBUG: "debug",
+    OUTPUT: "output",
+}
+
+# Minimum time between redraws of the progress line.
+PROGRESS_REDRAW_SECONDS = 0.1
+
+
+class _State:
+  """Configuration and shared state of the reporter."""
+
+  def __init__(self):
+    super().__init__()
+    self.level = INFO
+    self.json_format = False
+    self.show_progress = True
+    # Serializes all writes (reentrant, as progress callbacks can report).
+    self.lock = threading.RLock()
+    self.progress_stack = []
+    self.progress_line_shown = False
+    self.last_redraw_time = 0.0
+
+
+_state = _State()
+
+
+def configure(*,
+              level: int = INFO,
+              json_format: bool = False,
+              show_progress: bool = True):
+  """Configures reporting for the rest of the process.
+
+  Args:
+    level: Minimum level of events to show.
+    json_format: Write events as lines of JSON.
+    show_progress: Show a live progress line (only if stderr is a terminal and
+      not in JSON mode).
+  """
+  with _state.lock:
+    _state.level = level
+    _state.json_format = json_format
+    _state.show_progress = show_progress
+
+
+def is_enabled(level: int) -> bool:
+  """Whether events of a level are shown (to skip expensive formatting)."""
+  return level >= _state.level
+
+
+def format_bytes(count: int) -> str:
+  """Formats a byte count for humans.
+
+  >>> format_bytes(12)
+  '12 B'
+  >>> format_bytes(1536)
+  '1.5 KiB'
+  >>> format_bytes(3 * 1024 * 1024 * 1024)
+  '3.0 GiB'
+  """
+  if count < 1024:
+    return "{} B".format(count)
+  value = float(count)
+  for unit in ("KiB", "MiB", "GiB"):
+    value /= 1024
+    if value < 1024 or unit == "GiB":
+      break
+  return "{:.1f} {}".format(value, unit)
+
+
+def _format_duration(seconds: float) -> str:
+  """Formats a duration as [h:]m:ss.
+
+  >>> _format_duration(75.2)
+  '1:15'
+  >>> _format_duration(3725)
+  '1:02:05'
+  """
+  seconds = int(round(seconds))
+  hours, seconds = divmod(seconds, 3600)
+  minutes, seconds = divmod(seconds, 60)
+  if hours:
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+  return "{}:{:02}".format(minutes, seconds)
+
+
+def _progress_line_enabled() -> bool:
+  return (_state.show_progress and not _state.json_format and
+          sys.stderr.isatty())
+
+
+def _clear_progress_line():
+  if _state.progress_line_shown:
+    sys.stderr.write("\r\x1b[K")
+    sys.stderr.flush()
+    _state.progress_line_shown = False
+
+
+def _draw_progress_line():
+  if not _state.progress_stack or not _progress_line_enabled():
+    return
+  line = _state.progress_stack[-1].format_line()
+  sys.stderr.write("\r\x1b[K" + line)
+  sys.stderr.flush()
+  _state.progress_line_shown = True
+  _state.last_redraw_time = time.monotonic()
+
+
+def _write_json(event: dict):
+  sys.stdout.write(json.dumps(event, default=str) + "\n")
+  sys.stdout.flush()
+
+
+def _report(level: int, event: str, message: str, args, fields):
+  if level < _state.level:
+    return
+  if args:
+    message = message.format(*args)
+  with _state.lock:
+    if _state.json_format:
+      record = {
+          "time": round(time.time(), 3),
+          "level": LEVEL_NAMES[level],
+          "event": event,
+          "message": message,
+      }
+      record.update(fields)
+      _write_json(record)
+      return
+    _clear_progress_line()
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+    _draw_progress_line()
+
+
+def log(level: int, message: str, *args, event: str = "log", **fields):
+  """Reports an event at a level."""
+  _report(level, event, message, args, fields)
+
+
+def error(message: str, *args, event: str = "error", **fields):
+  _report(ERROR, event, message, args, fields)
+
+
+def warning(message: str, *args, event: str = "warning", **fields):
+  _report(WARNING, event, message, args, fields)
+
+
+def info(message: str, *args, event: str = "info", **fields):
+  _report(INFO, event, message, args, fields)
+
+
+def detail(message: str, *args, event: str = "detail", **fields):
+  _report(DETAIL, event, message, args, fields)
+
+
+def debug(message: str, *args, event: str = "debug", **fields):
+  _report(DEBUG, event, message, args, fields)
+
+
+def output(message: str, *args, event: str = "output", **fields):
+  """Reports output of a command (shown at every level)."""
+  _report(OUTPUT, event, message, args, fields)
+
+
+class Progress:
+  """Progress of a command over a number of items.
+
+  The total may grow as more work is discovered (i.e. dependencies).
+  """
+
+  def __init__(self, title: str, total: int, unit: str):
+    super().__init__()
+    self.title = title
+    self.total = total
+    self.unit = unit
+    self.done = 0
+    self.bytes = 0
+    self._start_time = time.monotonic()
+
+  def format_line(self) -> str:
+    parts = ["{}: {}/{} {}".format(self.title, self.done, self.total,
+                                   self.unit)]
+    if self.bytes:
+      parts.append("{} fetched".format(format_bytes(self.bytes)))
+    if 0 < self.done < self.total:
+      elapsed = time.monotonic() - self._start_time
+      parts.append("ETA {}".format(
+          _format_duration(elapsed / self.done * (self.total - self.done))))
+    return ", ".join(parts)
+
+  def _update(self, force: bool = False):
+    if _state.json_format:
+      _write_json({
+          "time": round(time.time(), 3),
+          "level": LEVEL_NAMES[INFO],
+          "event": "progress",
+          "title": self.title,
+          "done": self.done,
+          "total": self.total,
+          "unit": self.unit,
+          "bytes": self.bytes,
+      })
+    elif (force or time.monotonic() - _state.last_redraw_time >=
+          PROGRESS_REDRAW_SECONDS):
+      _draw_progress_line()
+
+  def add_total(self, count: int = 1):
+    with _state.lock:
+      self.total += count
+
+  def advance(self, count: int = 1):
+    with _state.lock:
+      self.done += count
+      self._update(force=self.done >= self.total)
+
+  def add_bytes(self, count: int):
+    with _state.lock:
+      self.bytes += count
+      if not _state.json_format:
+        self._update()
+
+
+@contextlib.contextmanager
+def progress(title: str, total: int = 0, unit: str = "trees"):
+  """Shows the progress of a block of work.
+
+  Yields:
+    The Progress, to advance as items complete.
+  """
+  p = Progress(title, total, unit)
+  with _state.lock:
+    _state.progress_stack.append(p)
+    _draw_progress_line()
+  try:
+    yield p
+  finally:
+    with _state.lock:
+      _state.progress_stack.remove(p)
+      _clear_progress_line()
+      _draw_progress_line()
+
+
+def is_showing_bytes() -> bool:
+  """Whether record_bytes() counts are shown (to skip measuring them).
+
+  They are shown by the progress line, and in the progress events of JSON
+  mode:
+
+  >>> is_showing_bytes()
+  False
+  >>> configure(json_format=True)
+  >>> with progress("Fetching"):
+  ...   is_showing_bytes()
+  True
+  >>> configure()
+  """
+  with _state.lock:
+    return bool(_state.progress_stack) and (_state.json_format or
+                                            _progress_line_enabled())
+
+
+def record_bytes(count: int):
+  """Records bytes fetched, adding them to the innermost progress (if any)."""
+  with _state.lock:
+    if _state.progress_stack and count > 0:
+      _state.progress_stack[-1].add_bytes(count)
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
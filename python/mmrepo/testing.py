@@ -0,0 +1,183 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Helpers for doctests which need real git repositories.
+
+Remotes are bare repositories in a temporary directory. Their URLs look like
+hosted ones (https://mmr.test/<name>.git), but git rewrites them to file://
+URLs, so nothing touches the network. mmr commands are run in a new process
+(like a user would), so that no state is shared between them.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+__all__ = [
+    "TestEnv",
+]
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REMOTE_URL_BASE = "https://mmr.test/"
+
+
+class TestEnv:
+  """A temporary directory of remotes and repositories.
+
+  While open, the current directory is the temporary directory and git is
+  isolated from the user's and system config. close() restores both.
+
+  >>> env = TestEnv()
+  >>> x = env.create_remote("x", files={"src/x.txt": "x"})
+  >>> a = env.create_remote("a", submodules={"third_party/x": x})
+  >>> env.git(env.remote_path("a"), "ls-tree", "-r", "--name-only",
+  ...         "main").split()
+  ['.gitmodules', 'README', 'third_party/x']
+  >>> env.close()
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.path = os.path.realpath(tempfile.mkdtemp(prefix="mmr-test-"))
+    self._saved_environ = dict(os.environ)
+    self._saved_cwd = os.getcwd()
+    gitconfig = os.path.join(self.path, "gitconfig")
+    with open(gitconfig, "w") as f:
+      f.write("[user]\n\tname = Test\n\temail = test@example.test\n"
+              "[protocol \"file\"]\n\tallow = always\n"
+              "[init]\n\tdefaultBranch = main\n"
+              "[url \"file://{}/\"]\n\tinsteadOf = {}\n".format(
+                  os.path.join(self.path, "remotes"), REMOTE_URL_BASE))
+    os.environ["GIT_CONFIG_GLOBAL"] = gitconfig
+    os.environ["GIT_CONFIG_NOSYSTEM"] = "1"
+    os.environ["GIT_TERMINAL_PROMPT"] = "0"
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        [PYTHON_DIR] + [p for p in [os.environ.get("PYTHONPATH")] if p])
+    os.chdir(self.path)
+
+  def close(self):
+    os.chdir(self._saved_cwd)
+    os.environ.clear()
+    os.environ.update(self._saved_environ)
+    shutil.rmtree(self.path, ignore_errors=True)
+
+  def git(self, cwd: str, *args) -> str:
+    """Runs git, returning its (stripped) output."""
+    result = subprocess.run(["git"] + list(args),
+                            cwd=cwd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = result.stdout.decode("UTF-8").strip()
+    if result.returncode != 0:
+      raise AssertionError("git {} failed:\n{}".format(" ".join(args),
+                                                       output))
+    return output
+
+  def remote_path(self, name: str) -> str:
+    return os.path.join(self.path, "remotes", name + ".git")
+
+  def remote_url(self, name: str) -> str:
+    return REMOTE_URL_BASE + name + ".git"
+
+  def head(self, url: str) -> str:
+    """Gets the commit of the main branch of a remote."""
+    assert url.startswith(REMOTE_URL_BASE) and url.endswith(".git")
+    name = url[len(REMOTE_URL_BASE):-len(".git")]
+    return self.git(self.path, "--git-dir", self.remote_path(name),
+                    "rev-parse", "refs/heads/main")
+
+  def create_remote(self,
+                    name: str,
+                    files=None,
+                    json_deps=None,
+                    submodules=None) -> str:
+    """Creates a remote, or adds a commit to an existing one.
+
+    Args:
+      name: Name of the remote.
+      files: Dict of path -> contents of files to write.
+      json_deps: module_deps.json records (with versions defaulting to the
+        head of the dependency).
+      submodules: Dict of path -> URL of submodules (at their heads).
+    Returns:
+      The URL of the remote.
+    """
+    work_dir = os.path.join(self.path, "work", name)
+    bare_dir = self.remote_path(name)
+    if not os.path.isdir(work_dir):
+      os.makedirs(work_dir)
+      self.git(work_dir, "init", "--quiet")
+      self._write(work_dir, "README", name + "\n")
+    for path, contents in (files or {}).items():
+      self._write(work_dir, path, contents)
+    if json_deps is not None:
+      deps = []
+      for record in json_deps:
+        record = dict(record)
+        if "version" not in record:
+          record["version"] = self.head(record["url"])
+        deps.append(record)
+      self._write(work_dir, "module_deps.json",
+                  json.dumps({"deps": deps}, indent=2))
+    if submodules:
+      self._write(
+          work_dir, ".gitmodules", "".join(
+              '[submodule "{0}"]\n\tpath = {0}\n\turl = {1}\n'.format(
+                  path, url) for path, url in sorted(submodules.items())))
+    self.git(work_dir, "add", "-A")
+    for path, url in (submodules or {}).items():
+      self.git(work_dir, "update-index", "--add", "--cacheinfo",
+               "160000,{},{}".format(self.head(url), path))
+    self.git(work_dir, "commit", "--quiet", "--allow-empty", "-m",
+             "Update " + name)
+    if os.path.isdir(bare_dir):
+      self.git(work_dir, "push", "--quiet", "--force", bare_dir,
+               "HEAD:refs/heads/main")
+    else:
+      self.git(self.path, "clone", "--quiet", "--bare", work_dir, bare_dir)
+    return self.remote_url(name)
+
+  @staticmethod
+  def _write(work_dir: str, path: str, contents: str):
+    file_path = os.path.join(work_dir, path)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w") as f:
+      f.write(contents)
+
+  def init_repo(self, name: str, *init_args) -> str:
+    """Creates an mmr repository, returning its path."""
+    repo_dir = os.path.join(self.path, name)
+    os.makedirs(repo_dir)
+    self.mmr(repo_dir, "init", *init_args)
+    return repo_dir
+
+  def mmr(self, cwd: str, *args) -> str:
+    """Runs an mmr command in a new process, returning its output."""
+    result = subprocess.run([sys.executable, "-m", "mmrepo.main"] +
+                            list(args),
+                            cwd=cwd,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = result.stdout.decode("UTF-8")
+    if result.returncode != 0:
+      raise AssertionError("mmr {} failed:\n{}".format(" ".join(args),
+                                                       output))
+    return output
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
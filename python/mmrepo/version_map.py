@@ -17,13 +17,25 @@ from collections import namedtuple
 import re
 
 from mmrepo.common import *
+from mmrepo.remote_refs import *
 from mmrepo.repo import *
 
 __all__ = [
+    "RESOLVE_OFFLINE",
+    "RESOLVE_PREFER_LOCAL",
+    "RESOLVE_REMOTE",
     "VersionComponent",
     "VersionMap",
 ]
 
+# Modes for resolving symbolic versions.
+# Always query the remote.
+RESOLVE_REMOTE = "remote"
+# Use refs already fetched into local clones, querying the remote if missing.
+RESOLVE_PREFER_LOCAL = "prefer-local"
+# Only use refs already fetched into local clones.
+RESOLVE_OFFLINE = "offline"
+
 EXTRACT_RESOLVED_PAT = re.compile(r"""(.*)=([^=]+)""")
 EXTRACT_SYMBOLIC_PAT = re.compile(r"""(.*)@([^@]+)""")
 WHITESPACE_PAT = re.compile(r"""[\s|\n|\r]+""")
@@ -92,8 +104,15 @@ class VersionComponent(
       s += "=" + self.resolved_version
     return s
 
-  def resolve(self, repo: Repo) -> "VersionComponent":
-    """Parses the spec, resolving the tree to an existing instance."""
+  @property
+  def symbolic_version_or_head(self) -> str:
+    """The symbolic version to resolve (HEAD if not specified)."""
+    if self.symbolic_version is not None:
+      return self.symbolic_version
+    return "HEAD"
+
+  def resolve_tree(self, repo: Repo) -> "VersionComponent":
+    """Resolves the tree to an existing instance."""
     # Try to resolve as a tree id.
     tree_spec = self.tree
     tree = tree_spec
@@ -104,14 +123,25 @@ class VersionComponent(
       if tree is None:
         raise UserError("Tree '{}' is not known in the repository",
                         tree_spec)
+    return self._replace(tree=tree)
+
+  def resolve(self, repo: Repo, remote_refs=None) -> "VersionComponent":
+    """Parses the spec, resolving the tree to an existing instance.
+
+    Args:
+      repo: The repository.
+      remote_refs: Dict of ref -> commit advertised by the tree's remote, if
+        already known. Otherwise, the remote is queried if needed.
+    """
+    tree = self.resolve_tree(repo).tree
 
     # If no resolved_commit, try to resolve it.
     resolved_version = self.resolved_version
     symbolic_version = self.symbolic_version
     if resolved_version is None:
-      symbolic_version = (symbolic_version
-                          if symbolic_version is not None else "HEAD")
-      remote_refs = repo.git.ls_remote(tree.url)
+      symbolic_version = self.symbolic_version_or_head
+      if remote_refs is None:
+        remote_refs = repo.git.ls_remote(tree.url)
       if symbolic_version in remote_refs:
         resolved_version = remote_refs[symbolic_version]
       else:
@@ -158,9 +188,54 @@ class VersionMap:
       components.extend((VersionComponent.parse(s) for s in spec_split))
     return VersionMap(components)
 
-  def resolve(self, repo: Repo):
-    """Resolves all components of the version map, returning a new one."""
-    return VersionMap([c.resolve(repo) for c in self.components])
+  def resolve(self,
+              repo: Repo,
+              *,
+              jobs: int = None,
+              refresh: bool = False,
+              mode: str = RESOLVE_REMOTE):
+    """Resolves all components of the version map, returning a new one.
+
+    Remotes that need to be queried are each queried once, concurrently, and
+    results are cached in the repository for a short time (unless refresh).
+
+    Args:
+      repo: The repository.
+      jobs: Maximum number of concurrent remote queries.
+      refresh: Whether to bypass the cache of remote refs.
+      mode: One of the RESOLVE_* modes. In local modes, symbolic versions are
+        first resolved against the remote-tracking refs of local clones.
+    """
+    components = [c.resolve_tree(repo) for c in self.components]
+    unresolved = [c for c in components if c.resolved_version is None]
+
+    # Resolve against local clones.
+    local_refs = dict()
+    if mode in (RESOLVE_PREFER_LOCAL, RESOLVE_OFFLINE):
+      for c in unresolved:
+        if c.tree.url not in local_refs:
+          local_refs[c.tree.url] = c.tree.local_remote_refs()
+      unresolved = [
+          c for c in unresolved
+          if c.symbolic_version_or_head not in local_refs[c.tree.url]
+      ]
+    if unresolved and mode == RESOLVE_OFFLINE:
+      raise UserError(
+          "Symbolic version '{}' not found locally for '{}' (offline)",
+          unresolved[0].symbolic_version_or_head, unresolved[0].tree.url)
+
+    # Resolve the rest against remotes.
+    urls = [c.tree.url for c in unresolved]
+    remote_refs = lookup_remote_refs(repo, urls, jobs=jobs, refresh=refresh)
+
+    def refs_for(c):
+      refs = local_refs.get(c.tree.url)
+      if refs is not None and c.symbolic_version_or_head in refs:
+        return refs
+      return remote_refs.get(c.tree.url)
+
+    return VersionMap([c.resolve(repo, remote_refs=refs_for(c))
+                       for c in components])
 
 
 if __name__ == "__main__":
@@ -16,7 +16,18 @@
 
 
 TEST_MODULES="
+  mmrepo.commands.checkout
+  mmrepo.commands.dup
+  mmrepo.commands.fix
+  mmrepo.config
   mmrepo.git
+  mmrepo.graph_index
+  mmrepo.mirror
+  mmrepo.profiling
+  mmrepo.remote_policy
+  mmrepo.reporting
+  mmrepo.repo
+  mmrepo.testing
   mmrepo.version_map
 "
 
@@ -50,3 +61,6 @@ for testmod in $TEST_MODULES; do
   echo "RUNNING: $testmod"
   "$python_exe" -m "$testmod"
 done
+
+echo "RUNNING: benchmarks/bench.py doctests"
+"$python_exe" -m doctest "$td/benchmarks/bench.py"